@@ -0,0 +1,205 @@
+"""
+Fly8 maintenance commands
+Run from the backend directory, e.g. `python manage.py rebuild-summaries`
+"""
+import asyncio
+import json
+import time
+import uuid
+from datetime import datetime, timezone, timedelta
+from typing import List, Optional
+
+import typer
+
+from server import (
+    app,
+    client,
+    get_repositories,
+    hash_password,
+    load_services,
+    record_commission,
+    refresh_student_summary,
+    repositories,
+    stale_cache,
+    Repositories,
+    rebuild_student_summaries,
+    check_student_summaries,
+    backfill_commission_rollups,
+    rebuild_search_index,
+    search_users,
+    explain_search,
+    migrate_datetimes,
+)
+
+cli = typer.Typer(help="Fly8 maintenance commands")
+
+
+def run(coro):
+    try:
+        return asyncio.run(coro)
+    finally:
+        client.close()
+
+
+@cli.command("rebuild-summaries")
+def rebuild_summaries(batch_size: int = 500):
+    """Rebuild the student_summaries read model from students, users and applications"""
+    rebuilt = run(rebuild_student_summaries(repositories, batch_size))
+    typer.echo(f"Rebuilt {rebuilt} student summaries")
+
+
+@cli.command("check-summaries")
+def check_summaries(batch_size: int = 500, repair: bool = False):
+    """Report summaries that are missing, stale or orphaned (optionally repair them)"""
+    report = run(check_student_summaries(repositories, batch_size, repair=repair))
+    typer.echo(json.dumps(report, indent=2))
+    if not report['consistent'] and not repair:
+        raise typer.Exit(code=1)
+
+
+@cli.command("backfill-commissions")
+def backfill_commissions(batch_size: int = 1000):
+    """Recompute the per-agent daily/monthly/all-time commission rollups from the ledger"""
+    rollups = run(backfill_commission_rollups(repositories, batch_size))
+    typer.echo(f"Wrote {rollups} commission rollups")
+
+
+@cli.command("rebuild-search")
+def rebuild_search(batch_size: int = 500):
+    """Rebuild the admin search index from users and students"""
+    indexed = run(rebuild_search_index(repositories, batch_size))
+    typer.echo(f"Indexed {indexed} users")
+
+
+@cli.command("bench-search")
+def bench_search(
+    queries: List[str],
+    role: Optional[str] = None,
+    runs: int = 20,
+    target_ms: float = 50,
+):
+    """Show the candidate plans of admin search queries and fail if p95 latency exceeds target_ms"""
+    async def bench():
+        report = {}
+        for q in queries:
+            timings = []
+            for _ in range(runs):
+                started = time.perf_counter()
+                await search_users(repositories, q, role, 0, 20)
+                timings.append((time.perf_counter() - started) * 1000)
+            timings.sort()
+            report[q] = {
+                'p50Ms': round(timings[len(timings) // 2], 1),
+                'p95Ms': round(timings[min(len(timings) - 1, int(len(timings) * 0.95))], 1),
+                'plans': await explain_search(repositories, q, role)
+            }
+        return report
+    
+    report = run(bench())
+    typer.echo(json.dumps(report, indent=2, default=str))
+    if any(r['p95Ms'] > target_ms for r in report.values()):
+        raise typer.Exit(code=1)
+
+
+async def seed_memory(students: int, staff: int) -> Repositories:
+    """In-memory repositories with `staff` counselors and agents sharing `students` students"""
+    repos = Repositories.memory()
+    password = hash_password('password123')
+    now = datetime.now(timezone.utc)
+    
+    async def add_user(email, role, first_name, last_name, created_at=now):
+        user = {
+            'userId': str(uuid.uuid4()), 'email': email, 'password': password, 'firstName': first_name,
+            'lastName': last_name, 'role': role, 'isActive': True, 'createdAt': created_at
+        }
+        await repos.users.insert(user)
+        return user['userId']
+    
+    await add_user('admin@bench.fly8.com', 'super_admin', 'Bench', 'Admin')
+    counselors = [await add_user(f'counselor{i}@bench.fly8.com', 'counselor', 'Counselor', str(i)) for i in range(staff)]
+    agents = [await add_user(f'agent{i}@bench.fly8.com', 'agent', 'Agent', str(i)) for i in range(staff)]
+    services = [s['serviceId'] for s in await load_services(repos)]
+    
+    for i in range(students):
+        created_at = now - timedelta(minutes=i)
+        user_id = await add_user(f'student{i}@bench.fly8.com', 'student', f'Student{i}', 'Bench', created_at)
+        student_id = str(uuid.uuid4())
+        await repos.students.insert({
+            'studentId': student_id, 'userId': user_id, 'interestedCountries': ['USA', 'UK'],
+            'selectedServices': [], 'onboardingCompleted': True, 'createdAt': created_at,
+            'assignedCounselor': counselors[i % staff], 'assignedAgent': agents[i % staff]
+        })
+        service_id = services[i % len(services)]
+        await repos.applications.insert({
+            'applicationId': str(uuid.uuid4()), 'studentId': student_id, 'serviceId': service_id,
+            'status': 'in_progress', 'progress': i % 100, 'createdAt': created_at
+        })
+        await refresh_student_summary(repos, student_id)
+        await record_commission(repos, agents[i % staff], student_id, service_id, 300, 10)
+    await rebuild_search_index(repos)
+    return repos
+
+
+BENCH_ENDPOINTS = {
+    'admin@bench.fly8.com': [
+        '/api/admin/students', '/api/admin/students/summary', '/api/admin/counselors', '/api/admin/agents',
+        '/api/admin/commissions', '/api/admin/search?q=student1', '/api/bootstrap'
+    ],
+    'counselor0@bench.fly8.com': ['/api/counselors/dashboard', '/api/counselors/my-students', '/api/bootstrap'],
+    'agent0@bench.fly8.com': ['/api/agents/dashboard', '/api/agents/commissions', '/api/bootstrap'],
+}
+
+
+@cli.command("bench-handlers")
+def bench_handlers(students: int = 1000, staff: int = 10, runs: int = 50, target_ms: Optional[float] = None):
+    """Time read endpoints against seeded in-memory repositories, without MongoDB"""
+    from fastapi.testclient import TestClient
+    
+    repos = asyncio.run(seed_memory(students, staff))
+    app.dependency_overrides[get_repositories] = lambda: repos
+    http = TestClient(app)
+    report = {}
+    try:
+        for email, paths in BENCH_ENDPOINTS.items():
+            response = http.post('/api/auth/login', json={'email': email, 'password': 'password123'})
+            headers = {'Authorization': f"Bearer {response.json()['token']}"}
+            for path in paths:
+                timings = []
+                for _ in range(runs):
+                    # Time the handler, not the stale cache
+                    stale_cache.entries.clear()
+                    started = time.perf_counter()
+                    response = http.get(path, headers=headers)
+                    timings.append((time.perf_counter() - started) * 1000)
+                    if response.status_code != 200:
+                        raise typer.BadParameter(f"{path} returned {response.status_code}: {response.text}")
+                timings.sort()
+                report[f"{email.split('@')[0]} {path}"] = {
+                    'p50Ms': round(timings[len(timings) // 2], 2),
+                    'p95Ms': round(timings[min(len(timings) - 1, int(len(timings) * 0.95))], 2)
+                }
+    finally:
+        app.dependency_overrides.clear()
+    
+    typer.echo(json.dumps(report, indent=2))
+    if target_ms is not None and any(r['p95Ms'] > target_ms for r in report.values()):
+        raise typer.Exit(code=1)
+
+
+@cli.command("migrate-dates")
+def migrate_dates(batch_size: int = 1000, dry_run: bool = False):
+    """Convert ISO string timestamps (createdAt, lastLogin, ...) to native BSON dates"""
+    report = run(migrate_datetimes(batch_size, dry_run=dry_run))
+    verb = "Would convert" if dry_run else "Converted"
+    for field, count in report['converted'].items():
+        typer.echo(f"{verb} {count} {field}")
+    for field, unparseable in report['unparseable'].items():
+        typer.echo(f"Left {unparseable['count']} unparseable {field}: {', '.join(unparseable['ids'])}", err=True)
+    if not report['converted'] and not report['unparseable']:
+        typer.echo("No string timestamps left")
+    if report['unparseable']:
+        raise typer.Exit(code=1)
+
+
+if __name__ == "__main__":
+    cli()
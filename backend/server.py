@@ -1,30 +1,191 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, Request
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, Request, Response, Query, UploadFile, File
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import JSONResponse, PlainTextResponse
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReplaceOne, UpdateOne, monitoring, timeout as db_timeout
+from pymongo.errors import (
+    BulkWriteError, ConnectionFailure, DuplicateKeyError, ExecutionTimeout, NetworkTimeout,
+    ServerSelectionTimeoutError, WaitQueueTimeoutError
+)
 import os
+import sys
 import logging
 from pathlib import Path
-from pydantic import BaseModel, Field, ConfigDict, EmailStr
-from typing import List, Optional
+from pydantic import BaseModel, Field, ConfigDict, EmailStr, ValidationError
+from typing import List, Optional, Literal
 import uuid
+import heapq
+import re
+import math
+import random
+import csv
+import json
+import codecs
+import asyncio
+import time
+import threading
+from collections import OrderedDict, deque
+from contextvars import Context, ContextVar
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone, timedelta
+from urllib.parse import parse_qs
 import jwt
 import bcrypt
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
-# MongoDB connection
-mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
-db = client[os.environ['DB_NAME']]
-
 # JWT Configuration
 JWT_SECRET = os.environ.get('JWT_SECRET', 'fly8_super_secret_jwt_key_2024')
 JWT_ALGORITHM = 'HS256'
 
+# Session mode: 'legacy' issues 7-day tokens resolved against the users collection;
+# 'claims' issues short-lived access tokens carrying the profile plus rotating refresh tokens
+AUTH_SESSION_MODE = os.environ.get('AUTH_SESSION_MODE', 'legacy')
+ACCESS_TOKEN_TTL = timedelta(minutes=int(os.environ.get('ACCESS_TOKEN_TTL_MINUTES', 15)))
+REFRESH_TOKEN_TTL = timedelta(days=int(os.environ.get('REFRESH_TOKEN_TTL_DAYS', 30)))
+REVOCATION_SYNC_SECONDS = int(os.environ.get('REVOCATION_SYNC_SECONDS', 30))
+
+# Write-behind buffer for non-critical updates (lastLogin, activity, counters)
+WRITE_BEHIND_INTERVAL = float(os.environ.get('WRITE_BEHIND_INTERVAL_SECONDS', 2))
+WRITE_BEHIND_MAX_PENDING = int(os.environ.get('WRITE_BEHIND_MAX_PENDING', 5000))
+
+# Audit log: bounded in-memory queue written in batches
+AUDIT_QUEUE_SIZE = int(os.environ.get('AUDIT_QUEUE_SIZE', 10000))
+AUDIT_BATCH_SIZE = int(os.environ.get('AUDIT_BATCH_SIZE', 500))
+AUDIT_FLUSH_SECONDS = float(os.environ.get('AUDIT_FLUSH_SECONDS', 1))
+AUDIT_OVERFLOW_POLICY = os.environ.get('AUDIT_OVERFLOW_POLICY', 'drop')  # 'drop' or 'block'
+AUDIT_COLLECTION_MODE = os.environ.get('AUDIT_COLLECTION_MODE', 'standard')  # 'standard', 'capped' or 'timeseries'
+AUDIT_CAPPED_SIZE_MB = int(os.environ.get('AUDIT_CAPPED_SIZE_MB', 1024))
+
+# Notifications: events are fanned out to inboxes by a background worker
+NOTIFICATION_QUEUE_SIZE = int(os.environ.get('NOTIFICATION_QUEUE_SIZE', 10000))
+NOTIFICATION_BATCH_SIZE = int(os.environ.get('NOTIFICATION_BATCH_SIZE', 1000))
+
+# Request deadlines: every request gets a latency budget that also caps its MongoDB calls
+REQUEST_BUDGET_SECONDS = float(os.environ.get('REQUEST_BUDGET_SECONDS', 10))
+DASHBOARD_BUDGET_SECONDS = float(os.environ.get('DASHBOARD_BUDGET_SECONDS', 3))
+AUTH_BUDGET_SECONDS = float(os.environ.get('AUTH_BUDGET_SECONDS', 5))
+# Writes are never cancelled; this only bounds their MongoDB calls
+WRITE_BUDGET_SECONDS = float(os.environ.get('WRITE_BUDGET_SECONDS', 30))
+PARTIAL_RESERVE_SECONDS = float(os.environ.get('PARTIAL_RESERVE_MS', 200)) / 1000
+
+# Circuit breaker: opens when too many recent database calls fail or run slow
+BREAKER_WINDOW_SECONDS = float(os.environ.get('BREAKER_WINDOW_SECONDS', 10))
+BREAKER_MIN_CALLS = int(os.environ.get('BREAKER_MIN_CALLS', 20))
+BREAKER_FAILURE_RATE = float(os.environ.get('BREAKER_FAILURE_RATE', 0.5))
+BREAKER_SLOW_CALL_SECONDS = float(os.environ.get('BREAKER_SLOW_CALL_MS', 2000)) / 1000
+BREAKER_OPEN_SECONDS = float(os.environ.get('BREAKER_OPEN_SECONDS', 15))
+
+# Last-known-good results of read endpoints, served while the breaker is open
+STALE_CACHE_MAX_ENTRIES = int(os.environ.get('STALE_CACHE_MAX_ENTRIES', 10000))
+SERVICE_CATALOG_FRESH_SECONDS = float(os.environ.get('SERVICE_CATALOG_FRESH_SECONDS', 60))
+
+# Per-request profiling for admins; profiles are written to PROFILE_DIR if set, else returned inline
+PROFILE_DIR = os.environ.get('PROFILE_DIR')
+PROFILE_SAMPLE_HZ = int(os.environ.get('PROFILE_SAMPLE_HZ', 500))
+# Fraction of flagged requests that are actually profiled
+PROFILE_REQUEST_RATE = float(os.environ.get('PROFILE_REQUEST_RATE', 1.0))
+
+# ============== CIRCUIT BREAKER ==============
+# Fed by pymongo command monitoring, so every database call counts: a call fails
+# if it hit a network error or timeout, or took longer than the slow-call
+# threshold. Once the failure rate over the window crosses the threshold the
+# breaker opens; after the cooldown one trial call is let through, and the next
+# outcome closes or re-opens it.
+
+class CircuitBreaker(monitoring.CommandListener):
+    def __init__(self, window: float, min_calls: int, failure_rate: float, slow_call: float, open_seconds: float):
+        self.window = window
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.slow_call = slow_call
+        self.open_seconds = open_seconds
+        self.state = 'closed'
+        self.opened_at = 0.0
+        self.opened = 0
+        self.calls = deque()
+        self.failures = 0
+        self._lock = threading.Lock()
+    
+    # Command events are published from Motor's worker threads
+    def started(self, event):
+        pass
+    
+    def succeeded(self, event):
+        self.record(event.duration_micros / 1e6 > self.slow_call)
+    
+    def failed(self, event):
+        # Server replies (duplicate key, validation) say the database is up;
+        # client-side errors and MaxTimeMSExpired (code 50) say it is not keeping up
+        self.record('errtype' in event.failure or event.failure.get('code') == 50)
+    
+    def record_exception(self, exc: Exception):
+        # Server selection and pool checkout fail before any command is published
+        if isinstance(exc, (ServerSelectionTimeoutError, WaitQueueTimeoutError)):
+            self.record(True)
+    
+    def record(self, failed: bool):
+        now = time.monotonic()
+        with self._lock:
+            if self.state == 'half_open':
+                if failed:
+                    self._open(now)
+                else:
+                    self._close()
+                return
+            if self.state == 'open':
+                return
+            self.calls.append((now, failed))
+            self.failures += failed
+            while self.calls[0][0] < now - self.window:
+                self.failures -= self.calls.popleft()[1]
+            if len(self.calls) >= self.min_calls and self.failures / len(self.calls) >= self.failure_rate:
+                self._open(now)
+    
+    def _open(self, now: float):
+        self.state = 'open'
+        self.opened_at = now
+        self.opened += 1
+        self.calls.clear()
+        self.failures = 0
+        logger.warning(f"Database circuit breaker open for {self.open_seconds}s")
+    
+    def _close(self):
+        self.state = 'closed'
+        logger.info("Database circuit breaker closed")
+    
+    def allow(self) -> bool:
+        """Whether to attempt a database call; while open, one trial call per cooldown."""
+        with self._lock:
+            if self.state == 'closed':
+                return True
+            now = time.monotonic()
+            if now - self.opened_at < self.open_seconds:
+                return False
+            self.state = 'half_open'
+            self.opened_at = now
+            return True
+    
+    def retry_after(self) -> int:
+        return max(1, math.ceil(self.opened_at + self.open_seconds - time.monotonic()))
+    
+    def stats(self) -> dict:
+        return {'state': self.state, 'opened': self.opened, 'recentCalls': len(self.calls), 'recentFailures': self.failures}
+
+db_breaker = CircuitBreaker(
+    BREAKER_WINDOW_SECONDS, BREAKER_MIN_CALLS, BREAKER_FAILURE_RATE,
+    BREAKER_SLOW_CALL_SECONDS, BREAKER_OPEN_SECONDS
+)
+
+# MongoDB connection
+mongo_url = os.environ['MONGO_URL']
+# tz_aware so stored BSON dates come back as UTC datetimes (serialized with +00:00)
+client = AsyncIOMotorClient(mongo_url, tz_aware=True, event_listeners=[db_breaker])
+db = client[os.environ['DB_NAME']]
+
 # Create the main app
 app = FastAPI(title="Fly8 API", version="1.0.0")
 
@@ -35,97 +196,2984 @@ admin_router = APIRouter(prefix="/admin", tags=["Admin"])
 student_router = APIRouter(prefix="/students", tags=["Students"])
 service_router = APIRouter(prefix="/services", tags=["Services"])
 
-security = HTTPBearer()
+security = HTTPBearer()
+
+# bcrypt releases the GIL, so a thread pool hashes passwords in parallel
+hash_executor = ThreadPoolExecutor(max_workers=int(os.environ.get('HASH_WORKERS', os.cpu_count() or 4)))
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# ============== MODELS ==============
+
+class UserCreate(BaseModel):
+    email: EmailStr
+    password: str
+    firstName: str
+    lastName: str
+    role: Optional[str] = "student"
+
+class UserLogin(BaseModel):
+    email: EmailStr
+    password: str
+
+class UserResponse(BaseModel):
+    userId: str
+    email: str
+    firstName: str
+    lastName: str
+    role: str
+    phone: Optional[str] = None
+    country: Optional[str] = None
+
+class TokenResponse(BaseModel):
+    message: str
+    token: str
+    refreshToken: Optional[str] = None
+    user: UserResponse
+
+class RefreshRequest(BaseModel):
+    refreshToken: str
+
+class OnboardingData(BaseModel):
+    interestedCountries: List[str] = []
+    selectedServices: List[str] = []
+    intake: Optional[str] = None
+    preferredDestination: Optional[str] = None
+
+class ServiceCreate(BaseModel):
+    name: str
+    description: str
+    category: str
+    estimatedDuration: Optional[str] = None
+    price: Optional[float] = None
+
+class ServiceApplicationCreate(BaseModel):
+    serviceId: str
+
+class StudentAssignment(BaseModel):
+    studentId: str
+    counselorId: Optional[str] = None
+    agentId: Optional[str] = None
+
+class BulkAssignmentRequest(BaseModel):
+    assignments: List[StudentAssignment] = []
+    policy: Optional[Literal['least_loaded']] = None
+    studentIds: List[str] = []
+    counselorIds: List[str] = []
+    limit: int = Field(1000, ge=1, le=10000)
+
+class AnnouncementCreate(BaseModel):
+    title: str
+    message: str
+    roles: List[Literal['student', 'counselor', 'agent', 'super_admin']] = ['student', 'counselor', 'agent']
+
+class CommissionCreate(BaseModel):
+    agentId: str
+    studentId: str
+    serviceId: str
+    amount: float
+    percentage: float = 10
+
+# ============== UTILITY FUNCTIONS ==============
+
+def hash_password(password: str) -> str:
+    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+
+async def hash_password_async(password: str) -> str:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(hash_executor, hash_password, password)
+
+def verify_password(password: str, hashed: str) -> bool:
+    return bcrypt.checkpw(password.encode('utf-8'), hashed.encode('utf-8'))
+
+def create_token(user_id: str, role: str) -> str:
+    payload = {
+        'userId': user_id,
+        'role': role,
+        'exp': datetime.now(timezone.utc) + timedelta(days=7)
+    }
+    return jwt.encode(payload, JWT_SECRET, algorithm=JWT_ALGORITHM)
+
+# ============== REPOSITORIES ==============
+# Handlers reach users, students, service_applications, services, commissions,
+# the read models (student summaries, search index, commission rollups), the
+# audit log and notification inboxes through a Repositories bundle injected
+# with Depends(get_repositories), so every query on those collections lives
+# here. The Motor repositories run against MongoDB; the in-memory ones keep
+# documents in dicts with hash indexes on the fields the queries filter on, for
+# unit tests and benchmarks of handler logic. Sessions, the write-behind buffer
+# and date migrations stay on Motor. Projections are Mongo-style in both
+# implementations.
+
+PUBLIC_USER = {'_id': 0, 'password': 0}
+NO_ID = {'_id': 0}
+
+class MotorUserRepository:
+    def __init__(self, collection):
+        self.collection = collection
+    
+    async def ensure_indexes(self):
+        # Unique users; bulk import relies on the email index to reject duplicates
+        try:
+            await self.collection.create_index('email', unique=True)
+            await self.collection.create_index('userId', unique=True)
+        except Exception as e:
+            logger.warning(f"Could not create unique user indexes: {e}")
+        await self.collection.create_index('role')
+        await self.collection.create_index([('role', 1), ('createdAt', -1)])
+    
+    async def has_unique_email(self) -> bool:
+        indexes = await self.collection.index_information()
+        return any(i.get('unique') and i['key'] == [('email', 1)] for i in indexes.values())
+    
+    async def get(self, user_id: str, projection: dict = PUBLIC_USER) -> Optional[dict]:
+        return await self.collection.find_one({'userId': user_id}, projection)
+    
+    async def get_by_email(self, email: str) -> Optional[dict]:
+        """Full user document, password hash included."""
+        return await self.collection.find_one({'email': email}, NO_ID)
+    
+    async def find_many(self, user_ids: List[str], projection: dict = PUBLIC_USER) -> List[dict]:
+        return await self.collection.find({'userId': {'$in': user_ids}}, projection).to_list(None)
+    
+    async def list_by_role(self, role: str, limit: int = 100, projection: dict = PUBLIC_USER) -> List[dict]:
+        return await self.collection.find({'role': role}, projection).to_list(limit)
+    
+    async def count_by_role(self, role: str) -> int:
+        return await self.collection.count_documents({'role': role})
+    
+    async def active_ids(self, role: str, user_ids: Optional[List[str]] = None) -> List[str]:
+        query = {'role': role, 'isActive': True}
+        if user_ids is not None:
+            query['userId'] = {'$in': user_ids}
+        return await self.collection.distinct('userId', query)
+    
+    async def iter_active_ids(self, roles: List[str], batch_size: int = 1000):
+        async for user in self.collection.find(
+            {'role': {'$in': roles}, 'isActive': True}, {'_id': 0, 'userId': 1}
+        ).batch_size(batch_size):
+            yield user['userId']
+    
+    async def iter_all(self, batch_size: int = 500):
+        async for user in self.collection.find({}, PUBLIC_USER).batch_size(batch_size):
+            yield user
+    
+    async def insert(self, doc: dict):
+        # Insert a copy so the caller's document doesn't pick up an ObjectId
+        await self.collection.insert_one(dict(doc))
+    
+    async def insert_many(self, docs: List[dict]) -> dict:
+        """Insert what can be inserted; returns {index: error} for the rest ('duplicate' for taken emails)."""
+        failed = {}
+        try:
+            await self.collection.insert_many([dict(doc) for doc in docs], ordered=False)
+        except BulkWriteError as e:
+            for error in e.details.get('writeErrors', []):
+                failed[error['index']] = 'duplicate' if error.get('code') == 11000 else error.get('errmsg')
+        return failed
+
+class MotorStudentRepository:
+    def __init__(self, collection):
+        self.collection = collection
+    
+    async def ensure_indexes(self):
+        await self.collection.create_index('studentId', unique=True)
+        await self.collection.create_index('userId')
+        await self.collection.create_index([('assignedCounselor', 1), ('createdAt', 1)])
+        await self.collection.create_index('assignedAgent')
+    
+    async def get(self, student_id: str, projection: dict = NO_ID) -> Optional[dict]:
+        return await self.collection.find_one({'studentId': student_id}, projection)
+    
+    async def get_by_user(self, user_id: str, projection: dict = NO_ID) -> Optional[dict]:
+        return await self.collection.find_one({'userId': user_id}, projection)
+    
+    async def find_many(self, student_ids: List[str], projection: dict = NO_ID) -> List[dict]:
+        return await self.collection.find({'studentId': {'$in': student_ids}}, projection).to_list(None)
+    
+    async def find_by_users(self, user_ids: List[str], projection: dict = NO_ID) -> List[dict]:
+        return await self.collection.find({'userId': {'$in': user_ids}}, projection).to_list(None)
+    
+    async def list(self, projection: dict = NO_ID, limit: int = 1000) -> List[dict]:
+        return await self.collection.find({}, projection).to_list(limit)
+    
+    async def list_assigned(self, field: str, user_id: str, projection: dict = NO_ID, limit: int = 100) -> List[dict]:
+        """Students whose assignedCounselor/assignedAgent (`field`) is user_id."""
+        return await self.collection.find({field: user_id}, projection).to_list(limit)
+    
+    async def list_unassigned_ids(self, limit: int, student_ids: Optional[List[str]] = None) -> List[str]:
+        """Students without a counselor (optionally only among student_ids), oldest first."""
+        query = {'assignedCounselor': None}
+        if student_ids is not None:
+            query['studentId'] = {'$in': student_ids}
+        students = await self.collection.find(
+            query, {'_id': 0, 'studentId': 1}
+        ).sort('createdAt', 1).to_list(limit)
+        return [s['studentId'] for s in students]
+    
+    async def count(self) -> int:
+        return await self.collection.count_documents({})
+    
+    async def assignment_load(self, field: str, user_ids: List[str]) -> dict:
+        """Number of students assigned to each user, from a single aggregation."""
+        load = {user_id: 0 for user_id in user_ids}
+        async for row in self.collection.aggregate([
+            {'$match': {field: {'$in': user_ids}}},
+            {'$group': {'_id': f'${field}', 'count': {'$sum': 1}}}
+        ]):
+            load[row['_id']] = row['count']
+        return load
+    
+    async def existing_ids(self, student_ids: List[str]) -> set:
+        return set(await self.collection.distinct('studentId', {'studentId': {'$in': student_ids}}))
+    
+    async def insert(self, doc: dict):
+        await self.collection.insert_one(dict(doc))
+    
+    async def insert_many(self, docs: List[dict]):
+        await self.collection.insert_many([dict(doc) for doc in docs], ordered=False)
+    
+    async def update_by_user(self, user_id: str, fields: dict):
+        await self.collection.update_one({'userId': user_id}, {'$set': fields})
+    
+    async def assign(self, assignments: dict) -> tuple:
+        """Apply {studentId: fields} with one bulk write; returns (matched, modified)."""
+        result = await self.collection.bulk_write([
+            UpdateOne({'studentId': student_id}, {'$set': fields})
+            for student_id, fields in assignments.items()
+        ], ordered=False)
+        return result.matched_count, result.modified_count
+    
+    async def iter_all(self, batch_size: int = 500):
+        async for student in self.collection.find({}, NO_ID).batch_size(batch_size):
+            yield student
+
+class MotorApplicationRepository:
+    def __init__(self, collection):
+        self.collection = collection
+    
+    async def ensure_indexes(self):
+        await self.collection.create_index([('studentId', 1), ('createdAt', -1)])
+        await self.collection.create_index([('status', 1), ('createdAt', -1)])
+    
+    async def list_for_student(self, student_id: str, projection: dict = NO_ID,
+                               limit: int = 100, newest_first: bool = False) -> List[dict]:
+        cursor = self.collection.find({'studentId': student_id}, projection)
+        if newest_first:
+            cursor = cursor.sort('createdAt', -1)
+        return await cursor.to_list(limit)
+    
+    async def list_for_students(self, student_ids: List[str], projection: dict = NO_ID) -> List[dict]:
+        return await self.collection.find({'studentId': {'$in': student_ids}}, projection).to_list(None)
+    
+    async def counts_by_student(self, student_ids: List[str]) -> dict:
+        counts = {}
+        async for row in self.collection.aggregate([
+            {'$match': {'studentId': {'$in': student_ids}}},
+            {'$group': {'_id': '$studentId', 'count': {'$sum': 1}}}
+        ]):
+            counts[row['_id']] = row['count']
+        return counts
+    
+    async def find(self, student_id: str, service_id: str) -> Optional[dict]:
+        return await self.collection.find_one({'studentId': student_id, 'serviceId': service_id}, NO_ID)
+    
+    async def count_by_status(self, statuses: List[str]) -> int:
+        return await self.collection.count_documents({'status': {'$in': statuses}})
+    
+    async def insert(self, doc: dict):
+        await self.collection.insert_one(dict(doc))
+
+class MotorServiceRepository:
+    def __init__(self, collection):
+        self.collection = collection
+    
+    async def ensure_indexes(self):
+        pass
+    
+    async def list(self, limit: int = 100) -> List[dict]:
+        return await self.collection.find({}, NO_ID).to_list(limit)
+    
+    async def find_many(self, service_ids: List[str], projection: dict = NO_ID) -> List[dict]:
+        return await self.collection.find({'serviceId': {'$in': service_ids}}, projection).to_list(None)
+    
+    async def insert_many(self, docs: List[dict]):
+        await self.collection.insert_many([dict(doc) for doc in docs])
+
+class MotorCommissionRepository:
+    def __init__(self, collection):
+        self.collection = collection
+    
+    async def ensure_indexes(self):
+        await self.collection.create_index('commissionId', unique=True)
+        await self.collection.create_index([('agentId', 1), ('createdAt', -1)])
+        await self.collection.create_index([('createdAt', -1)])
+    
+    async def insert(self, doc: dict):
+        await self.collection.insert_one(dict(doc))
+    
+    async def transition(self, commission_id: str, from_statuses: List[str], update: dict) -> Optional[dict]:
+        """Apply update if the commission is in one of from_statuses; returns the previous document."""
+        return await self.collection.find_one_and_update(
+            {'commissionId': commission_id, 'status': {'$in': from_statuses}},
+            {'$set': update},
+            projection=NO_ID
+        )
+    
+    async def list(self, agent_id: Optional[str] = None, created_from: Optional[datetime] = None,
+                   created_to: Optional[datetime] = None, order: str = 'desc',
+                   skip: int = 0, limit: int = 100, projection: dict = NO_ID) -> List[dict]:
+        query = date_range('createdAt', created_from, created_to)
+        if agent_id:
+            query['agentId'] = agent_id
+        return await self.collection.find(query, projection) \
+            .sort('createdAt', -1 if order == 'desc' else 1).skip(skip).limit(limit).to_list(limit)
+    
+    async def iter_all(self, projection: dict = NO_ID, batch_size: int = 1000):
+        async for commission in self.collection.find({}, projection).batch_size(batch_size):
+            yield commission
+    
+    async def count(self) -> int:
+        return await self.collection.count_documents({})
+
+class MotorSummaryRepository:
+    def __init__(self, collection):
+        self.collection = collection
+    
+    async def ensure_indexes(self):
+        await self.collection.create_index('studentId', unique=True)
+        await self.collection.create_index('userId')
+        await self.collection.create_index([('assignedCounselor', 1), ('createdAt', -1)])
+        await self.collection.create_index([('assignedAgent', 1), ('createdAt', -1)])
+        await self.collection.create_index([('createdAt', -1)])
+    
+    async def is_empty(self) -> bool:
+        return await self.collection.estimated_document_count() == 0
+    
+    async def find_many(self, student_ids: List[str], projection: dict = NO_ID) -> List[dict]:
+        return await self.collection.find({'studentId': {'$in': student_ids}}, projection).to_list(None)
+    
+    async def iter_ids(self, batch_size: int = 500):
+        async for summary in self.collection.find({}, {'_id': 0, 'studentId': 1}).batch_size(batch_size):
+            yield summary['studentId']
+    
+    async def page(self, filters: dict, created_from: Optional[datetime] = None, created_to: Optional[datetime] = None,
+                   order: str = 'desc', skip: int = 0, limit: int = 100) -> tuple:
+        """Summaries matching the equality filters and createdAt range; returns (page, total)."""
+        query = {**filters, **date_range('createdAt', created_from, created_to)}
+        total = await self.collection.count_documents(query)
+        summaries = await self.collection.find(query, NO_ID) \
+            .sort('createdAt', -1 if order == 'desc' else 1).skip(skip).limit(limit).to_list(limit)
+        return summaries, total
+    
+    async def totals(self, field: str, user_id: str) -> dict:
+        """Student and application counts over the summaries whose `field` is user_id."""
+        totals = {'students': 0, 'applications': 0, 'activeApplications': 0}
+        async for row in self.collection.aggregate([
+            {'$match': {field: user_id}},
+            {'$group': {
+                '_id': None,
+                'students': {'$sum': 1},
+                'applications': {'$sum': '$totalApplications'},
+                'activeApplications': {'$sum': {'$add': [
+                    '$applicationCounts.not_started', '$applicationCounts.in_progress'
+                ]}}
+            }}
+        ]):
+            totals = {k: row[k] for k in totals}
+        return totals
+    
+    async def replace(self, summary: dict):
+        await self.collection.replace_one({'studentId': summary['studentId']}, summary, upsert=True)
+    
+    async def replace_many(self, summaries: List[dict]):
+        await self.collection.bulk_write([
+            ReplaceOne({'studentId': s['studentId']}, s, upsert=True) for s in summaries
+        ], ordered=False)
+    
+    async def assign(self, assignments: dict):
+        """Same {studentId: fields} $set as the students collection."""
+        await self.collection.bulk_write([
+            UpdateOne({'studentId': student_id}, {'$set': fields}) for student_id, fields in assignments.items()
+        ], ordered=False)
+    
+    async def delete(self, student_id: str):
+        await self.collection.delete_one({'studentId': student_id})
+    
+    async def delete_stale(self, before: datetime):
+        await self.collection.delete_many({'updatedAt': {'$lt': before}})
+
+class MotorSearchRepository:
+    def __init__(self, collection):
+        self.collection = collection
+    
+    async def ensure_indexes(self):
+        await self.collection.create_index('userId', unique=True)
+        await self.collection.create_index('grams')
+        await self.collection.create_index([('role', 1), ('grams', 1)])
+    
+    async def is_empty(self) -> bool:
+        return await self.collection.estimated_document_count() == 0
+    
+    async def gram_counts(self, grams: List[str], limit: int) -> List[int]:
+        """Entries holding each gram, counted up to limit."""
+        return await asyncio.gather(*(
+            self.collection.count_documents({'grams': gram}, limit=limit) for gram in grams
+        ))
+    
+    async def scored(self, match: dict, prefixes: List[str], trigrams: List[str], min_trigrams: int, top: int) -> dict:
+        """The `top` best scored entries among the candidates matching `match`; returns
+        {'candidates': n, 'entries': [...]}, n above SEARCH_MAX_CANDIDATES meaning the set was cut."""
+        [result] = await self.collection.aggregate(
+            _scored_pipeline(match, prefixes, trigrams, min_trigrams, top)
+        ).to_list(1)
+        return {
+            'candidates': result['candidates'][0]['n'] if result['candidates'] else 0,
+            'entries': result['entries']
+        }
+    
+    async def explain(self, match: dict, prefixes: List[str], trigrams: List[str], min_trigrams: int, top: int) -> dict:
+        explain = await self.collection.database.command(
+            'explain', {
+                'aggregate': self.collection.name,
+                'pipeline': _scored_pipeline(match, prefixes, trigrams, min_trigrams, top),
+                'cursor': {}
+            },
+            verbosity='executionStats'
+        )
+        stats = _execution_stats(explain)
+        return {
+            'keysExamined': stats.get('totalKeysExamined'),
+            'docsExamined': stats.get('totalDocsExamined'),
+            'executionTimeMillis': stats.get('executionTimeMillis')
+        }
+    
+    async def replace(self, entry: dict):
+        await self.collection.replace_one({'userId': entry['userId']}, entry, upsert=True)
+    
+    async def replace_many(self, entries: List[dict]):
+        await self.collection.bulk_write([
+            ReplaceOne({'userId': e['userId']}, e, upsert=True) for e in entries
+        ], ordered=False)
+    
+    async def delete(self, user_id: str):
+        await self.collection.delete_one({'userId': user_id})
+    
+    async def delete_stale(self, before: datetime):
+        await self.collection.delete_many({'indexedAt': {'$lt': before}})
+
+class MotorRollupRepository:
+    def __init__(self, collection):
+        self.collection = collection
+    
+    async def ensure_indexes(self):
+        await self.collection.create_index([('agentId', 1), ('granularity', 1), ('bucket', 1)], unique=True)
+    
+    async def is_empty(self) -> bool:
+        return await self.collection.estimated_document_count() == 0
+    
+    async def increment(self, agent_id: str, buckets: List[tuple], increments: dict):
+        """$inc the agent's rollup in each (granularity, bucket), creating missing ones."""
+        await self.collection.bulk_write([
+            UpdateOne(
+                {'agentId': agent_id, 'granularity': granularity, 'bucket': bucket},
+                {'$inc': increments},
+                upsert=True
+            )
+            for granularity, bucket in buckets
+        ], ordered=False)
+    
+    async def all_time(self, agent_ids: List[str]) -> List[dict]:
+        return await self.collection.find(
+            {'agentId': {'$in': agent_ids}, 'granularity': 'all'},
+            {'_id': 0, 'agentId': 1, 'count': 1, 'amounts': 1}
+        ).to_list(None)
+    
+    async def buckets(self, agent_id: str, granularity: str, start: Optional[str] = None,
+                      end: Optional[str] = None) -> List[dict]:
+        """One agent's rollups of a granularity with start <= bucket <= end, oldest first."""
+        query = {'agentId': agent_id, 'granularity': granularity}
+        if start or end:
+            query['bucket'] = {}
+            if start:
+                query['bucket']['$gte'] = start
+            if end:
+                query['bucket']['$lte'] = end
+        return await self.collection.find(
+            query, {'_id': 0, 'agentId': 0, 'granularity': 0, 'rebuiltAt': 0}
+        ).sort('bucket', 1).to_list(None)
+    
+    async def summary(self) -> dict:
+        """Commission count and amount per status summed over every agent's all-time rollup."""
+        summary = {'count': 0, **{s: 0 for s in COMMISSION_STATUSES}}
+        async for row in self.collection.aggregate([
+            {'$match': {'granularity': 'all'}},
+            {'$group': {
+                '_id': None,
+                'count': {'$sum': '$count'},
+                **{s: {'$sum': f'$amounts.{s}'} for s in COMMISSION_STATUSES}
+            }}
+        ]):
+            summary = {k: row[k] for k in summary}
+        return summary
+    
+    async def replace_many(self, rollups: List[dict]):
+        await self.collection.bulk_write([
+            ReplaceOne(
+                {'agentId': r['agentId'], 'granularity': r['granularity'], 'bucket': r['bucket']}, r, upsert=True
+            )
+            for r in rollups
+        ], ordered=False)
+    
+    async def delete_stale(self, before: datetime):
+        await self.collection.delete_many({
+            '$or': [{'rebuiltAt': {'$exists': False}}, {'rebuiltAt': {'$lt': before}}]
+        })
+
+class MotorAuditRepository:
+    def __init__(self, database):
+        self.database = database
+        self.collection = database.audit_logs
+    
+    async def ensure_indexes(self):
+        # A capped or time-series collection has to exist before the first insert
+        if self.collection.name not in await self.database.list_collection_names():
+            if AUDIT_COLLECTION_MODE == 'capped':
+                await self.database.create_collection(
+                    self.collection.name, capped=True, size=AUDIT_CAPPED_SIZE_MB * 1024 * 1024
+                )
+            elif AUDIT_COLLECTION_MODE == 'timeseries':
+                await self.database.create_collection(
+                    self.collection.name, timeseries={'timeField': 'timestamp', 'granularity': 'seconds'}
+                )
+        await self.collection.create_index([('userId', 1), ('timestamp', -1)])
+        await self.collection.create_index([('action', 1), ('timestamp', -1)])
+        await self.collection.create_index([('timestamp', -1)])
+    
+    async def insert_many(self, events: List[dict]):
+        await self.collection.insert_many([dict(event) for event in events], ordered=False)
+    
+    async def find(self, filters: dict, start: Optional[datetime] = None, end: Optional[datetime] = None,
+                   skip: int = 0, limit: int = 50) -> List[dict]:
+        """Events matching the equality filters and timestamp range, newest first."""
+        query = {**filters, **date_range('timestamp', start, end)}
+        return await self.collection.find(query, NO_ID) \
+            .sort('timestamp', -1).skip(skip).limit(limit).to_list(limit)
+
+class MotorInboxRepository:
+    def __init__(self, database):
+        self.notifications = database.notifications
+        self.counters = database.notification_counters
+    
+    async def ensure_indexes(self):
+        await self.notifications.create_index('notificationId', unique=True)
+        await self.notifications.create_index([('recipientId', 1), ('createdAt', -1)])
+        await self.notifications.create_index([('recipientId', 1), ('isRead', 1)])
+        await self.counters.create_index('userId', unique=True)
+    
+    async def deliver(self, docs: List[dict]):
+        """Insert unread notifications and bump each recipient's unread counter."""
+        await self.notifications.insert_many([dict(doc) for doc in docs], ordered=False)
+        unread = {}
+        for doc in docs:
+            unread[doc['recipientId']] = unread.get(doc['recipientId'], 0) + 1
+        await self.counters.bulk_write([
+            UpdateOne({'userId': recipient_id}, {'$inc': {'unread': count}}, upsert=True)
+            for recipient_id, count in unread.items()
+        ], ordered=False)
+    
+    async def list(self, recipient_id: str, unread_only: bool = False, skip: int = 0, limit: int = 20) -> List[dict]:
+        query = {'recipientId': recipient_id}
+        if unread_only:
+            query['isRead'] = False
+        return await self.notifications.find(query, NO_ID) \
+            .sort('createdAt', -1).skip(skip).limit(limit).to_list(limit)
+    
+    async def unread_count(self, recipient_id: str) -> int:
+        counter = await self.counters.find_one({'userId': recipient_id}, {'_id': 0, 'unread': 1})
+        return max(counter.get('unread', 0), 0) if counter else 0
+    
+    async def mark_all_read(self, recipient_id: str) -> int:
+        result = await self.notifications.update_many(
+            {'recipientId': recipient_id, 'isRead': False},
+            {'$set': {'isRead': True}}
+        )
+        if result.modified_count:
+            await self.counters.update_one({'userId': recipient_id}, {'$inc': {'unread': -result.modified_count}})
+        return result.modified_count
+    
+    async def mark_read(self, recipient_id: str, notification_id: str) -> bool:
+        result = await self.notifications.update_one(
+            {'notificationId': notification_id, 'recipientId': recipient_id, 'isRead': False},
+            {'$set': {'isRead': True}}
+        )
+        if result.modified_count:
+            await self.counters.update_one({'userId': recipient_id}, {'$inc': {'unread': -1}})
+        return bool(result.modified_count)
+
+def project(doc: Optional[dict], projection: Optional[dict]) -> Optional[dict]:
+    """Apply a top-level Mongo projection to an in-memory document, returning a copy."""
+    if doc is None:
+        return None
+    fields = {k: v for k, v in (projection or {}).items() if k != '_id'}
+    
+    def copy(value):
+        if isinstance(value, list):
+            return list(value)
+        if isinstance(value, dict):
+            return dict(value)
+        return value
+    
+    if any(fields.values()):
+        return {k: copy(doc[k]) for k in fields if k in doc}
+    return {k: copy(v) for k, v in doc.items() if k not in fields}
+
+class MemoryTable:
+    """Documents keyed by one field, with unique and non-unique hash indexes on others.
+    
+    Like a multikey index, a non-unique index on a list field indexes each element.
+    """
+    
+    def __init__(self, key: str, unique: tuple = (), indexes: tuple = ()):
+        self.key = key
+        self.docs = {}
+        self.unique = {field: {} for field in unique}
+        self.indexes = {field: {} for field in indexes}
+    
+    def insert(self, doc: dict):
+        key = doc[self.key]
+        if key in self.docs or any(doc.get(f) in values for f, values in self.unique.items()):
+            raise DuplicateKeyError(f"Duplicate key {self.key}={key}", 11000)
+        doc = project(doc, None)
+        self.docs[key] = doc
+        self._index(key, doc)
+    
+    def update(self, key, fields: dict) -> bool:
+        """Set fields on one document; returns whether anything changed."""
+        doc = self.docs.get(key)
+        if doc is None or all(doc.get(f) == v for f, v in fields.items()):
+            return False
+        self._unindex(key, doc)
+        doc.update(fields)
+        self._index(key, doc)
+        return True
+    
+    def delete(self, key) -> Optional[dict]:
+        doc = self.docs.pop(key, None)
+        if doc is not None:
+            self._unindex(key, doc)
+        return doc
+    
+    def get(self, key) -> Optional[dict]:
+        return self.docs.get(key)
+    
+    def get_by(self, field: str, value) -> Optional[dict]:
+        return self.docs.get(self.unique[field].get(value))
+    
+    def find_by(self, field: str, value) -> List[dict]:
+        if field in self.unique:
+            doc = self.get_by(field, value)
+            return [doc] if doc else []
+        return [self.docs[key] for key in self.indexes[field].get(value, ())]
+    
+    def all(self) -> List[dict]:
+        return list(self.docs.values())
+    
+    @staticmethod
+    def _values(doc: dict, field: str) -> list:
+        value = doc.get(field)
+        return value if isinstance(value, list) else [value]
+    
+    def _index(self, key, doc: dict):
+        for field, values in self.unique.items():
+            values[doc.get(field)] = key
+        for field, buckets in self.indexes.items():
+            for value in self._values(doc, field):
+                buckets.setdefault(value, {})[key] = None
+    
+    def _unindex(self, key, doc: dict):
+        for field, values in self.unique.items():
+            values.pop(doc.get(field), None)
+        for field, buckets in self.indexes.items():
+            for value in self._values(doc, field):
+                buckets.get(value, {}).pop(key, None)
+
+class MemoryUserRepository:
+    def __init__(self):
+        self.table = MemoryTable('userId', unique=('email',), indexes=('role',))
+    
+    async def ensure_indexes(self):
+        pass
+    
+    async def has_unique_email(self) -> bool:
+        return True
+    
+    async def get(self, user_id: str, projection: dict = PUBLIC_USER) -> Optional[dict]:
+        return project(self.table.get(user_id), projection)
+    
+    async def get_by_email(self, email: str) -> Optional[dict]:
+        return project(self.table.get_by('email', email), None)
+    
+    async def find_many(self, user_ids: List[str], projection: dict = PUBLIC_USER) -> List[dict]:
+        return [project(u, projection) for u in map(self.table.get, dict.fromkeys(user_ids)) if u]
+    
+    async def list_by_role(self, role: str, limit: int = 100, projection: dict = PUBLIC_USER) -> List[dict]:
+        return [project(u, projection) for u in self.table.find_by('role', role)[:limit]]
+    
+    async def count_by_role(self, role: str) -> int:
+        return len(self.table.find_by('role', role))
+    
+    async def active_ids(self, role: str, user_ids: Optional[List[str]] = None) -> List[str]:
+        users = self.table.find_by('role', role)
+        if user_ids is not None:
+            wanted = set(user_ids)
+            users = [u for u in users if u['userId'] in wanted]
+        return [u['userId'] for u in users if u.get('isActive')]
+    
+    async def iter_active_ids(self, roles: List[str], batch_size: int = 1000):
+        for role in roles:
+            for user_id in await self.active_ids(role):
+                yield user_id
+    
+    async def iter_all(self, batch_size: int = 500):
+        for user in self.table.all():
+            yield project(user, PUBLIC_USER)
+    
+    async def insert(self, doc: dict):
+        self.table.insert(doc)
+    
+    async def insert_many(self, docs: List[dict]) -> dict:
+        failed = {}
+        for i, doc in enumerate(docs):
+            try:
+                self.table.insert(doc)
+            except DuplicateKeyError:
+                failed[i] = 'duplicate'
+        return failed
+
+class MemoryStudentRepository:
+    def __init__(self):
+        self.table = MemoryTable('studentId', indexes=('userId', 'assignedCounselor', 'assignedAgent'))
+    
+    async def ensure_indexes(self):
+        pass
+    
+    async def get(self, student_id: str, projection: dict = NO_ID) -> Optional[dict]:
+        return project(self.table.get(student_id), projection)
+    
+    async def get_by_user(self, user_id: str, projection: dict = NO_ID) -> Optional[dict]:
+        students = self.table.find_by('userId', user_id)
+        return project(students[0], projection) if students else None
+    
+    async def find_many(self, student_ids: List[str], projection: dict = NO_ID) -> List[dict]:
+        return [project(s, projection) for s in map(self.table.get, dict.fromkeys(student_ids)) if s]
+    
+    async def find_by_users(self, user_ids: List[str], projection: dict = NO_ID) -> List[dict]:
+        return [project(s, projection) for u in dict.fromkeys(user_ids) for s in self.table.find_by('userId', u)]
+    
+    async def list(self, projection: dict = NO_ID, limit: int = 1000) -> List[dict]:
+        return [project(s, projection) for s in self.table.all()[:limit]]
+    
+    async def list_assigned(self, field: str, user_id: str, projection: dict = NO_ID, limit: int = 100) -> List[dict]:
+        return [project(s, projection) for s in self.table.find_by(field, user_id)[:limit]]
+    
+    async def list_unassigned_ids(self, limit: int, student_ids: Optional[List[str]] = None) -> List[str]:
+        students = self.table.find_by('assignedCounselor', None)
+        if student_ids is not None:
+            wanted = set(student_ids)
+            students = [s for s in students if s['studentId'] in wanted]
+        students = sorted(students, key=lambda s: s['createdAt'])
+        return [s['studentId'] for s in students[:limit]]
+    
+    async def count(self) -> int:
+        return len(self.table.docs)
+    
+    async def assignment_load(self, field: str, user_ids: List[str]) -> dict:
+        return {user_id: len(self.table.find_by(field, user_id)) for user_id in user_ids}
+    
+    async def existing_ids(self, student_ids: List[str]) -> set:
+        return {student_id for student_id in student_ids if student_id in self.table.docs}
+    
+    async def insert(self, doc: dict):
+        self.table.insert(doc)
+    
+    async def insert_many(self, docs: List[dict]):
+        for doc in docs:
+            self.table.insert(doc)
+    
+    async def update_by_user(self, user_id: str, fields: dict):
+        students = self.table.find_by('userId', user_id)
+        if students:
+            self.table.update(students[0]['studentId'], fields)
+    
+    async def assign(self, assignments: dict) -> tuple:
+        matched = [student_id for student_id in assignments if student_id in self.table.docs]
+        modified = sum(self.table.update(student_id, assignments[student_id]) for student_id in matched)
+        return len(matched), modified
+    
+    async def iter_all(self, batch_size: int = 500):
+        for student in self.table.all():
+            yield project(student, NO_ID)
+
+class MemoryApplicationRepository:
+    def __init__(self):
+        self.table = MemoryTable('applicationId', indexes=('studentId', 'status'))
+    
+    async def ensure_indexes(self):
+        pass
+    
+    async def list_for_student(self, student_id: str, projection: dict = NO_ID,
+                               limit: int = 100, newest_first: bool = False) -> List[dict]:
+        applications = self.table.find_by('studentId', student_id)
+        if newest_first:
+            applications = sorted(applications, key=lambda a: a['createdAt'], reverse=True)
+        return [project(a, projection) for a in applications[:limit]]
+    
+    async def list_for_students(self, student_ids: List[str], projection: dict = NO_ID) -> List[dict]:
+        return [
+            project(a, projection)
+            for student_id in dict.fromkeys(student_ids) for a in self.table.find_by('studentId', student_id)
+        ]
+    
+    async def counts_by_student(self, student_ids: List[str]) -> dict:
+        counts = {student_id: len(self.table.find_by('studentId', student_id)) for student_id in student_ids}
+        return {student_id: count for student_id, count in counts.items() if count}
+    
+    async def find(self, student_id: str, service_id: str) -> Optional[dict]:
+        for application in self.table.find_by('studentId', student_id):
+            if application['serviceId'] == service_id:
+                return project(application, NO_ID)
+        return None
+    
+    async def count_by_status(self, statuses: List[str]) -> int:
+        return sum(len(self.table.find_by('status', status)) for status in set(statuses))
+    
+    async def insert(self, doc: dict):
+        self.table.insert(doc)
+
+class MemoryServiceRepository:
+    def __init__(self):
+        self.table = MemoryTable('serviceId')
+    
+    async def ensure_indexes(self):
+        pass
+    
+    async def list(self, limit: int = 100) -> List[dict]:
+        return [project(s, NO_ID) for s in self.table.all()[:limit]]
+    
+    async def find_many(self, service_ids: List[str], projection: dict = NO_ID) -> List[dict]:
+        return [project(s, projection) for s in map(self.table.get, dict.fromkeys(service_ids)) if s]
+    
+    async def insert_many(self, docs: List[dict]):
+        for doc in docs:
+            self.table.insert(doc)
+
+class MemoryCommissionRepository:
+    def __init__(self):
+        self.table = MemoryTable('commissionId', indexes=('agentId',))
+    
+    async def ensure_indexes(self):
+        pass
+    
+    async def insert(self, doc: dict):
+        self.table.insert(doc)
+    
+    async def transition(self, commission_id: str, from_statuses: List[str], update: dict) -> Optional[dict]:
+        commission = self.table.get(commission_id)
+        if not commission or commission.get('status') not in from_statuses:
+            return None
+        previous = project(commission, NO_ID)
+        self.table.update(commission_id, update)
+        return previous
+    
+    async def list(self, agent_id: Optional[str] = None, created_from: Optional[datetime] = None,
+                   created_to: Optional[datetime] = None, order: str = 'desc',
+                   skip: int = 0, limit: int = 100, projection: dict = NO_ID) -> List[dict]:
+        commissions = self.table.find_by('agentId', agent_id) if agent_id else self.table.all()
+        created_from, created_to = as_utc(created_from), as_utc(created_to)
+        commissions = [
+            c for c in commissions
+            if (created_from is None or c['createdAt'] >= created_from)
+            and (created_to is None or c['createdAt'] < created_to)
+        ]
+        commissions.sort(key=lambda c: c['createdAt'], reverse=order == 'desc')
+        return [project(c, projection) for c in commissions[skip:skip + limit]]
+    
+    async def iter_all(self, projection: dict = NO_ID, batch_size: int = 1000):
+        for commission in self.table.all():
+            yield project(commission, projection)
+    
+    async def count(self) -> int:
+        return len(self.table.docs)
+
+class MemorySummaryRepository:
+    def __init__(self):
+        self.table = MemoryTable('studentId', indexes=('assignedCounselor', 'assignedAgent'))
+    
+    async def ensure_indexes(self):
+        pass
+    
+    async def is_empty(self) -> bool:
+        return not self.table.docs
+    
+    async def find_many(self, student_ids: List[str], projection: dict = NO_ID) -> List[dict]:
+        return [project(s, projection) for s in map(self.table.get, dict.fromkeys(student_ids)) if s]
+    
+    async def iter_ids(self, batch_size: int = 500):
+        for student_id in list(self.table.docs):
+            yield student_id
+    
+    def _matching(self, filters: dict) -> List[dict]:
+        """Summaries equal to filters on assignedCounselor/assignedAgent, through the first one's index."""
+        if not filters:
+            return self.table.all()
+        (field, value), *rest = filters.items()
+        return [s for s in self.table.find_by(field, value) if all(s.get(f) == v for f, v in rest)]
+    
+    async def page(self, filters: dict, created_from: Optional[datetime] = None, created_to: Optional[datetime] = None,
+                   order: str = 'desc', skip: int = 0, limit: int = 100) -> tuple:
+        created_from, created_to = as_utc(created_from), as_utc(created_to)
+        summaries = [
+            s for s in self._matching(filters)
+            if (created_from is None or s['createdAt'] >= created_from)
+            and (created_to is None or s['createdAt'] < created_to)
+        ]
+        summaries.sort(key=lambda s: s['createdAt'], reverse=order == 'desc')
+        return [project(s, NO_ID) for s in summaries[skip:skip + limit]], len(summaries)
+    
+    async def totals(self, field: str, user_id: str) -> dict:
+        summaries = self.table.find_by(field, user_id)
+        return {
+            'students': len(summaries),
+            'applications': sum(s['totalApplications'] for s in summaries),
+            'activeApplications': sum(
+                s['applicationCounts']['not_started'] + s['applicationCounts']['in_progress'] for s in summaries
+            )
+        }
+    
+    async def replace(self, summary: dict):
+        self.table.delete(summary['studentId'])
+        self.table.insert(summary)
+    
+    async def replace_many(self, summaries: List[dict]):
+        for summary in summaries:
+            await self.replace(summary)
+    
+    async def assign(self, assignments: dict):
+        for student_id, fields in assignments.items():
+            self.table.update(student_id, fields)
+    
+    async def delete(self, student_id: str):
+        self.table.delete(student_id)
+    
+    async def delete_stale(self, before: datetime):
+        for summary in self.table.all():
+            if summary.get('updatedAt', before) < before:
+                self.table.delete(summary['studentId'])
+
+class MemorySearchRepository:
+    def __init__(self):
+        self.table = MemoryTable('userId', indexes=('grams',))
+    
+    async def ensure_indexes(self):
+        pass
+    
+    async def is_empty(self) -> bool:
+        return not self.table.docs
+    
+    async def gram_counts(self, grams: List[str], limit: int) -> List[int]:
+        return [min(len(self.table.indexes['grams'].get(gram, ())), limit) for gram in grams]
+    
+    def _candidates(self, match: dict) -> List[dict]:
+        grams = match['grams']
+        if '$all' in grams:
+            wanted = set(grams['$all'])
+            entries = [e for e in self.table.find_by('grams', min(wanted)) if wanted <= set(e['grams'])]
+        else:
+            keys = dict.fromkeys(k for gram in grams['$in'] for k in self.table.indexes['grams'].get(gram, ()))
+            entries = [self.table.get(k) for k in keys]
+        if 'role' in match:
+            entries = [e for e in entries if e.get('role') == match['role']]
+        return entries[:SEARCH_MAX_CANDIDATES + 1]
+    
+    async def scored(self, match: dict, prefixes: List[str], trigrams: List[str], min_trigrams: int, top: int) -> dict:
+        """Same filter, cap and score as the Motor pipeline, computed over the gram index."""
+        candidates = self._candidates(match)
+        prefixes, trigrams = set(prefixes), set(trigrams)
+        entries = []
+        for entry in candidates[:SEARCH_MAX_CANDIDATES]:
+            grams = set(entry['grams'])
+            prefix_hits, trigram_hits = len(grams & prefixes), len(grams & trigrams)
+            if prefix_hits or trigram_hits >= min_trigrams:
+                entries.append({
+                    **project(entry, {'_id': 0, 'grams': 0, 'indexedAt': 0}),
+                    'score': prefix_hits * SEARCH_PREFIX_WEIGHT + trigram_hits
+                })
+        entries.sort(key=lambda e: (-e['score'], e.get('lastName') or '', e['userId']))
+        return {'candidates': len(candidates), 'entries': entries[:top]}
+    
+    async def explain(self, match: dict, prefixes: List[str], trigrams: List[str], min_trigrams: int, top: int) -> dict:
+        started = time.perf_counter()
+        result = await self.scored(match, prefixes, trigrams, min_trigrams, top)
+        return {
+            'keysExamined': None,
+            'docsExamined': result['candidates'],
+            'executionTimeMillis': round((time.perf_counter() - started) * 1000)
+        }
+    
+    async def replace(self, entry: dict):
+        self.table.delete(entry['userId'])
+        self.table.insert(entry)
+    
+    async def replace_many(self, entries: List[dict]):
+        for entry in entries:
+            await self.replace(entry)
+    
+    async def delete(self, user_id: str):
+        self.table.delete(user_id)
+    
+    async def delete_stale(self, before: datetime):
+        for entry in self.table.all():
+            if entry.get('indexedAt', before) < before:
+                self.table.delete(entry['userId'])
+
+class MemoryRollupRepository:
+    def __init__(self):
+        # (agentId, granularity, bucket) -> rollup
+        self.docs = {}
+    
+    async def ensure_indexes(self):
+        pass
+    
+    async def is_empty(self) -> bool:
+        return not self.docs
+    
+    async def increment(self, agent_id: str, buckets: List[tuple], increments: dict):
+        for granularity, bucket in buckets:
+            rollup = self.docs.setdefault(
+                (agent_id, granularity, bucket), {'agentId': agent_id, 'granularity': granularity, 'bucket': bucket}
+            )
+            for path, value in increments.items():
+                *parents, leaf = path.split('.')
+                target = rollup
+                for part in parents:
+                    target = target.setdefault(part, {})
+                target[leaf] = target.get(leaf, 0) + value
+    
+    async def all_time(self, agent_ids: List[str]) -> List[dict]:
+        return [
+            project(self.docs[key], {'_id': 0, 'agentId': 1, 'count': 1, 'amounts': 1})
+            for key in ((agent_id, 'all', 'all') for agent_id in dict.fromkeys(agent_ids)) if key in self.docs
+        ]
+    
+    async def buckets(self, agent_id: str, granularity: str, start: Optional[str] = None,
+                      end: Optional[str] = None) -> List[dict]:
+        rollups = sorted(
+            (r for (a, g, b), r in self.docs.items()
+             if a == agent_id and g == granularity and (not start or b >= start) and (not end or b <= end)),
+            key=lambda r: r['bucket']
+        )
+        return [project(r, {'_id': 0, 'agentId': 0, 'granularity': 0, 'rebuiltAt': 0}) for r in rollups]
+    
+    async def summary(self) -> dict:
+        summary = {'count': 0, **{s: 0 for s in COMMISSION_STATUSES}}
+        for (_, granularity, _), rollup in self.docs.items():
+            if granularity == 'all':
+                summary['count'] += rollup.get('count', 0)
+                for s in COMMISSION_STATUSES:
+                    summary[s] += rollup.get('amounts', {}).get(s, 0)
+        return summary
+    
+    async def replace_many(self, rollups: List[dict]):
+        for rollup in rollups:
+            self.docs[(rollup['agentId'], rollup['granularity'], rollup['bucket'])] = project(rollup, None)
+    
+    async def delete_stale(self, before: datetime):
+        for key, rollup in list(self.docs.items()):
+            if 'rebuiltAt' not in rollup or rollup['rebuiltAt'] < before:
+                del self.docs[key]
+
+class MemoryAuditRepository:
+    def __init__(self):
+        self.events = []
+    
+    async def ensure_indexes(self):
+        pass
+    
+    async def insert_many(self, events: List[dict]):
+        self.events.extend(project(event, None) for event in events)
+    
+    async def find(self, filters: dict, start: Optional[datetime] = None, end: Optional[datetime] = None,
+                   skip: int = 0, limit: int = 50) -> List[dict]:
+        start, end = as_utc(start), as_utc(end)
+        events = [
+            e for e in self.events
+            if all(e.get(field) == value for field, value in filters.items())
+            and (start is None or e['timestamp'] >= start) and (end is None or e['timestamp'] < end)
+        ]
+        events.sort(key=lambda e: e['timestamp'], reverse=True)
+        return [project(e, NO_ID) for e in events[skip:skip + limit]]
+
+class MemoryInboxRepository:
+    def __init__(self):
+        self.table = MemoryTable('notificationId', indexes=('recipientId',))
+        self.unread = {}
+    
+    async def ensure_indexes(self):
+        pass
+    
+    async def deliver(self, docs: List[dict]):
+        for doc in docs:
+            self.table.insert(doc)
+            self.unread[doc['recipientId']] = self.unread.get(doc['recipientId'], 0) + 1
+    
+    async def list(self, recipient_id: str, unread_only: bool = False, skip: int = 0, limit: int = 20) -> List[dict]:
+        notifications = [n for n in self.table.find_by('recipientId', recipient_id) if not unread_only or not n['isRead']]
+        notifications.sort(key=lambda n: n['createdAt'], reverse=True)
+        return [project(n, NO_ID) for n in notifications[skip:skip + limit]]
+    
+    async def unread_count(self, recipient_id: str) -> int:
+        return max(self.unread.get(recipient_id, 0), 0)
+    
+    async def mark_all_read(self, recipient_id: str) -> int:
+        marked = sum(
+            self.table.update(n['notificationId'], {'isRead': True})
+            for n in self.table.find_by('recipientId', recipient_id)
+        )
+        self.unread[recipient_id] = self.unread.get(recipient_id, 0) - marked
+        return marked
+    
+    async def mark_read(self, recipient_id: str, notification_id: str) -> bool:
+        notification = self.table.get(notification_id)
+        if not notification or notification['recipientId'] != recipient_id \
+                or not self.table.update(notification_id, {'isRead': True}):
+            return False
+        self.unread[recipient_id] -= 1
+        return True
+
+class Repositories:
+    def __init__(self, users, students, applications, services, commissions,
+                 summaries, search, rollups, audit, inbox):
+        self.users = users
+        self.students = students
+        self.applications = applications
+        self.services = services
+        self.commissions = commissions
+        self.summaries = summaries
+        self.search = search
+        self.rollups = rollups
+        self.audit = audit
+        self.inbox = inbox
+    
+    @classmethod
+    def motor(cls, database) -> 'Repositories':
+        return cls(
+            MotorUserRepository(database.users),
+            MotorStudentRepository(database.students),
+            MotorApplicationRepository(database.service_applications),
+            MotorServiceRepository(database.services),
+            MotorCommissionRepository(database.commissions),
+            MotorSummaryRepository(database.student_summaries),
+            MotorSearchRepository(database.search_index),
+            MotorRollupRepository(database.commission_rollups),
+            MotorAuditRepository(database),
+            MotorInboxRepository(database)
+        )
+    
+    @classmethod
+    def memory(cls) -> 'Repositories':
+        return cls(
+            MemoryUserRepository(),
+            MemoryStudentRepository(),
+            MemoryApplicationRepository(),
+            MemoryServiceRepository(),
+            MemoryCommissionRepository(),
+            MemorySummaryRepository(),
+            MemorySearchRepository(),
+            MemoryRollupRepository(),
+            MemoryAuditRepository(),
+            MemoryInboxRepository()
+        )
+    
+    async def ensure_indexes(self):
+        for repository in (self.users, self.students, self.applications, self.services, self.commissions,
+                           self.summaries, self.search, self.rollups, self.audit, self.inbox):
+            await repository.ensure_indexes()
+
+# Used by startup, background workers and maintenance commands; handlers get it
+# through get_repositories so tests can override it
+repositories = Repositories.motor(db)
+
+def get_repositories() -> Repositories:
+    return repositories
+
+# ============== REQUEST DEADLINES ==============
+# The middleware starts each request's clock and runs the handler inside
+# pymongo.timeout(), which Motor carries into its worker threads, so every
+# query is sent with maxTimeMS set to whatever is left of the budget. A handler
+# that overruns is cancelled and answered with 504; a client that disconnects
+# has its handler cancelled straight away. Dashboards can opt into partial
+# results: parts that would miss the deadline come back as null instead.
+# Only reads are cut short. A write cancelled between two of its database
+# calls (signup creates the user and then the student) would be left half
+# done, so writes are never cancelled and an overrun is only logged; their
+# MongoDB calls still run inside pymongo.timeout() with the longer of the
+# route budget and WRITE_BUDGET_SECONDS, so a stuck query cannot hold a pooled
+# connection indefinitely. Imports bound the database work of each batch.
+
+# Longest matching path prefix wins; None means no deadline (maintenance jobs)
+ROUTE_BUDGETS = {
+    '/api/auth/': AUTH_BUDGET_SECONDS,
+    '/api/bootstrap': DASHBOARD_BUDGET_SECONDS,
+    '/api/admin/metrics': DASHBOARD_BUDGET_SECONDS,
+    '/api/counselors/dashboard': DASHBOARD_BUDGET_SECONDS,
+    '/api/agents/dashboard': DASHBOARD_BUDGET_SECONDS,
+    '/api/admin/users/import': None,
+    '/api/admin/search/rebuild': None,
+    '/api/admin/student-summaries/': None,
+    '/api/admin/commissions/rollups/backfill': None,
+}
+
+SAFE_METHODS = {'GET', 'HEAD', 'OPTIONS'}
+
+request_deadline: ContextVar[Optional[float]] = ContextVar('request_deadline', default=None)
+deadline_stats = {'timedOut': 0, 'disconnected': 0, 'writesOverran': 0}
+
+def route_budget(path: str) -> Optional[float]:
+    matches = [prefix for prefix in ROUTE_BUDGETS if path.startswith(prefix)]
+    if not matches:
+        return REQUEST_BUDGET_SECONDS
+    return ROUTE_BUDGETS[max(matches, key=len)]
+
+def remaining_budget() -> Optional[float]:
+    deadline = request_deadline.get()
+    return None if deadline is None else deadline - time.monotonic()
+
+def spawn_detached(coro) -> asyncio.Task:
+    # A task copies its creator's context; one started from a handler would
+    # otherwise inherit the request's deadline and pymongo.timeout() scope
+    return Context().run(asyncio.create_task, coro)
+
+class DeadlineMiddleware:
+    def __init__(self, app):
+        self.app = app
+    
+    async def __call__(self, scope, receive, send):
+        budget = route_budget(scope['path']) if scope['type'] == 'http' else None
+        if budget is None:
+            await self.app(scope, receive, send)
+            return
+        if scope['method'] not in SAFE_METHODS:
+            started = time.monotonic()
+            with db_timeout(max(budget, WRITE_BUDGET_SECONDS)):
+                await self.app(scope, receive, send)
+            if time.monotonic() - started > budget:
+                deadline_stats['writesOverran'] += 1
+                logger.warning(f"{scope['method']} {scope['path']} exceeded its {budget}s budget")
+            return
+        
+        # Read the client's messages ourselves so a disconnect is seen even
+        # while the handler is busy awaiting the database
+        messages = asyncio.Queue()
+        disconnected = asyncio.Event()
+        response_started = False
+        
+        async def listen():
+            while True:
+                message = await receive()
+                await messages.put(message)
+                if message['type'] == 'http.disconnect':
+                    disconnected.set()
+                    return
+        
+        async def send_tracked(message):
+            nonlocal response_started
+            response_started = True
+            await send(message)
+        
+        token = request_deadline.set(time.monotonic() + budget)
+        with db_timeout(budget):
+            handler = asyncio.create_task(self.app(scope, messages.get, send_tracked))
+        request_deadline.reset(token)
+        listener = asyncio.create_task(listen())
+        watcher = asyncio.create_task(disconnected.wait())
+        try:
+            done, _ = await asyncio.wait(
+                {handler, watcher}, timeout=budget, return_when=asyncio.FIRST_COMPLETED
+            )
+            if handler in done:
+                handler.result()
+                return
+            
+            handler.cancel()
+            await asyncio.gather(handler, return_exceptions=True)
+            if watcher in done:
+                deadline_stats['disconnected'] += 1
+                logger.info(f"Client disconnected, cancelled {scope['method']} {scope['path']}")
+                return
+            
+            deadline_stats['timedOut'] += 1
+            logger.warning(f"{scope['method']} {scope['path']} exceeded its {budget}s budget")
+            if not response_started:
+                response = JSONResponse({'detail': 'Request timed out'}, status_code=504)
+                await response(scope, messages.get, send)
+        finally:
+            listener.cancel()
+            watcher.cancel()
+
+async def gather_parts(parts: dict, allow_partial: bool = False) -> dict:
+    """Await named coroutines concurrently and return their results by name.
+    
+    With allow_partial, each part gets what is left of the request budget (less
+    a reserve for responding); parts that run out come back as None and are
+    named in 'missing' rather than failing the whole request.
+    """
+    remaining = remaining_budget()
+    if not allow_partial or remaining is None:
+        return dict(zip(parts, await asyncio.gather(*parts.values())))
+    
+    limit = max(remaining - PARTIAL_RESERVE_SECONDS, 0)
+    
+    async def run(coro):
+        with db_timeout(limit):
+            return await asyncio.wait_for(coro, limit)
+    
+    outcomes = await asyncio.gather(*(run(coro) for coro in parts.values()), return_exceptions=True)
+    results, missing = {}, []
+    for name, outcome in zip(parts, outcomes):
+        if isinstance(outcome, (asyncio.TimeoutError, ExecutionTimeout, NetworkTimeout)):
+            results[name] = None
+            missing.append(name)
+        elif isinstance(outcome, BaseException):
+            raise outcome
+        else:
+            results[name] = outcome
+    results['missing'] = missing
+    return results
+
+# ============== STALE CACHE ==============
+# Read endpoints keep their last good response per key. While the breaker is
+# closed they are served fresh (the service catalog is reused for
+# SERVICE_CATALOG_FRESH_SECONDS) and a database failure falls back to the last
+# good response. While the breaker is open the cached response is served
+# straight away with Warning and Age headers, and the trial call the breaker
+# allows is spent revalidating it in the background. Writes fail fast with 503.
+
+DATABASE_ERRORS = (ConnectionFailure, ExecutionTimeout)
+
+class StaleCache:
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.revalidating = {}
+        self.served_stale = 0
+    
+    async def read(self, key, loader, response: Optional[Response] = None, fresh_for: float = 0):
+        """Return loader()'s result, or the last good one for key if the database is unavailable."""
+        entry = self.entries.get(key)
+        if entry is not None:
+            if time.time() - entry[1] < fresh_for:
+                return entry[0]
+            if db_breaker.state != 'closed':
+                if db_breaker.allow():
+                    self._revalidate(key, loader)
+                return self._serve_stale(key, entry, response)
+        elif not db_breaker.allow():
+            raise HTTPException(
+                status_code=503, detail="Database unavailable",
+                headers={'Retry-After': str(db_breaker.retry_after())}
+            )
+        
+        try:
+            value = await loader()
+        except DATABASE_ERRORS as e:
+            db_breaker.record_exception(e)
+            if entry is None:
+                raise
+            return self._serve_stale(key, entry, response)
+        self._store(key, value)
+        return value
+    
+    def _store(self, key, value):
+        self.entries[key] = (value, time.time())
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+    
+    def _serve_stale(self, key, entry, response: Optional[Response]):
+        self.served_stale += 1
+        self.entries.move_to_end(key)
+        if response is not None:
+            response.headers['Warning'] = '110 - "Response is Stale"'
+            response.headers['Age'] = str(int(time.time() - entry[1]))
+        return entry[0]
+    
+    def _revalidate(self, key, loader):
+        async def reload():
+            try:
+                self._store(key, await loader())
+            except DATABASE_ERRORS as e:
+                db_breaker.record_exception(e)
+            except Exception as e:
+                logger.warning(f"Revalidating {key} failed: {e}")
+            finally:
+                self.revalidating.pop(key, None)
+        if key not in self.revalidating:
+            self.revalidating[key] = spawn_detached(reload())
+    
+    def stats(self) -> dict:
+        return {'entries': len(self.entries), 'servedStale': self.served_stale}
+
+stale_cache = StaleCache(STALE_CACHE_MAX_ENTRIES)
+
+class FailFastMiddleware:
+    """Rejects writes while the breaker is open instead of queueing them on a failing database."""
+    
+    def __init__(self, app):
+        self.app = app
+    
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'http' and scope['method'] not in SAFE_METHODS and not db_breaker.allow():
+            response = JSONResponse(
+                {'detail': 'Database unavailable'}, status_code=503,
+                headers={'Retry-After': str(db_breaker.retry_after())}
+            )
+            await response(scope, receive, send)
+            return
+        await self.app(scope, receive, send)
+
+# ============== PROFILING ==============
+# A super_admin can profile one request by sending `X-Profile: 1` (or
+# `?profile=1`), optionally with `X-Profile-Hz`/`profileHz` (sampler frequency),
+# `X-Profile-Rate`/`profileRate` (fraction of flagged requests to profile, so a
+# client can leave the flag on a polled dashboard), `X-Profile-Format`/
+# `profileFormat` (speedscope or collapsed) and `X-Profile-Output`/`profileOutput`
+# (file or inline). While the request runs a sampler thread records, for every
+# task the request spawned, either the event loop's stack (the task is running)
+# or its coroutine chain (the task is waiting on Motor or bcrypt). Samples are
+# attributed to handler code, validation, serialization, bcrypt or Motor.
+# Requests without the flag only pay for a header scan.
+
+BCRYPT_FUNCTIONS = {'hash_password', 'hash_password_async', 'verify_password'}
+
+profiled_request: ContextVar[Optional['RequestProfile']] = ContextVar('profiled_request', default=None)
+
+def profile_category(frames: list) -> str:
+    """Attribute a sampled stack (root first) by its innermost recognisable frame."""
+    for frame in reversed(frames):
+        code = frame.f_code
+        if code.co_name in BCRYPT_FUNCTIONS and code.co_filename == __file__:
+            return 'bcrypt'
+        if '/pydantic' in code.co_filename or code.co_filename.endswith('fastapi/_compat.py'):
+            return 'validation'
+        if code.co_filename.endswith(('fastapi/encoders.py', 'starlette/responses.py')) or '/json/' in code.co_filename:
+            return 'serialization'
+        if code.co_name == 'serialize_response':
+            return 'serialization'
+        if code.co_filename == __file__:
+            return 'handler'
+        if code.co_name in ('request_params_to_args', 'request_body_to_args'):
+            return 'validation'
+    return 'framework'
+
+class RequestProfile:
+    def __init__(self, name: str, hz: int):
+        self.name = name
+        self.interval = 1 / hz
+        self.loop_thread = threading.get_ident()
+        self.tasks = []
+        self.frames = {}
+        self.stacks = {}
+        self.categories = {}
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='request-profiler', daemon=True)
+    
+    def start(self):
+        self._thread.start()
+    
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self.tasks = []
+    
+    def _run(self):
+        last = time.perf_counter()
+        while not self._stop.wait(self.interval):
+            now = time.perf_counter()
+            self.sample((now - last) * 1000)
+            last = now
+    
+    def sample(self, elapsed_ms: float):
+        live = [(task, parent) for task, parent in self.tasks[:] if not task.done()]
+        # A task waiting on its own children (gather, awaiting a task) is not sampled itself
+        parents = {parent for _, parent in live}
+        for task, _ in live:
+            coro = task.get_coro()
+            if getattr(coro, 'cr_running', False):
+                frames = self._running_stack(coro.cr_frame)
+                self._add(frames, None, profile_category(frames), elapsed_ms)
+                continue
+            if task in parents:
+                continue
+            frames, awaiting = self._awaiting_stack(coro)
+            if awaiting:
+                self._add(frames, f'[await {awaiting}]', awaiting, elapsed_ms)
+    
+    def _running_stack(self, root) -> list:
+        frames = []
+        frame = sys._current_frames().get(self.loop_thread)
+        while frame is not None:
+            frames.append(frame)
+            if frame is root:
+                break
+            frame = frame.f_back
+        return frames[::-1]
+    
+    def _awaiting_stack(self, coro):
+        # Follow cr_await down to what the task is suspended on; Motor and the
+        # hash executor both hand back bare futures awaited from our own code
+        frames = []
+        while coro is not None:
+            frame = getattr(coro, 'cr_frame', None) or getattr(coro, 'gi_frame', None)
+            if frame is None:
+                break
+            frames.append(frame)
+            coro = getattr(coro, 'cr_await', None) or getattr(coro, 'gi_yieldfrom', None)
+        if not frames or coro is None:
+            return frames, None
+        innermost = frames[-1].f_code
+        if innermost.co_name in BCRYPT_FUNCTIONS:
+            return frames, 'bcrypt'
+        if innermost.co_filename == __file__ or '/motor/' in innermost.co_filename:
+            return frames, 'motor'
+        # Queues, events, sleeps and gathers: the time shows up in the tasks they wait for
+        return frames, None
+    
+    def _add(self, frames: list, leaf: Optional[str], category: str, elapsed_ms: float):
+        # co_qualname is new in Python 3.11
+        keys = [
+            (getattr(f.f_code, 'co_qualname', f.f_code.co_name), f.f_code.co_filename, f.f_code.co_firstlineno)
+            for f in frames
+        ]
+        if leaf:
+            keys.append((leaf, '', 0))
+        stack = tuple(self.frames.setdefault(key, len(self.frames)) for key in keys)
+        count, weight = self.stacks.get(stack, (0, 0.0))
+        self.stacks[stack] = (count + 1, weight + elapsed_ms)
+        self.categories[category] = self.categories.get(category, 0.0) + elapsed_ms
+    
+    def summary(self) -> dict:
+        return {category: round(ms, 1) for category, ms in self.categories.items()}
+    
+    def speedscope(self) -> dict:
+        weights = [round(weight, 3) for _, weight in self.stacks.values()]
+        return {
+            '$schema': 'https://www.speedscope.app/file-format-schema.json',
+            'name': self.name,
+            'exporter': 'fly8-api',
+            'activeProfileIndex': 0,
+            'shared': {'frames': [{'name': name, 'file': file, 'line': line} for name, file, line in self.frames]},
+            'profiles': [{
+                'type': 'sampled',
+                'name': self.name,
+                'unit': 'milliseconds',
+                'startValue': 0,
+                'endValue': round(sum(weights), 3),
+                'samples': [list(stack) for stack in self.stacks],
+                'weights': weights
+            }]
+        }
+    
+    def collapsed(self) -> str:
+        # Brendan Gregg's folded format, for flamegraph.pl and friends
+        names = [name for name, _, _ in self.frames]
+        return ''.join(
+            ';'.join(names[i] for i in stack) + f' {count}\n'
+            for stack, (count, _) in self.stacks.items()
+        )
+
+# The task factory is only installed while at least one profile is running
+profiling_state = {'active': 0, 'previous': None}
+
+def profiling_task_factory(loop, coro, **kwargs):
+    previous = profiling_state['previous']
+    task = previous(loop, coro, **kwargs) if previous else asyncio.Task(coro, loop=loop, **kwargs)
+    context = kwargs.get('context')
+    profile = context.get(profiled_request) if context is not None else profiled_request.get()
+    if profile is not None:
+        profile.tasks.append((task, asyncio.current_task(loop)))
+    return task
+
+def profile_options(scope) -> Optional[dict]:
+    headers = {
+        name.decode('latin-1'): value.decode('latin-1')
+        for name, value in scope['headers'] if name.startswith(b'x-profile') or name == b'authorization'
+    }
+    query = parse_qs(scope['query_string'].decode('latin-1')) if b'profile' in scope['query_string'] else {}
+    
+    def option(header, param, default=None):
+        return headers.get(header) or query.get(param, [default])[0]
+    
+    if option('x-profile', 'profile', '0').lower() not in ('1', 'true', 'yes'):
+        return None
+    try:
+        payload = decode_token(headers.get('authorization', '').removeprefix('Bearer '))
+    except HTTPException:
+        return None
+    if payload.get('role') != 'super_admin' or payload.get('type') == 'refresh' or payload.get('sid') in revoked_sessions:
+        return None
+    
+    try:
+        rate = min(max(float(option('x-profile-rate', 'profileRate', PROFILE_REQUEST_RATE)), 0.0), 1.0)
+    except ValueError:
+        rate = PROFILE_REQUEST_RATE
+    if random.random() >= rate:
+        return None
+    try:
+        hz = min(max(int(option('x-profile-hz', 'profileHz', PROFILE_SAMPLE_HZ)), 10), 5000)
+    except ValueError:
+        hz = PROFILE_SAMPLE_HZ
+    return {
+        'hz': hz,
+        'format': 'collapsed' if option('x-profile-format', 'profileFormat') == 'collapsed' else 'speedscope',
+        'output': option('x-profile-output', 'profileOutput', 'file' if PROFILE_DIR else 'inline')
+    }
+
+class ProfilingMiddleware:
+    def __init__(self, app):
+        self.app = app
+    
+    async def __call__(self, scope, receive, send):
+        options = profile_options(scope) if scope['type'] == 'http' else None
+        if options is None:
+            await self.app(scope, receive, send)
+            return
+        
+        profile = RequestProfile(f"{scope['method']} {scope['path']}", options['hz'])
+        inline = options['output'] != 'file' or not PROFILE_DIR
+        extension = 'speedscope.json' if options['format'] == 'speedscope' else 'collapsed.txt'
+        filename = f"{datetime.now(timezone.utc):%Y%m%dT%H%M%S}-{scope['path'].strip('/').replace('/', '-')}-{uuid.uuid4().hex[:8]}.{extension}"
+        status = {}
+        
+        async def send_profiled(message):
+            if message['type'] == 'http.response.start':
+                status['code'] = message['status']
+                if not inline:
+                    message = {**message, 'headers': [*message.get('headers', []), (b'x-profile-file', filename.encode())]}
+            if not inline:
+                await send(message)
+        
+        loop = asyncio.get_running_loop()
+        if not profiling_state['active']:
+            profiling_state['previous'] = loop.get_task_factory()
+            loop.set_task_factory(profiling_task_factory)
+        profiling_state['active'] += 1
+        token = profiled_request.set(profile)
+        handler = asyncio.create_task(self.app(scope, receive, send_profiled))
+        profiled_request.reset(token)
+        profile.start()
+        try:
+            await handler
+        finally:
+            profile.stop()
+            profiling_state['active'] -= 1
+            if not profiling_state['active']:
+                loop.set_task_factory(profiling_state['previous'])
+        
+        body = profile.speedscope() if options['format'] == 'speedscope' else profile.collapsed()
+        summary = '; '.join(f'{category}={ms}ms' for category, ms in profile.summary().items())
+        logger.info(f"Profiled {profile.name}: {summary}")
+        if not inline:
+            path = Path(PROFILE_DIR) / filename
+            await asyncio.to_thread(path.write_text, json.dumps(body) if isinstance(body, dict) else body)
+            return
+        
+        headers = {'X-Profile-Status': str(status.get('code', 500)), 'X-Profile-Summary': summary}
+        if isinstance(body, dict):
+            response = JSONResponse(body, headers=headers)
+        else:
+            response = PlainTextResponse(body, headers=headers)
+        await response(scope, receive, send)
+
+# ============== WRITE-BEHIND BUFFER ==============
+# Fire-and-forget updates are coalesced per (collection, filter) in memory and
+# flushed with one unordered bulk_write per collection, periodically, when the
+# buffer fills up, and on shutdown. Only for writes that may be lost on a crash.
+
+class WriteBehindBuffer:
+    def __init__(self, interval: float, max_pending: int):
+        self.interval = interval
+        self.max_pending = max_pending
+        self.pending = {}
+        self.flushed = 0
+        self.dropped = 0
+        self._flush_lock = asyncio.Lock()
+    
+    def defer(self, collection: str, filter: dict, update: dict):
+        """Queue an update; supports $set (last wins), $inc (summed) and $max."""
+        key = (collection, tuple(sorted(filter.items())))
+        merged = self.pending.setdefault(key, {})
+        for op, fields in update.items():
+            target = merged.setdefault(op, {})
+            for field, value in fields.items():
+                if op == '$inc':
+                    target[field] = target.get(field, 0) + value
+                elif op == '$max' and field in target:
+                    target[field] = max(target[field], value)
+                elif op in ('$set', '$max'):
+                    target[field] = value
+                else:
+                    raise ValueError(f"Unsupported write-behind operator {op}")
+        if len(self.pending) >= self.max_pending:
+            spawn_detached(self.flush())
+    
+    async def flush(self):
+        async with self._flush_lock:
+            pending, self.pending = self.pending, {}
+            by_collection = {}
+            for (collection, filter_items), update in pending.items():
+                by_collection.setdefault(collection, []).append(UpdateOne(dict(filter_items), update))
+            for collection, operations in by_collection.items():
+                try:
+                    await db[collection].bulk_write(operations, ordered=False)
+                    self.flushed += len(operations)
+                except Exception as e:
+                    self.dropped += len(operations)
+                    logger.warning(f"Write-behind flush to {collection} failed, dropped {len(operations)} updates: {e}")
+    
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.flush()
+    
+    def stats(self) -> dict:
+        return {'pending': len(self.pending), 'flushed': self.flushed, 'dropped': self.dropped}
+
+write_behind = WriteBehindBuffer(WRITE_BEHIND_INTERVAL, WRITE_BEHIND_MAX_PENDING)
+
+# ============== AUDIT LOG ==============
+# Events are queued in memory and written by one background task with
+# insert_many, so auditing adds no database write to the request path. Each
+# event goes to the audit repository of the handler's bundle. When the queue is
+# full events are dropped (and counted) or, with the 'block' policy, the request
+# waits for room.
+
+class AuditLogger:
+    def __init__(self, max_size: int, batch_size: int, flush_seconds: float, policy: str):
+        self.queue = asyncio.Queue(maxsize=max_size)
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self.policy = policy
+        self.written = 0
+        self.dropped = 0
+    
+    async def log(self, user_id: str, action: str, resource_type: Optional[str] = None,
+                  resource_id: Optional[str] = None, details: Optional[dict] = None,
+                  request: Optional[Request] = None, repos: Optional[Repositories] = None):
+        event = {
+            'logId': str(uuid.uuid4()),
+            'userId': user_id,
+            'action': action,
+            'resourceType': resource_type,
+            'resourceId': resource_id,
+            'details': details,
+            'ipAddress': request.client.host if request and request.client else None,
+            'userAgent': request.headers.get('user-agent') if request else None,
+            'timestamp': datetime.now(timezone.utc)
+        }
+        item = ((repos or repositories).audit, event)
+        if self.policy == 'block':
+            await self.queue.put(item)
+            return
+        try:
+            self.queue.put_nowait(item)
+        except asyncio.QueueFull:
+            self.dropped += 1
+    
+    async def _write(self, batch: List[tuple]):
+        """Write (audit repository, event) pairs with one insert_many per repository."""
+        by_sink = {}
+        for sink, event in batch:
+            by_sink.setdefault(sink, []).append(event)
+        for sink, events in by_sink.items():
+            try:
+                await sink.insert_many(events)
+                self.written += len(events)
+            except Exception as e:
+                self.dropped += len(events)
+                logger.warning(f"Audit log write failed, dropped {len(events)} events: {e}")
+    
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        batch = []
+        try:
+            while True:
+                batch.append(await self.queue.get())
+                deadline = loop.time() + self.flush_seconds
+                while len(batch) < self.batch_size:
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                    except asyncio.TimeoutError:
+                        break
+                # Hand the batch over before awaiting, so a cancel during the write can't write it twice
+                batch, pending = [], batch
+                await self._write(pending)
+        except asyncio.CancelledError:
+            if batch:
+                await self._write(batch)
+            raise
+    
+    async def drain(self):
+        batch = []
+        while not self.queue.empty():
+            batch.append(self.queue.get_nowait())
+            if len(batch) >= self.batch_size:
+                await self._write(batch)
+                batch = []
+        if batch:
+            await self._write(batch)
+    
+    def stats(self) -> dict:
+        return {'queued': self.queue.qsize(), 'written': self.written, 'dropped': self.dropped}
+
+audit_log = AuditLogger(AUDIT_QUEUE_SIZE, AUDIT_BATCH_SIZE, AUDIT_FLUSH_SECONDS, AUDIT_OVERFLOW_POLICY)
+
+# ============== NOTIFICATIONS ==============
+# Write handlers publish events naming their audience (students, whose user,
+# counselor and agent are looked up, explicit users, whole roles, admins). A
+# background worker resolves recipients in batches through the publishing
+# handler's repositories and hands one inbox document per recipient to the same
+# bundle's inbox, which inserts them and bumps per-user unread counters.
+
+class NotificationEngine:
+    def __init__(self, max_size: int, batch_size: int):
+        self.queue = asyncio.Queue(maxsize=max_size)
+        self.batch_size = batch_size
+        self.delivered = 0
+        self.failed = 0
+    
+    async def publish(self, type: str, title: str, message: str, metadata: Optional[dict] = None,
+                      student_ids: Optional[List[str]] = None, user_ids: Optional[List[str]] = None,
+                      roles: Optional[List[str]] = None, admins: bool = False, exclude: Optional[str] = None,
+                      student_metadata: Optional[dict] = None, repos: Optional[Repositories] = None):
+        """Queue one event; with student_metadata ({studentId: metadata}) the users linked to each
+        student get one notification per student, carrying that student's metadata. Recipients
+        are looked up in repos, the caller's injected bundle (the global one by default)."""
+        # Waiting for room applies backpressure rather than losing notifications
+        await self.queue.put({
+            'type': type,
+            'title': title,
+            'message': message,
+            'metadata': metadata or {},
+            'studentMetadata': student_metadata or {},
+            'studentIds': student_ids or [],
+            'userIds': user_ids or [],
+            'roles': (roles or []) + (['super_admin'] if admins else []),
+            'exclude': exclude,
+            'repos': repos or repositories
+        })
+    
+    async def _recipients(self, event: dict):
+        """Yield batches of distinct (recipient user id, student id) pairs.
+        
+        The student id is None unless the event carries per-student metadata.
+        """
+        repos = event['repos']
+        per_student = bool(event['studentMetadata'])
+        seen = set()
+        
+        def fresh(pairs):
+            new = [p for p in pairs if p[0] and p[0] != event['exclude'] and p not in seen]
+            seen.update(new)
+            return new
+        
+        for i in range(0, len(event['userIds']), self.batch_size):
+            batch = fresh((user_id, None) for user_id in event['userIds'][i:i + self.batch_size])
+            if batch:
+                yield batch
+        
+        for i in range(0, len(event['studentIds']), self.batch_size):
+            pairs = []
+            for student in await repos.students.find_many(
+                event['studentIds'][i:i + self.batch_size],
+                {'_id': 0, 'studentId': 1, 'userId': 1, 'assignedCounselor': 1, 'assignedAgent': 1}
+            ):
+                key = student['studentId'] if per_student else None
+                pairs.extend(
+                    (user_id, key)
+                    for user_id in (student.get('userId'), student.get('assignedCounselor'), student.get('assignedAgent'))
+                )
+            batch = fresh(pairs)
+            if batch:
+                yield batch
+        
+        if event['roles']:
+            batch = []
+            async for user_id in repos.users.iter_active_ids(event['roles'], self.batch_size):
+                batch.append((user_id, None))
+                if len(batch) >= self.batch_size:
+                    yield fresh(batch)
+                    batch = []
+            if batch:
+                yield fresh(batch)
+    
+    def _metadata(self, event: dict, student_id: Optional[str]) -> dict:
+        if student_id is None:
+            return event['metadata']
+        return {**event['metadata'], 'studentId': student_id, **event['studentMetadata'].get(student_id, {})}
+    
+    async def _deliver(self, event: dict):
+        created_at = datetime.now(timezone.utc)
+        async for recipients in self._recipients(event):
+            if not recipients:
+                continue
+            await event['repos'].inbox.deliver([
+                {
+                    'notificationId': str(uuid.uuid4()),
+                    'recipientId': recipient_id,
+                    'type': event['type'],
+                    'title': event['title'],
+                    'message': event['message'],
+                    'isRead': False,
+                    'metadata': self._metadata(event, student_id),
+                    'createdAt': created_at
+                }
+                for recipient_id, student_id in recipients
+            ])
+            self.delivered += len(recipients)
+    
+    async def _process(self, event: dict):
+        try:
+            await self._deliver(event)
+        except Exception as e:
+            self.failed += 1
+            logger.warning(f"Notification fan-out for {event['type']} failed: {e}")
+    
+    async def run(self):
+        while True:
+            event = await self.queue.get()
+            await self._process(event)
+    
+    async def drain(self):
+        while not self.queue.empty():
+            await self._process(self.queue.get_nowait())
+    
+    def stats(self) -> dict:
+        return {'queued': self.queue.qsize(), 'delivered': self.delivered, 'failed': self.failed}
+
+notifications = NotificationEngine(NOTIFICATION_QUEUE_SIZE, NOTIFICATION_BATCH_SIZE)
+
+# ============== SESSIONS ==============
+# In 'claims' mode the access token carries the profile and onboarding flag, so
+# authenticated requests need no database read. Sessions are ended through an
+# in-memory revocation list that each worker syncs from revoked_sessions.
+
+SESSION_CLAIMS = ['userId', 'email', 'firstName', 'lastName', 'role', 'phone', 'country', 'isActive']
+
+# sessionId -> unix time after which every access token of the session has expired
+revoked_sessions = {}
+
+def create_access_token(user: dict, onboarding_completed: bool, session_id: str) -> str:
+    now = datetime.now(timezone.utc)
+    payload = {
+        **{k: user.get(k) for k in SESSION_CLAIMS},
+        'onboardingCompleted': onboarding_completed,
+        'type': 'access',
+        'sid': session_id,
+        'iat': now,
+        'exp': now + ACCESS_TOKEN_TTL
+    }
+    return jwt.encode(payload, JWT_SECRET, algorithm=JWT_ALGORITHM)
+
+async def create_session(user: dict, onboarding_completed: bool, session_id: Optional[str] = None) -> dict:
+    """Issue an access token and a single-use refresh token for a (new or continuing) session."""
+    session_id = session_id or str(uuid.uuid4())
+    jti = str(uuid.uuid4())
+    expires_at = datetime.now(timezone.utc) + REFRESH_TOKEN_TTL
+    await db.refresh_tokens.insert_one({
+        'jti': jti,
+        'sessionId': session_id,
+        'userId': user['userId'],
+        'usedAt': None,
+        'expiresAt': expires_at
+    })
+    refresh_token = jwt.encode({
+        'userId': user['userId'],
+        'type': 'refresh',
+        'sid': session_id,
+        'jti': jti,
+        'exp': expires_at
+    }, JWT_SECRET, algorithm=JWT_ALGORITHM)
+    
+    return {
+        'token': create_access_token(user, onboarding_completed, session_id),
+        'refreshToken': refresh_token
+    }
+
+async def issue_tokens(repos: Repositories, user: dict, onboarding_completed: Optional[bool] = None) -> dict:
+    if AUTH_SESSION_MODE != 'claims':
+        return {'token': create_token(user['userId'], user['role'])}
+    if onboarding_completed is None:
+        onboarding_completed = await get_onboarding_status(repos, user)
+    return await create_session(user, onboarding_completed)
+
+async def revoke_session(session_id: str):
+    # Access tokens of the session stay valid for at most ACCESS_TOKEN_TTL
+    expires_at = datetime.now(timezone.utc) + ACCESS_TOKEN_TTL
+    revoked_sessions[session_id] = expires_at.timestamp()
+    await db.revoked_sessions.update_one(
+        {'sessionId': session_id},
+        {'$set': {'sessionId': session_id, 'expiresAt': expires_at}},
+        upsert=True
+    )
+    await db.refresh_tokens.delete_many({'sessionId': session_id})
+
+async def sync_revoked_sessions():
+    now = datetime.now(timezone.utc)
+    revoked = await db.revoked_sessions.find(
+        {'expiresAt': {'$gt': now}}, {'_id': 0, 'sessionId': 1, 'expiresAt': 1}
+    ).to_list(None)
+    current = {r['sessionId']: _as_datetime(r['expiresAt']).timestamp() for r in revoked}
+    # Keep local revocations that may not have replicated yet
+    current.update({sid: exp for sid, exp in revoked_sessions.items() if exp > now.timestamp()})
+    revoked_sessions.clear()
+    revoked_sessions.update(current)
+
+async def revocation_sync_loop():
+    while True:
+        await asyncio.sleep(REVOCATION_SYNC_SECONDS)
+        try:
+            await sync_revoked_sessions()
+        except Exception as e:
+            logger.warning(f"Revocation list sync failed: {e}")
+
+def decode_token(token: str) -> dict:
+    try:
+        return jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
+    except jwt.ExpiredSignatureError:
+        raise HTTPException(status_code=401, detail="Token expired")
+    except jwt.InvalidTokenError:
+        raise HTTPException(status_code=401, detail="Invalid token")
+
+def record_activity(user_id: str):
+    write_behind.defer('users', {'userId': user_id}, {
+        '$max': {'lastActiveAt': datetime.now(timezone.utc)}
+    })
+
+async def get_current_user(
+    credentials: HTTPAuthorizationCredentials = Depends(security),
+    repos: Repositories = Depends(get_repositories)
+):
+    payload = decode_token(credentials.credentials)
+    record_activity(payload['userId'])
+    
+    if payload.get('type') == 'access':
+        if payload['sid'] in revoked_sessions:
+            raise HTTPException(status_code=401, detail="Session revoked")
+        return {
+            **{k: payload.get(k) for k in SESSION_CLAIMS},
+            'onboardingCompleted': payload.get('onboardingCompleted', True),
+            'sessionId': payload['sid']
+        }
+    if payload.get('type') == 'refresh':
+        raise HTTPException(status_code=401, detail="Invalid token")
+    
+    user = await stale_cache.read(
+        ('user', payload['userId']),
+        lambda: repos.users.get(payload['userId'])
+    )
+    if not user:
+        raise HTTPException(status_code=401, detail="User not found")
+    return user
+
+def student_onboarding_status(student: Optional[dict]) -> bool:
+    return student.get('onboardingCompleted', False) if student else True
+
+async def get_onboarding_status(repos: Repositories, user: dict) -> bool:
+    if user['role'] != 'student':
+        return True
+    student = await repos.students.get_by_user(user['userId'], {'_id': 0, 'onboardingCompleted': 1})
+    return student_onboarding_status(student)
+
+def require_role(allowed_roles: List[str]):
+    async def role_checker(user: dict = Depends(get_current_user)):
+        if user['role'] not in allowed_roles:
+            raise HTTPException(status_code=403, detail="Insufficient permissions")
+        return user
+    return role_checker
+
+# ============== FIELDSETS ==============
+# Read endpoints accept `fields` (e.g. fields=onboardingCompleted,user.firstName)
+# and `include` (e.g. include=user) to trim what is fetched and embedded.
+# Requested fields are checked against what the caller's role may see. Without
+# `fields` a resource comes back whole, less the fields the role may not see
+# (known fields outside its rules), so stored fields not listed here still pass.
+
+STUDENT_FIELDS = {
+    'studentId', 'userId', 'interestedCountries', 'selectedServices', 'intake', 'preferredDestination',
+    'onboardingCompleted', 'assignedCounselor', 'assignedAgent', 'commissionPercentage', 'status', 'createdAt'
+}
+USER_FIELDS = {
+    'userId', 'email', 'firstName', 'lastName', 'role', 'phone', 'country', 'avatar',
+    'isActive', 'createdAt', 'lastLogin', 'lastActiveAt', 'loginCount'
+}
+PRIVATE_USER_FIELDS = {'isActive', 'lastLogin', 'lastActiveAt', 'loginCount'}
+APPLICATION_FIELDS = {
+    'applicationId', 'studentId', 'serviceId', 'status', 'progress', 'assignedCounselor', 'assignedAgent',
+    'notes', 'documents', 'appliedAt', 'completedAt', 'createdAt'
+}
+SERVICE_FIELDS = {'serviceId', 'name', 'description', 'category', 'estimatedDuration', 'price', 'icon'}
+COMMISSION_FIELDS = {
+    'commissionId', 'agentId', 'studentId', 'serviceId', 'amount', 'percentage', 'status', 'createdAt', 'paidAt'
+}
+# Derived in the handler rather than stored
+COMPUTED_FIELDS = {'commission', 'assignedStudents', 'referredStudents', 'totalCommission', 'commissionRate'}
+# Never returned, whatever the role
+SECRET_FIELDS = {'password'}
+
+RESOURCE_FIELDS = {
+    'student': STUDENT_FIELDS | {'commission'},
+    'user': USER_FIELDS,
+    'applications': APPLICATION_FIELDS,
+    'service': SERVICE_FIELDS,
+    'counselors': USER_FIELDS | {'assignedStudents'},
+    'agents': USER_FIELDS | {'referredStudents', 'totalCommission', 'commissionRate'},
+    'commissions': COMMISSION_FIELDS
+}
+
+FIELDSET_RULES = {
+    'super_admin': {
+        'student': STUDENT_FIELDS,
+        'user': USER_FIELDS,
+        'applications': APPLICATION_FIELDS,
+        'counselors': RESOURCE_FIELDS['counselors'],
+        'agents': RESOURCE_FIELDS['agents'],
+        'commissions': COMMISSION_FIELDS
+    },
+    'counselor': {
+        'student': STUDENT_FIELDS,
+        'user': USER_FIELDS - PRIVATE_USER_FIELDS,
+        'applications': APPLICATION_FIELDS
+    },
+    'agent': {
+        'student': (STUDENT_FIELDS - {'assignedCounselor'}) | {'commission'},
+        'user': {'userId', 'email', 'firstName', 'lastName', 'phone', 'country', 'avatar'},
+        'applications': APPLICATION_FIELDS - {'assignedCounselor'},
+        'commissions': COMMISSION_FIELDS
+    },
+    'student': {
+        'student': STUDENT_FIELDS,
+        'user': USER_FIELDS - PRIVATE_USER_FIELDS,
+        'applications': APPLICATION_FIELDS,
+        'service': SERVICE_FIELDS
+    }
+}
+
+class Fieldset:
+    def __init__(self, root: str, embeds: set, fields: Optional[dict] = None, hidden: Optional[dict] = None):
+        self.root = root
+        self.embeds = embeds
+        self.fields = fields or {}  # resource -> requested field names
+        self.hidden = hidden or {}  # resource -> fields left out when none were requested
+    
+    def embeds_resource(self, resource: str) -> bool:
+        return resource in self.embeds
+    
+    def wants(self, resource: str, field: str) -> bool:
+        if resource in self.fields:
+            return field in self.fields[resource]
+        return field not in self.hidden.get(resource, SECRET_FIELDS)
+    
+    def projection(self, resource: str, keys: tuple = ()) -> dict:
+        """Mongo projection for a resource; `keys` are always fetched (they are needed to join)."""
+        if resource in self.fields:
+            requested = (self.fields[resource] - COMPUTED_FIELDS) | set(keys)
+            return {'_id': 0, **{f: 1 for f in sorted(requested)}}
+        hidden = self.hidden.get(resource, SECRET_FIELDS) - COMPUTED_FIELDS - set(keys)
+        return {'_id': 0, **{f: 0 for f in sorted(hidden)}}
+    
+    def trim(self, resource: str, doc: Optional[dict]) -> Optional[dict]:
+        """Apply the fieldset to a document that was not fetched with projection()."""
+        if doc is None:
+            return doc
+        if resource in self.fields:
+            return {k: v for k, v in doc.items() if k in self.fields[resource]}
+        hidden = self.hidden.get(resource, SECRET_FIELDS)
+        return {k: v for k, v in doc.items() if k not in hidden}
+
+def parse_fieldset(fields: Optional[str], include: Optional[str], role: str,
+                   root: str, embeddable: List[str]) -> Fieldset:
+    rules = FIELDSET_RULES.get(role, {})
+    embeds = set(embeddable)
+    if include is not None:
+        embeds = {e.strip() for e in include.split(',') if e.strip()}
+        unknown = embeds - set(embeddable)
+        if unknown:
+            raise HTTPException(status_code=400, detail=f"Cannot include: {', '.join(sorted(unknown))}")
+    requested = {}
+    for name in (f.strip() for f in (fields or '').split(',')):
+        if not name:
+            continue
+        resource, _, field = name.rpartition('.')
+        resource = resource or root
+        if resource != root and resource not in embeddable:
+            raise HTTPException(status_code=400, detail=f"Unknown field: {name}")
+        if field not in rules.get(resource, set()):
+            raise HTTPException(status_code=400, detail=f"Field not available: {name}")
+        requested.setdefault(resource, set()).add(field)
+        if resource != root:
+            embeds.add(resource)
+    hidden = {
+        resource: (RESOURCE_FIELDS.get(resource, set()) - rules.get(resource, set())) | SECRET_FIELDS
+        for resource in {root} | embeds
+    }
+    return Fieldset(root, embeds, requested, hidden)
+
+def fieldset_params(root: str, embeddable: List[str]):
+    def dependency(
+        fields: Optional[str] = Query(None, description="Comma-separated fields, e.g. studentId,user.firstName"),
+        include: Optional[str] = Query(None, description=f"Comma-separated embeds: {', '.join(embeddable)}"),
+        user: dict = Depends(get_current_user)
+    ) -> Fieldset:
+        return parse_fieldset(fields, include, user['role'], root, embeddable)
+    return dependency
+
+student_list_fieldset = fieldset_params('student', ['user', 'applications'])
+student_profile_fieldset = fieldset_params('student', ['user', 'applications', 'service'])
+application_fieldset = fieldset_params('applications', ['service'])
+counselor_list_fieldset = fieldset_params('counselors', [])
+agent_list_fieldset = fieldset_params('agents', [])
+commission_list_fieldset = fieldset_params('commissions', [])
+
+async def embed_students(repos: Repositories, students: List[dict], fieldset: Fieldset) -> List[dict]:
+    """Attach users and applications to students with one query per embedded resource."""
+    users_by_id = {}
+    if fieldset.embeds_resource('user'):
+        users = await repos.users.find_many(
+            [s['userId'] for s in students], fieldset.projection('user', ('userId',))
+        )
+        users_by_id = {u['userId']: u for u in users}
+    
+    applications_by_student = {}
+    if fieldset.embeds_resource('applications'):
+        for app in await repos.applications.list_for_students(
+            [s['studentId'] for s in students], fieldset.projection('applications', ('studentId',))
+        ):
+            applications_by_student.setdefault(app['studentId'], []).append(app)
+    
+    results = []
+    for student in students:
+        result = dict(student)
+        if fieldset.embeds_resource('user'):
+            result['user'] = users_by_id.get(student['userId'])
+        if fieldset.embeds_resource('applications'):
+            result['applications'] = applications_by_student.get(student['studentId'], [])
+        results.append(result)
+    return results
+
+async def embed_services(repos: Repositories, applications: List[dict], fieldset: Fieldset):
+    services = await repos.services.find_many(
+        list({a['serviceId'] for a in applications}), fieldset.projection('service', ('serviceId',))
+    )
+    services_by_id = {sv['serviceId']: sv for sv in services}
+    for app in applications:
+        app['service'] = services_by_id.get(app['serviceId'])
+
+# ============== DATES ==============
+# Timestamps are stored as native BSON dates. migrate_datetimes converts the ISO
+# strings written by earlier versions in place, in batches.
+
+DATETIME_FIELDS = {
+    'users': ['createdAt', 'lastLogin', 'lastActiveAt'],
+    'students': ['createdAt'],
+    'service_applications': ['createdAt'],
+    'services': ['createdAt'],
+    'commissions': ['createdAt', 'paidAt'],
+    'commission_rollups': ['rebuiltAt'],
+    'student_summaries': ['createdAt', 'updatedAt'],
+    'search_index': ['createdAt', 'indexedAt'],
+    'notifications': ['createdAt']
+}
+
+def as_utc(value: Optional[datetime]) -> Optional[datetime]:
+    # Date-only query parameters (createdFrom=2024-01-01) parse as naive datetimes
+    return value.replace(tzinfo=timezone.utc) if value and not value.tzinfo else value
+
+def date_range(field: str, start: Optional[datetime], end: Optional[datetime]) -> dict:
+    """Query fragment for start <= field < end (either bound optional, naive bounds are UTC)."""
+    bounds = {}
+    if start:
+        bounds['$gte'] = as_utc(start)
+    if end:
+        bounds['$lt'] = as_utc(end)
+    return {field: bounds} if bounds else {}
+
+async def migrate_datetimes(batch_size: int = 1000, dry_run: bool = False, sample_size: int = 100) -> dict:
+    """Convert string timestamps to BSON dates; safe to re-run and to run while serving.
+    
+    Strings that don't parse are left as they are and reported under 'unparseable'
+    ({field: {'count', 'ids'}}) so they can be fixed by hand.
+    """
+    report = {'converted': {}, 'unparseable': {}}
+    for collection, fields in DATETIME_FIELDS.items():
+        for field in fields:
+            name = f'{collection}.{field}'
+            converted = 0
+            unparseable = {'count': 0, 'ids': []}
+            last_id = None
+            while True:
+                # Walk by _id so documents left unconverted are not fetched again
+                query = {field: {'$type': 'string'}}
+                if last_id is not None:
+                    query['_id'] = {'$gt': last_id}
+                docs = await db[collection].find(query, {field: 1}).sort('_id', 1).limit(batch_size).to_list(batch_size)
+                if not docs:
+                    break
+                last_id = docs[-1]['_id']
+                operations = []
+                for doc in docs:
+                    try:
+                        value = _as_datetime(doc[field])
+                    except ValueError:
+                        logger.warning(f"Unparseable {name} on {doc['_id']}: {doc[field]!r}, left unchanged")
+                        unparseable['count'] += 1
+                        if len(unparseable['ids']) < sample_size:
+                            unparseable['ids'].append(str(doc['_id']))
+                        continue
+                    # The value guard skips documents rewritten since they were read
+                    operations.append(UpdateOne({'_id': doc['_id'], field: doc[field]}, {'$set': {field: value}}))
+                if operations and not dry_run:
+                    await db[collection].bulk_write(operations, ordered=False)
+                converted += len(operations)
+            if converted:
+                report['converted'][name] = converted
+            if unparseable['count']:
+                report['unparseable'][name] = unparseable
+    return report
+
+# ============== STUDENT SUMMARIES ==============
+# Denormalized read model of students: one document per student holding the
+# profile fields, assignments and application counts that list pages need.
+# Kept in sync by the write handlers; rebuild/check via manage.py.
+
+APPLICATION_STATUSES = ['not_started', 'in_progress', 'completed']
+
+def build_student_summary(student: dict, user_data: Optional[dict], applications: List[dict]) -> dict:
+    user_data = user_data or {}
+    counts = {status: 0 for status in APPLICATION_STATUSES}
+    for app in applications:
+        status = app.get('status', 'not_started')
+        counts[status] = counts.get(status, 0) + 1
+    total = len(applications)
+    progress = sum(app.get('progress', 0) for app in applications)
+    
+    return {
+        'studentId': student['studentId'],
+        'userId': student['userId'],
+        'firstName': user_data.get('firstName'),
+        'lastName': user_data.get('lastName'),
+        'email': user_data.get('email'),
+        'phone': user_data.get('phone'),
+        'country': user_data.get('country'),
+        'interestedCountries': student.get('interestedCountries', []),
+        'onboardingCompleted': student.get('onboardingCompleted', False),
+        'assignedCounselor': student.get('assignedCounselor'),
+        'assignedAgent': student.get('assignedAgent'),
+        'applicationCounts': counts,
+        'totalApplications': total,
+        'averageProgress': round(progress / total) if total else 0,
+        'createdAt': student.get('createdAt')
+    }
+
+async def _load_summaries(repos: Repositories, students: List[dict]) -> List[dict]:
+    """Build summaries for a batch of students with one users and one applications query."""
+    user_ids = [s['userId'] for s in students]
+    student_ids = [s['studentId'] for s in students]
+    
+    users = await repos.users.find_many(user_ids)
+    users_by_id = {u['userId']: u for u in users}
+    
+    applications_by_student = {}
+    for app in await repos.applications.list_for_students(
+        student_ids, {'_id': 0, 'studentId': 1, 'status': 1, 'progress': 1}
+    ):
+        applications_by_student.setdefault(app['studentId'], []).append(app)
+    
+    return [
+        build_student_summary(
+            student,
+            users_by_id.get(student['userId']),
+            applications_by_student.get(student['studentId'], [])
+        )
+        for student in students
+    ]
+
+async def refresh_student_summary(repos: Repositories, student_id: str):
+    """Recompute one student's summary after a write that touches it."""
+    student = await repos.students.get(student_id)
+    if not student:
+        await repos.summaries.delete(student_id)
+        return
+    
+    summary = (await _load_summaries(repos, [student]))[0]
+    summary['updatedAt'] = datetime.now(timezone.utc)
+    await repos.summaries.replace(summary)
+
+async def rebuild_student_summaries(repos: Repositories, batch_size: int = 500) -> int:
+    """Rebuild the whole projection in batches and drop summaries of deleted students."""
+    started_at = datetime.now(timezone.utc)
+    rebuilt = 0
+    
+    async def flush(batch):
+        summaries = await _load_summaries(repos, batch)
+        updated_at = datetime.now(timezone.utc)
+        await repos.summaries.replace_many([{**s, 'updatedAt': updated_at} for s in summaries])
+        return len(summaries)
+    
+    batch = []
+    async for student in repos.students.iter_all(batch_size):
+        batch.append(student)
+        if len(batch) >= batch_size:
+            rebuilt += await flush(batch)
+            batch = []
+    if batch:
+        rebuilt += await flush(batch)
+    
+    # Anything not touched by this run (or a concurrent refresh) no longer has a student
+    await repos.summaries.delete_stale(started_at)
+    return rebuilt
+
+async def check_student_summaries(repos: Repositories, batch_size: int = 500, repair: bool = False,
+                                  sample_size: int = 100) -> dict:
+    """Compare stored summaries with freshly computed ones."""
+    report = {'checked': 0, 'missing': [], 'stale': [], 'orphaned': []}
+    counts = {'missing': 0, 'stale': 0, 'orphaned': 0}
+    
+    def record(kind, student_id):
+        counts[kind] += 1
+        if len(report[kind]) < sample_size:
+            report[kind].append(student_id)
+    
+    async def compare(batch):
+        expected = await _load_summaries(repos, batch)
+        stored = await repos.summaries.find_many(
+            [s['studentId'] for s in batch], {'_id': 0, 'updatedAt': 0}
+        )
+        stored_by_id = {s['studentId']: s for s in stored}
+        for summary in expected:
+            current = stored_by_id.get(summary['studentId'])
+            if current is None:
+                record('missing', summary['studentId'])
+            elif current != summary:
+                record('stale', summary['studentId'])
+            else:
+                continue
+            if repair:
+                await refresh_student_summary(repos, summary['studentId'])
+    
+    batch = []
+    async for student in repos.students.iter_all(batch_size):
+        report['checked'] += 1
+        batch.append(student)
+        if len(batch) >= batch_size:
+            await compare(batch)
+            batch = []
+    if batch:
+        await compare(batch)
+    
+    async def find_orphans(ids):
+        existing = await repos.students.existing_ids(ids)
+        for student_id in set(ids) - existing:
+            record('orphaned', student_id)
+            if repair:
+                await repos.summaries.delete(student_id)
+    
+    ids = []
+    async for student_id in repos.summaries.iter_ids(batch_size):
+        ids.append(student_id)
+        if len(ids) >= batch_size:
+            await find_orphans(ids)
+            ids = []
+    if ids:
+        await find_orphans(ids)
+    
+    report['counts'] = counts
+    report['consistent'] = not any(counts.values())
+    return report
+
+async def list_student_summaries(repos: Repositories, query: dict, skip: int, limit: int,
+                                 created_from: Optional[datetime] = None, created_to: Optional[datetime] = None,
+                                 order: str = 'desc') -> dict:
+    summaries, total = await repos.summaries.page(query, created_from, created_to, order, skip, limit)
+    return {'students': summaries, 'total': total, 'skip': skip, 'limit': limit}
+
+# ============== COMMISSION LEDGER ==============
+# Commissions are append-only ledger rows; per-agent rollups by day, month and
+# all-time are updated incrementally with $inc so earnings pages never scan the
+# ledger. Rollups can be rebuilt from the ledger with manage.py.
+
+COMMISSION_STATUSES = ['pending', 'approved', 'paid']
+
+def _as_datetime(value) -> datetime:
+    if isinstance(value, datetime):
+        return value if value.tzinfo else value.replace(tzinfo=timezone.utc)
+    if isinstance(value, str):
+        return datetime.fromisoformat(value.replace('Z', '+00:00'))
+    return datetime.now(timezone.utc)
+
+def _rollup_buckets(created_at) -> List[tuple]:
+    ts = _as_datetime(created_at)
+    return [('day', ts.strftime('%Y-%m-%d')), ('month', ts.strftime('%Y-%m')), ('all', 'all')]
+
+async def record_commission(repos: Repositories, agent_id: str, student_id: str, service_id: str,
+                            amount: float, percentage: float, status: str = 'pending') -> dict:
+    commission_doc = {
+        'commissionId': str(uuid.uuid4()),
+        'agentId': agent_id,
+        'studentId': student_id,
+        'serviceId': service_id,
+        'amount': amount,
+        'percentage': percentage,
+        'status': status,
+        'createdAt': datetime.now(timezone.utc)
+    }
+    await repos.commissions.insert(commission_doc)
+    await repos.rollups.increment(agent_id, _rollup_buckets(commission_doc['createdAt']), {
+        'count': 1,
+        'total': amount,
+        f'amounts.{status}': amount,
+        f'services.{service_id}.count': 1,
+        f'services.{service_id}.amount': amount
+    })
+    return commission_doc
+
+async def set_commission_status(repos: Repositories, commission_id: str, status: str,
+                                from_statuses: List[str]) -> Optional[dict]:
+    """Move a commission to a new status and shift its amount between rollup status buckets."""
+    update = {'status': status}
+    if status == 'paid':
+        update['paidAt'] = datetime.now(timezone.utc)
+    
+    # Filtering on the old status makes the transition (and the $inc) happen once
+    previous = await repos.commissions.transition(commission_id, from_statuses, update)
+    if not previous:
+        return None
+    
+    amount = previous.get('amount', 0)
+    await repos.rollups.increment(previous['agentId'], _rollup_buckets(previous.get('createdAt')), {
+        f"amounts.{previous['status']}": -amount,
+        f'amounts.{status}': amount
+    })
+    return {**previous, **update}
+
+async def get_commission_totals(repos: Repositories, agent_ids: List[str]) -> dict:
+    rollups = await repos.rollups.all_time(agent_ids)
+    totals = {agent_id: {'count': 0, 'amounts': {s: 0 for s in COMMISSION_STATUSES}} for agent_id in agent_ids}
+    for rollup in rollups:
+        totals[rollup['agentId']] = {
+            'count': rollup.get('count', 0),
+            'amounts': {s: rollup.get('amounts', {}).get(s, 0) for s in COMMISSION_STATUSES}
+        }
+    return totals
+
+async def get_earnings(repos: Repositories, agent_id: str, granularity: str,
+                       start: Optional[str], end: Optional[str]) -> dict:
+    width = 10 if granularity == 'day' else 7
+    rollups = await repos.rollups.buckets(agent_id, granularity, start and start[:width], end and end[:width])
+    
+    totals = {'count': 0, 'total': 0, 'amounts': {s: 0 for s in COMMISSION_STATUSES}}
+    for rollup in rollups:
+        totals['count'] += rollup.get('count', 0)
+        totals['total'] += rollup.get('total', 0)
+        for s in COMMISSION_STATUSES:
+            totals['amounts'][s] += rollup.get('amounts', {}).get(s, 0)
+    
+    return {'granularity': granularity, 'buckets': rollups, 'totals': totals}
+
+async def backfill_commission_rollups(repos: Repositories, batch_size: int = 1000) -> int:
+    """Recompute every rollup from the ledger, replacing what is stored.
+    
+    Run while commissions are not being written; concurrent $inc updates may be lost.
+    """
+    started_at = datetime.now(timezone.utc)
+    rollups = {}
+    
+    async for commission in repos.commissions.iter_all(
+        {'_id': 0, 'agentId': 1, 'serviceId': 1, 'status': 1, 'amount': 1, 'createdAt': 1}, batch_size
+    ):
+        amount = commission.get('amount', 0)
+        status = commission.get('status', 'pending')
+        service_id = commission.get('serviceId')
+        for granularity, bucket in _rollup_buckets(commission.get('createdAt')):
+            key = (commission['agentId'], granularity, bucket)
+            rollup = rollups.setdefault(key, {
+                'agentId': key[0], 'granularity': granularity, 'bucket': bucket,
+                'count': 0, 'total': 0, 'amounts': {}, 'services': {}
+            })
+            rollup['count'] += 1
+            rollup['total'] += amount
+            rollup['amounts'][status] = rollup['amounts'].get(status, 0) + amount
+            service = rollup['services'].setdefault(service_id, {'count': 0, 'amount': 0})
+            service['count'] += 1
+            service['amount'] += amount
+    
+    docs = list(rollups.values())
+    for i in range(0, len(docs), batch_size):
+        rebuilt_at = datetime.now(timezone.utc)
+        await repos.rollups.replace_many([{**d, 'rebuiltAt': rebuilt_at} for d in docs[i:i + batch_size]])
+    
+    # Buckets with no remaining ledger rows
+    await repos.rollups.delete_stale(started_at)
+    return len(docs)
+
+# ============== SEARCH INDEX ==============
+# One search_index document per user with edge prefixes (prefix matching) and
+# trigrams (typo tolerance) of name, email, country and interested countries,
+# stored in a multikey-indexed array. A search scores two capped candidate sets
+# in parallel: entries with the full prefix of every term, and entries with one
+# of the rarest trigrams (enough of them that every entry meeting the typo
+# threshold holds at least one). Common trigrams such as t:com never drive the
+# candidate scan. A set that hits SEARCH_MAX_CANDIDATES is scored in index
+# order and the response says `truncated`; a longer query narrows it.
+# `manage.py bench-search` reports plans and latency.
+
+SEARCH_PREFIX_MAX = 10
+SEARCH_PREFIX_WEIGHT = 5
+SEARCH_MAX_CANDIDATES = int(os.environ.get('SEARCH_MAX_CANDIDATES', 1000))
+
+def search_terms(*values) -> List[str]:
+    terms = []
+    for value in values:
+        if isinstance(value, list):
+            terms.extend(search_terms(*value))
+        elif value:
+            terms.extend(t for t in re.split(r'[^0-9a-z]+', str(value).lower()) if t)
+    return terms
+
+def _prefix_grams(term: str) -> List[str]:
+    return [f'p:{term[:i]}' for i in range(2, min(len(term), SEARCH_PREFIX_MAX) + 1)]
+
+def _trigrams(term: str) -> List[str]:
+    padded = f'^{term}$'
+    return [f't:{padded[i:i + 3]}' for i in range(len(padded) - 2)]
+
+def build_search_entry(user_data: dict, student: Optional[dict] = None) -> dict:
+    student = student or {}
+    terms = search_terms(
+        user_data.get('firstName'), user_data.get('lastName'), user_data.get('email'),
+        user_data.get('country'), student.get('interestedCountries', [])
+    )
+    grams = set()
+    for term in terms:
+        grams.update(_prefix_grams(term))
+        grams.update(_trigrams(term))
+    
+    return {
+        'userId': user_data['userId'],
+        'studentId': student.get('studentId'),
+        'role': user_data.get('role'),
+        'firstName': user_data.get('firstName'),
+        'lastName': user_data.get('lastName'),
+        'email': user_data.get('email'),
+        'country': user_data.get('country'),
+        'interestedCountries': student.get('interestedCountries', []),
+        'grams': sorted(grams),
+        'createdAt': user_data.get('createdAt')
+    }
+
+async def index_user_for_search(repos: Repositories, user_id: str):
+    """Refresh one user's search entry after a write that touches searchable fields."""
+    user_data = await repos.users.get(user_id)
+    if not user_data:
+        await repos.search.delete(user_id)
+        return
+    student = await repos.students.get_by_user(user_id)
+    entry = build_search_entry(user_data, student)
+    entry['indexedAt'] = datetime.now(timezone.utc)
+    await repos.search.replace(entry)
 
-# Configure logging
-logging.basicConfig(level=logging.INFO)
-logger = logging.getLogger(__name__)
+async def rebuild_search_index(repos: Repositories, batch_size: int = 500) -> int:
+    started_at = datetime.now(timezone.utc)
+    indexed = 0
+    
+    async def flush(users):
+        students = await repos.students.find_by_users([u['userId'] for u in users])
+        students_by_user = {st['userId']: st for st in students}
+        indexed_at = datetime.now(timezone.utc)
+        await repos.search.replace_many([
+            {**build_search_entry(u, students_by_user.get(u['userId'])), 'indexedAt': indexed_at}
+            for u in users
+        ])
+        return len(users)
+    
+    batch = []
+    async for user_data in repos.users.iter_all(batch_size):
+        batch.append(user_data)
+        if len(batch) >= batch_size:
+            indexed += await flush(batch)
+            batch = []
+    if batch:
+        indexed += await flush(batch)
+    
+    await repos.search.delete_stale(started_at)
+    return indexed
 
-# ============== MODELS ==============
+def _count_hits(query_grams: List[str]) -> dict:
+    return {'$size': {'$filter': {'input': '$grams', 'cond': {'$in': ['$$this', query_grams]}}}}
 
-class UserCreate(BaseModel):
-    email: EmailStr
-    password: str
-    firstName: str
-    lastName: str
-    role: Optional[str] = "student"
+def _scored_pipeline(match: dict, prefixes: List[str], trigrams: List[str], min_trigrams: int, top: int) -> List[dict]:
+    """One document {candidates: [{n}], entries: [...]}; n above SEARCH_MAX_CANDIDATES means the set was cut."""
+    return [
+        {'$match': match},
+        # Hard cap on how many entries one query scores, plus one to detect the cut
+        {'$limit': SEARCH_MAX_CANDIDATES + 1},
+        {'$facet': {
+            'candidates': [{'$count': 'n'}],
+            'entries': [
+                {'$limit': SEARCH_MAX_CANDIDATES},
+                {'$addFields': {
+                    'prefixHits': _count_hits(prefixes),
+                    'trigramHits': _count_hits(trigrams)
+                }},
+                {'$match': {'$or': [{'prefixHits': {'$gt': 0}}, {'trigramHits': {'$gte': min_trigrams}}]}},
+                {'$addFields': {'score': {'$add': [
+                    {'$multiply': ['$prefixHits', SEARCH_PREFIX_WEIGHT]}, '$trigramHits'
+                ]}}},
+                {'$sort': {'score': -1, 'lastName': 1, 'userId': 1}},
+                {'$limit': top},
+                {'$project': {'_id': 0, 'grams': 0, 'indexedAt': 0, 'prefixHits': 0, 'trigramHits': 0}}
+            ]
+        }}
+    ]
 
-class UserLogin(BaseModel):
-    email: EmailStr
-    password: str
+async def _rarest_trigrams(repos: Repositories, trigrams: List[str], count: int) -> List[str]:
+    """The `count` trigrams with the fewest entries, from index counts capped at SEARCH_MAX_CANDIDATES."""
+    if count >= len(trigrams):
+        return trigrams
+    counts = await repos.search.gram_counts(trigrams, SEARCH_MAX_CANDIDATES)
+    return [gram for _, gram in sorted(zip(counts, trigrams))[:count]]
 
-class UserResponse(BaseModel):
-    userId: str
-    email: str
-    firstName: str
-    lastName: str
-    role: str
-    phone: Optional[str] = None
-    country: Optional[str] = None
+async def search_plans(repos: Repositories, q: str, role: Optional[str], top: int) -> List[dict]:
+    """Candidate sets for a query, as repos.search.scored() arguments returning its `top` best entries."""
+    terms = search_terms(q)
+    prefixes = sorted({g for t in terms for g in _prefix_grams(t)[-1:]})
+    trigrams = sorted({g for t in terms if len(t) >= 3 for g in _trigrams(t)})
+    # A transposed pair of letters still leaves about a third of the trigrams intact
+    min_trigrams = min(len(trigrams), max(2, math.ceil(len(trigrams) / 3)))
+    role_filter = {'role': role} if role else {}
+    scoring = {'prefixes': prefixes, 'trigrams': trigrams, 'min_trigrams': min_trigrams, 'top': top}
+    
+    plans = []
+    if prefixes:
+        # Every term's prefix, so "john smith" does not scan every John
+        plans.append({'match': {'grams': {'$all': prefixes}, **role_filter}, **scoring})
+    if trigrams:
+        # An entry with min_trigrams hits misses at most len - min_trigrams of them
+        rare = await _rarest_trigrams(repos, trigrams, len(trigrams) - min_trigrams + 1)
+        plans.append({'match': {'grams': {'$in': rare}, **role_filter}, **scoring})
+    return plans
 
-class TokenResponse(BaseModel):
-    message: str
-    token: str
-    user: UserResponse
+async def search_users(repos: Repositories, q: str, role: Optional[str], skip: int, limit: int) -> dict:
+    plans = await search_plans(repos, q, role, skip + limit + 1)
+    branches = await asyncio.gather(*(repos.search.scored(**plan) for plan in plans))
+    
+    # Both branches score with the same grams, so an entry found twice has one score
+    by_user = {}
+    truncated = False
+    for branch in branches:
+        truncated |= branch['candidates'] > SEARCH_MAX_CANDIDATES
+        for entry in branch['entries']:
+            by_user.setdefault(entry['userId'], entry)
+    ranked = sorted(by_user.values(), key=lambda e: (-e['score'], e.get('lastName') or '', e['userId']))
+    results = ranked[skip:skip + limit + 1]
+    
+    return {
+        'results': results[:limit],
+        'skip': skip,
+        'limit': limit,
+        'hasMore': len(results) > limit,
+        # Only the first SEARCH_MAX_CANDIDATES candidates of a branch were scored
+        'truncated': truncated
+    }
 
-class OnboardingData(BaseModel):
-    interestedCountries: List[str] = []
-    selectedServices: List[str] = []
-    intake: Optional[str] = None
-    preferredDestination: Optional[str] = None
+def _execution_stats(explain: dict) -> dict:
+    """Pull executionStats out of an aggregate explain (classic and SBE layouts)."""
+    if isinstance(explain, dict):
+        if 'executionStats' in explain:
+            return explain['executionStats']
+        values = explain.values()
+    elif isinstance(explain, list):
+        values = explain
+    else:
+        return {}
+    for value in values:
+        stats = _execution_stats(value)
+        if stats:
+            return stats
+    return {}
 
-class ServiceCreate(BaseModel):
-    name: str
-    description: str
-    category: str
-    estimatedDuration: Optional[str] = None
-    price: Optional[float] = None
+async def explain_search(repos: Repositories, q: str, role: Optional[str] = None, limit: int = 20) -> List[dict]:
+    """Keys and documents examined by each candidate set of a query."""
+    return [
+        {'match': plan['match'], **await repos.search.explain(**plan)}
+        for plan in await search_plans(repos, q, role, limit + 1)
+    ]
 
-class ServiceApplicationCreate(BaseModel):
-    serviceId: str
+# ============== BULK IMPORT ==============
+# Streams a CSV or NDJSON upload, validates each row with UserCreate and inserts
+# users in batches: passwords are hashed on hash_executor and documents written
+# with unordered insert_many, duplicates being rejected by the unique email index.
 
-# ============== UTILITY FUNCTIONS ==============
+IMPORT_BATCH_SIZE = 500
 
-def hash_password(password: str) -> str:
-    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+async def _upload_lines(upload: UploadFile, chunk_size: int = 64 * 1024):
+    decoder = codecs.getincrementaldecoder('utf-8-sig')()
+    buffer = ''
+    while True:
+        chunk = await upload.read(chunk_size)
+        if not chunk:
+            break
+        buffer += decoder.decode(chunk)
+        *lines, buffer = buffer.split('\n')
+        for line in lines:
+            yield line.rstrip('\r')
+    buffer += decoder.decode(b'', final=True)
+    if buffer.strip():
+        yield buffer.rstrip('\r')
 
-def verify_password(password: str, hashed: str) -> bool:
-    return bcrypt.checkpw(password.encode('utf-8'), hashed.encode('utf-8'))
+async def _upload_rows(upload: UploadFile, fmt: str):
+    """Yield (row number, dict or error message) for each non-empty row."""
+    header = None
+    number = 0
+    record = None
+    async for line in _upload_lines(upload):
+        if record is None and not line.strip():
+            continue
+        if fmt == 'csv':
+            # A quoted field may continue on the next line; the record ends once its quotes balance
+            record = line if record is None else f'{record}\n{line}'
+            if record.count('"') % 2:
+                continue
+            values = next(csv.reader([record]))
+            record = None
+            if header is None:
+                header = [h.strip() for h in values]
+                continue
+            number += 1
+            yield number, dict(zip(header, (v.strip() for v in values)))
+        else:
+            number += 1
+            try:
+                row = json.loads(line)
+            except json.JSONDecodeError as e:
+                yield number, f"Invalid JSON: {e.msg}"
+                continue
+            yield number, row if isinstance(row, dict) else "Row must be a JSON object"
+    if record is not None:
+        yield number + 1, "Unterminated quoted field"
 
-def create_token(user_id: str, role: str) -> str:
-    payload = {
-        'userId': user_id,
-        'role': role,
-        'exp': datetime.now(timezone.utc) + timedelta(days=7)
-    }
-    return jwt.encode(payload, JWT_SECRET, algorithm=JWT_ALGORITHM)
+async def _import_batch(repos: Repositories, rows: List[tuple], report: List[dict]):
+    """Hash, insert and index one batch of validated (row number, UserCreate) pairs."""
+    hashes = await asyncio.gather(*(hash_password_async(data.password) for _, data in rows))
+    # Imports have no request deadline; each batch's database work is bounded instead
+    with db_timeout(WRITE_BUDGET_SECONDS):
+        await _insert_import_batch(repos, rows, hashes, report)
 
-async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
-    try:
-        token = credentials.credentials
-        payload = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
-        user = await db.users.find_one({'userId': payload['userId']}, {'_id': 0, 'password': 0})
-        if not user:
-            raise HTTPException(status_code=401, detail="User not found")
-        return user
-    except jwt.ExpiredSignatureError:
-        raise HTTPException(status_code=401, detail="Token expired")
-    except jwt.InvalidTokenError:
-        raise HTTPException(status_code=401, detail="Invalid token")
+async def _insert_import_batch(repos: Repositories, rows: List[tuple], hashes: List[str], report: List[dict]):
+    created_at = datetime.now(timezone.utc)
+    user_docs = [
+        {
+            'userId': str(uuid.uuid4()),
+            'email': data.email.lower(),
+            'password': hashed,
+            'firstName': data.firstName,
+            'lastName': data.lastName,
+            'role': data.role,
+            'isActive': True,
+            'createdAt': created_at
+        }
+        for (_, data), hashed in zip(rows, hashes)
+    ]
+    
+    failed = await repos.users.insert_many(user_docs)
+    
+    created = []
+    for i, ((number, data), doc) in enumerate(zip(rows, user_docs)):
+        if i in failed:
+            status = 'duplicate' if failed[i] == 'duplicate' else 'failed'
+            entry = {'row': number, 'email': doc['email'], 'status': status}
+            if status == 'failed':
+                entry['errors'] = [failed[i]]
+            report.append(entry)
+        else:
+            created.append(doc)
+            report.append({'row': number, 'email': doc['email'], 'status': 'created', 'userId': doc['userId']})
+    if not created:
+        return
+    
+    student_docs = [
+        {
+            'studentId': str(uuid.uuid4()),
+            'userId': doc['userId'],
+            'interestedCountries': [],
+            'selectedServices': [],
+            'onboardingCompleted': False,
+            'createdAt': created_at
+        }
+        for doc in created if doc['role'] == 'student'
+    ]
+    if student_docs:
+        await repos.students.insert_many(student_docs)
+        summaries = await _load_summaries(repos, student_docs)
+        await repos.summaries.replace_many([{**s, 'updatedAt': created_at} for s in summaries])
+    
+    students_by_user = {st['userId']: st for st in student_docs}
+    await repos.search.replace_many([
+        {**build_search_entry(doc, students_by_user.get(doc['userId'])), 'indexedAt': created_at}
+        for doc in created
+    ])
 
-def require_role(allowed_roles: List[str]):
-    async def role_checker(user: dict = Depends(get_current_user)):
-        if user['role'] not in allowed_roles:
-            raise HTTPException(status_code=403, detail="Insufficient permissions")
-        return user
-    return role_checker
+async def import_users(repos: Repositories, upload: UploadFile, fmt: str) -> dict:
+    report = []
+    batch = []
+    async for number, row in _upload_rows(upload, fmt):
+        if isinstance(row, str):
+            report.append({'row': number, 'status': 'invalid', 'errors': [row]})
+            continue
+        try:
+            data = UserCreate(**{k: v for k, v in row.items() if v not in (None, '')})
+        except ValidationError as e:
+            report.append({
+                'row': number,
+                'email': row.get('email'),
+                'status': 'invalid',
+                'errors': [f"{'.'.join(str(l) for l in err['loc'])}: {err['msg']}" for err in e.errors()]
+            })
+            continue
+        batch.append((number, data))
+        if len(batch) >= IMPORT_BATCH_SIZE:
+            await _import_batch(repos, batch, report)
+            batch = []
+    if batch:
+        await _import_batch(repos, batch, report)
+    
+    report.sort(key=lambda r: r['row'])
+    counts = {}
+    for entry in report:
+        counts[entry['status']] = counts.get(entry['status'], 0) + 1
+    return {'total': len(report), 'counts': counts, 'rows': report}
 
 # ============== AUTH ROUTES ==============
 
 @auth_router.post("/signup", response_model=TokenResponse)
-async def signup(data: UserCreate):
+async def signup(data: UserCreate, request: Request, repos: Repositories = Depends(get_repositories)):
     # Check if user exists
-    existing = await db.users.find_one({'email': data.email.lower()})
+    existing = await repos.users.get_by_email(data.email.lower())
     if existing:
         raise HTTPException(status_code=400, detail="Email already registered")
     
@@ -133,15 +3181,15 @@ async def signup(data: UserCreate):
     user_doc = {
         'userId': user_id,
         'email': data.email.lower(),
-        'password': hash_password(data.password),
+        'password': await hash_password_async(data.password),
         'firstName': data.firstName,
         'lastName': data.lastName,
         'role': data.role,
         'isActive': True,
-        'createdAt': datetime.now(timezone.utc).isoformat()
+        'createdAt': datetime.now(timezone.utc)
     }
     
-    await db.users.insert_one(user_doc)
+    await repos.users.insert(user_doc)
     
     # Create student record if role is student
     if data.role == 'student':
@@ -151,15 +3199,20 @@ async def signup(data: UserCreate):
             'interestedCountries': [],
             'selectedServices': [],
             'onboardingCompleted': False,
-            'createdAt': datetime.now(timezone.utc).isoformat()
+            'createdAt': datetime.now(timezone.utc)
         }
-        await db.students.insert_one(student_doc)
+        await repos.students.insert(student_doc)
+        await refresh_student_summary(repos, student_doc['studentId'])
+    
+    await index_user_for_search(repos, user_id)
+    await audit_log.log(user_id, 'user_created', 'user', user_id, {'role': data.role, 'source': 'signup'},
+                        request, repos=repos)
     
-    token = create_token(user_id, data.role)
+    tokens = await issue_tokens(repos, user_doc, onboarding_completed=data.role != 'student')
     
     return {
         'message': 'User created successfully',
-        'token': token,
+        **tokens,
         'user': {
             'userId': user_id,
             'email': data.email.lower(),
@@ -170,25 +3223,26 @@ async def signup(data: UserCreate):
     }
 
 @auth_router.post("/login", response_model=TokenResponse)
-async def login(data: UserLogin):
-    user = await db.users.find_one({'email': data.email.lower()})
+async def login(data: UserLogin, request: Request, repos: Repositories = Depends(get_repositories)):
+    user = await repos.users.get_by_email(data.email.lower())
     if not user:
         raise HTTPException(status_code=401, detail="Invalid credentials")
     
     if not verify_password(data.password, user['password']):
         raise HTTPException(status_code=401, detail="Invalid credentials")
     
-    # Update last login
-    await db.users.update_one(
-        {'userId': user['userId']},
-        {'$set': {'lastLogin': datetime.now(timezone.utc).isoformat()}}
-    )
+    # Update last login (off the request path)
+    write_behind.defer('users', {'userId': user['userId']}, {
+        '$set': {'lastLogin': datetime.now(timezone.utc)},
+        '$inc': {'loginCount': 1}
+    })
+    await audit_log.log(user['userId'], 'user_login', 'user', user['userId'], None, request, repos=repos)
     
-    token = create_token(user['userId'], user['role'])
+    tokens = await issue_tokens(repos, user)
     
     return {
         'message': 'Login successful',
-        'token': token,
+        **tokens,
         'user': {
             'userId': user['userId'],
             'email': user['email'],
@@ -200,103 +3254,379 @@ async def login(data: UserLogin):
         }
     }
 
+async def current_user_profile(repos: Repositories, user: dict) -> dict:
+    # Session claims already carry the onboarding flag
+    if 'sessionId' in user:
+        return {k: v for k, v in user.items() if k != 'sessionId'}
+    return {**user, 'onboardingCompleted': await get_onboarding_status(repos, user)}
+
 @auth_router.get("/me")
-async def get_me(user: dict = Depends(get_current_user)):
-    # If student, check onboarding status
-    onboarding_completed = True
-    if user['role'] == 'student':
-        student = await db.students.find_one({'userId': user['userId']}, {'_id': 0})
-        if student:
-            onboarding_completed = student.get('onboardingCompleted', False)
+async def get_me(user: dict = Depends(get_current_user), repos: Repositories = Depends(get_repositories)):
+    return {'user': await current_user_profile(repos, user)}
+
+@auth_router.post("/refresh")
+async def refresh_session(data: RefreshRequest, repos: Repositories = Depends(get_repositories)):
+    payload = decode_token(data.refreshToken)
+    if payload.get('type') != 'refresh':
+        raise HTTPException(status_code=401, detail="Invalid token")
+    if payload['sid'] in revoked_sessions:
+        raise HTTPException(status_code=401, detail="Session revoked")
     
-    return {
-        'user': {
-            **user,
-            'onboardingCompleted': onboarding_completed
-        }
-    }
+    # Refresh tokens are single use; claiming it atomically makes rotation race-free
+    token_doc = await db.refresh_tokens.find_one_and_update(
+        {'jti': payload['jti'], 'usedAt': None},
+        {'$set': {'usedAt': datetime.now(timezone.utc)}}
+    )
+    if not token_doc:
+        # A rotated token was presented again: assume it leaked and end the session
+        await revoke_session(payload['sid'])
+        raise HTTPException(status_code=401, detail="Refresh token already used")
+    
+    user = await repos.users.get(payload['userId'])
+    if not user or not user.get('isActive', True):
+        await revoke_session(payload['sid'])
+        raise HTTPException(status_code=401, detail="User not found")
+    
+    tokens = await create_session(user, await get_onboarding_status(repos, user), payload['sid'])
+    return {'message': 'Token refreshed', **tokens}
+
+@auth_router.post("/logout")
+async def logout(user: dict = Depends(get_current_user)):
+    if 'sessionId' in user:
+        await revoke_session(user['sessionId'])
+    return {'message': 'Logged out'}
 
 # ============== ADMIN ROUTES ==============
 
+async def admin_metrics(repos: Repositories, allow_partial: bool = False) -> dict:
+    return await gather_parts({
+        'totalStudents': repos.students.count(),
+        'totalCounselors': repos.users.count_by_role('counselor'),
+        'totalAgents': repos.users.count_by_role('agent'),
+        'activeApplications': repos.applications.count_by_status(['not_started', 'in_progress']),
+        'completedApplications': repos.applications.count_by_status(['completed'])
+    }, allow_partial)
+
 @admin_router.get("/metrics")
-async def get_admin_metrics(user: dict = Depends(require_role(['super_admin']))):
-    total_students = await db.students.count_documents({})
-    total_counselors = await db.users.count_documents({'role': 'counselor'})
-    total_agents = await db.users.count_documents({'role': 'agent'})
-    active_applications = await db.service_applications.count_documents({
-        'status': {'$in': ['not_started', 'in_progress']}
-    })
-    completed_applications = await db.service_applications.count_documents({'status': 'completed'})
-    
-    return {
-        'metrics': {
-            'totalStudents': total_students,
-            'totalCounselors': total_counselors,
-            'totalAgents': total_agents,
-            'activeApplications': active_applications,
-            'completedApplications': completed_applications
-        }
-    }
+async def get_admin_metrics(
+    response: Response,
+    partial: bool = Query(False, description="Return the counts that finish within the budget instead of a 504"),
+    user: dict = Depends(require_role(['super_admin'])),
+    repos: Repositories = Depends(get_repositories)
+):
+    return {'metrics': await stale_cache.read(('metrics', partial), lambda: admin_metrics(repos, partial), response)}
 
 @admin_router.get("/students")
-async def get_all_students(user: dict = Depends(require_role(['super_admin']))):
-    students = await db.students.find({}, {'_id': 0}).to_list(1000)
+async def get_all_students(
+    user: dict = Depends(require_role(['super_admin'])),
+    fieldset: Fieldset = Depends(student_list_fieldset),
+    repos: Repositories = Depends(get_repositories)
+):
+    students = await repos.students.list(fieldset.projection('student', ('studentId', 'userId')))
     
-    students_with_details = []
-    for student in students:
-        user_data = await db.users.find_one(
-            {'userId': student['userId']}, 
-            {'_id': 0, 'password': 0}
+    return {'students': await embed_students(repos, students, fieldset)}
+
+@admin_router.get("/students/summary")
+async def get_student_summaries(
+    counselorId: Optional[str] = None,
+    agentId: Optional[str] = None,
+    createdFrom: Optional[datetime] = None,
+    createdTo: Optional[datetime] = None,
+    order: Literal['asc', 'desc'] = 'desc',
+    skip: int = Query(0, ge=0),
+    limit: int = Query(100, ge=1, le=1000),
+    user: dict = Depends(require_role(['super_admin'])),
+    repos: Repositories = Depends(get_repositories)
+):
+    query = {}
+    if counselorId:
+        query['assignedCounselor'] = counselorId
+    if agentId:
+        query['assignedAgent'] = agentId
+    return await list_student_summaries(repos, query, skip, limit, createdFrom, createdTo, order)
+
+@admin_router.get("/student-summaries/check")
+async def check_student_summaries_endpoint(
+    repair: bool = False,
+    user: dict = Depends(require_role(['super_admin'])),
+    repos: Repositories = Depends(get_repositories)
+):
+    return await check_student_summaries(repos, repair=repair)
+
+@admin_router.post("/student-summaries/rebuild")
+async def rebuild_student_summaries_endpoint(
+    user: dict = Depends(require_role(['super_admin'])),
+    repos: Repositories = Depends(get_repositories)
+):
+    rebuilt = await rebuild_student_summaries(repos)
+    return {'message': 'Student summaries rebuilt', 'rebuilt': rebuilt}
+
+async def balance_assignments(repos: Repositories, data: BulkAssignmentRequest) -> List[StudentAssignment]:
+    """Spread students over counselors, always picking the one with the fewest students."""
+    counselor_ids = await repos.users.active_ids('counselor', data.counselorIds or None)
+    if not counselor_ids:
+        raise HTTPException(status_code=400, detail="No active counselors to assign to")
+    
+    # Unknown or already assigned ids would count against a counselor's load
+    student_ids = await repos.students.list_unassigned_ids(data.limit, data.studentIds or None)
+    
+    load = await repos.students.assignment_load('assignedCounselor', counselor_ids)
+    heap = [(count, counselor_id) for counselor_id, count in load.items()]
+    heapq.heapify(heap)
+    
+    assignments = []
+    for student_id in student_ids:
+        count, counselor_id = heapq.heappop(heap)
+        assignments.append(StudentAssignment(studentId=student_id, counselorId=counselor_id))
+        heapq.heappush(heap, (count + 1, counselor_id))
+    return assignments
+
+@admin_router.post("/students/assign")
+async def bulk_assign_students(
+    data: BulkAssignmentRequest,
+    request: Request,
+    user: dict = Depends(require_role(['super_admin'])),
+    repos: Repositories = Depends(get_repositories)
+):
+    if data.policy == 'least_loaded':
+        assignments = await balance_assignments(repos, data)
+    else:
+        assignments = data.assignments
+    if not assignments:
+        raise HTTPException(status_code=400, detail="No assignments given")
+    
+    # Validate every referenced counselor/agent with one query per role
+    counselor_ids = list({a.counselorId for a in assignments if a.counselorId})
+    agent_ids = list({a.agentId for a in assignments if a.agentId})
+    unknown = set(counselor_ids) - set(await repos.users.active_ids('counselor', counselor_ids))
+    unknown |= set(agent_ids) - set(await repos.users.active_ids('agent', agent_ids))
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown counselors/agents: {', '.join(sorted(unknown))}")
+    
+    updates = {}
+    for assignment in assignments:
+        fields = {}
+        if assignment.counselorId:
+            fields['assignedCounselor'] = assignment.counselorId
+        if assignment.agentId:
+            fields['assignedAgent'] = assignment.agentId
+        if fields:
+            updates.setdefault(assignment.studentId, {}).update(fields)
+    if not updates:
+        raise HTTPException(status_code=400, detail="Assignments must set counselorId or agentId")
+    
+    matched, modified = await repos.students.assign(updates)
+    # Same $set on the read model keeps it consistent without recomputing each summary
+    await repos.summaries.assign(updates)
+    
+    student_ids = [a.studentId for a in assignments]
+    found = await repos.students.existing_ids(student_ids)
+    
+    student_metadata = {}
+    for assignment in assignments:
+        if assignment.studentId not in found:
+            continue
+        if assignment.counselorId:
+            await audit_log.log(user['userId'], 'counselor_assigned', 'student', assignment.studentId,
+                                {'counselorId': assignment.counselorId}, request, repos=repos)
+        if assignment.agentId:
+            await audit_log.log(user['userId'], 'agent_assigned', 'student', assignment.studentId,
+                                {'agentId': assignment.agentId}, request, repos=repos)
+        student_metadata[assignment.studentId] = {
+            'counselorId': assignment.counselorId, 'agentId': assignment.agentId
+        }
+    
+    # One event for the whole batch; the worker resolves students and builds each notification
+    if student_metadata:
+        await notifications.publish(
+            'assignment',
+            'Student Assignment Updated',
+            'A counselor or agent has been assigned to a student',
+            student_ids=list(student_metadata),
+            student_metadata=student_metadata,
+            repos=repos
         )
-        applications = await db.service_applications.find(
-            {'studentId': student['studentId']},
-            {'_id': 0}
-        ).to_list(100)
-        
-        students_with_details.append({
-            **student,
-            'user': user_data,
-            'applications': applications
-        })
     
-    return {'students': students_with_details}
+    return {
+        'message': 'Students assigned',
+        'matched': matched,
+        'modified': modified,
+        'assignments': [a.model_dump() for a in assignments if a.studentId in found],
+        'unknownStudents': [sid for sid in student_ids if sid not in found],
+        'counselorLoad': await repos.students.assignment_load('assignedCounselor', counselor_ids),
+        'agentLoad': await repos.students.assignment_load('assignedAgent', agent_ids)
+    }
+
+@admin_router.get("/search")
+async def search(
+    q: str = Query(..., min_length=2, max_length=100),
+    role: Optional[Literal['student', 'counselor', 'agent', 'super_admin']] = None,
+    skip: int = Query(0, ge=0),
+    limit: int = Query(20, ge=1, le=100),
+    user: dict = Depends(require_role(['super_admin'])),
+    repos: Repositories = Depends(get_repositories)
+):
+    return await search_users(repos, q, role, skip, limit)
+
+@admin_router.post("/search/rebuild")
+async def rebuild_search_index_endpoint(
+    user: dict = Depends(require_role(['super_admin'])),
+    repos: Repositories = Depends(get_repositories)
+):
+    indexed = await rebuild_search_index(repos)
+    return {'message': 'Search index rebuilt', 'indexed': indexed}
 
 @admin_router.get("/counselors")
-async def get_all_counselors(user: dict = Depends(require_role(['super_admin']))):
-    counselors = await db.users.find(
-        {'role': 'counselor'}, 
-        {'_id': 0, 'password': 0}
-    ).to_list(100)
+async def get_all_counselors(
+    user: dict = Depends(require_role(['super_admin'])),
+    fieldset: Fieldset = Depends(counselor_list_fieldset),
+    repos: Repositories = Depends(get_repositories)
+):
+    counselors = await repos.users.list_by_role('counselor', projection=fieldset.projection('counselors', ('userId',)))
     
     # Add assigned students count
-    for counselor in counselors:
-        count = await db.students.count_documents({'assignedCounselor': counselor['userId']})
-        counselor['assignedStudents'] = count
+    if fieldset.wants('counselors', 'assignedStudents'):
+        load = await repos.students.assignment_load('assignedCounselor', [c['userId'] for c in counselors])
+        for counselor in counselors:
+            counselor['assignedStudents'] = load[counselor['userId']]
     
     return {'counselors': counselors}
 
 @admin_router.get("/agents")
-async def get_all_agents(user: dict = Depends(require_role(['super_admin']))):
-    agents = await db.users.find(
-        {'role': 'agent'}, 
-        {'_id': 0, 'password': 0}
-    ).to_list(100)
+async def get_all_agents(
+    user: dict = Depends(require_role(['super_admin'])),
+    fieldset: Fieldset = Depends(agent_list_fieldset),
+    repos: Repositories = Depends(get_repositories)
+):
+    agents = await repos.users.list_by_role('agent', projection=fieldset.projection('agents', ('userId',)))
     
     # Add referred students count and commission info
-    for agent in agents:
-        count = await db.students.count_documents({'assignedAgent': agent['userId']})
-        agent['referredStudents'] = count
-        
-        # Calculate total commission
-        commissions = await db.commissions.find({'agentId': agent['userId'], 'status': 'paid'}).to_list(1000)
-        agent['totalCommission'] = sum(c.get('amount', 0) for c in commissions)
-        agent['commissionRate'] = 10  # Default rate
+    agent_ids = [a['userId'] for a in agents]
+    if fieldset.wants('agents', 'referredStudents'):
+        load = await repos.students.assignment_load('assignedAgent', agent_ids)
+        for agent in agents:
+            agent['referredStudents'] = load[agent['userId']]
+    if fieldset.wants('agents', 'totalCommission'):
+        totals = await get_commission_totals(repos, agent_ids)
+        for agent in agents:
+            agent['totalCommission'] = totals[agent['userId']]['amounts']['paid']
+    if fieldset.wants('agents', 'commissionRate'):
+        for agent in agents:
+            agent['commissionRate'] = 10  # Default rate
     
     return {'agents': agents}
 
+@admin_router.get("/agents/{agent_id}/earnings")
+async def get_agent_earnings_admin(
+    agent_id: str,
+    granularity: str = Query('month', pattern='^(day|month)$'),
+    start: Optional[str] = None,
+    end: Optional[str] = None,
+    user: dict = Depends(require_role(['super_admin'])),
+    repos: Repositories = Depends(get_repositories)
+):
+    return await get_earnings(repos, agent_id, granularity, start, end)
+
+@admin_router.get("/commissions")
+async def get_all_commissions(
+    createdFrom: Optional[datetime] = None,
+    createdTo: Optional[datetime] = None,
+    order: Literal['asc', 'desc'] = 'desc',
+    skip: int = Query(0, ge=0),
+    limit: int = Query(100, ge=1, le=1000),
+    user: dict = Depends(require_role(['super_admin'])),
+    fieldset: Fieldset = Depends(commission_list_fieldset),
+    repos: Repositories = Depends(get_repositories)
+):
+    commissions = await repos.commissions.list(
+        created_from=createdFrom, created_to=createdTo, order=order, skip=skip, limit=limit,
+        projection=fieldset.projection('commissions')
+    )
+    
+    # Sum the all-time rollups instead of the ledger
+    totals = await repos.rollups.summary()
+    summary = {
+        'total': totals['count'],
+        'totalPending': totals['pending'],
+        'totalApproved': totals['approved'],
+        'totalPaid': totals['paid']
+    }
+    
+    return {'commissions': commissions, 'summary': summary}
+
+@admin_router.post("/commissions")
+async def create_commission(
+    data: CommissionCreate,
+    user: dict = Depends(require_role(['super_admin'])),
+    repos: Repositories = Depends(get_repositories)
+):
+    commission = await record_commission(
+        repos, data.agentId, data.studentId, data.serviceId, data.amount, data.percentage
+    )
+    return {'message': 'Commission recorded', 'commission': commission}
+
+@admin_router.put("/commissions/{commission_id}/approve")
+async def approve_commission(
+    commission_id: str,
+    request: Request,
+    user: dict = Depends(require_role(['super_admin'])),
+    repos: Repositories = Depends(get_repositories)
+):
+    commission = await set_commission_status(repos, commission_id, 'approved', ['pending'])
+    if not commission:
+        raise HTTPException(status_code=404, detail="Pending commission not found")
+    await audit_log.log(user['userId'], 'commission_approved', 'commission', commission_id, {
+        'amount': commission['amount'], 'agentId': commission['agentId']
+    }, request, repos=repos)
+    await notifications.publish(
+        'commission',
+        'Commission Approved',
+        f"Your commission of ${commission['amount']} has been approved",
+        {'commissionId': commission_id},
+        user_ids=[commission['agentId']],
+        repos=repos
+    )
+    return {'message': 'Commission approved', 'commission': commission}
+
+@admin_router.post("/commissions/{commission_id}/payout")
+async def payout_commission(
+    commission_id: str,
+    request: Request,
+    user: dict = Depends(require_role(['super_admin'])),
+    repos: Repositories = Depends(get_repositories)
+):
+    commission = await set_commission_status(repos, commission_id, 'paid', ['approved'])
+    if not commission:
+        raise HTTPException(status_code=400, detail="Commission must be approved first")
+    await audit_log.log(user['userId'], 'commission_paid', 'commission', commission_id, {
+        'amount': commission['amount'], 'agentId': commission['agentId']
+    }, request, repos=repos)
+    await notifications.publish(
+        'commission',
+        'Commission Paid',
+        f"Your commission of ${commission['amount']} has been paid",
+        {'commissionId': commission_id},
+        user_ids=[commission['agentId']],
+        repos=repos
+    )
+    return {'message': 'Payout processed', 'commission': commission}
+
+@admin_router.post("/commissions/rollups/backfill")
+async def backfill_commission_rollups_endpoint(
+    user: dict = Depends(require_role(['super_admin'])),
+    repos: Repositories = Depends(get_repositories)
+):
+    rollups = await backfill_commission_rollups(repos)
+    return {'message': 'Commission rollups rebuilt', 'rollups': rollups}
+
 @admin_router.post("/users")
-async def create_user(data: UserCreate, user: dict = Depends(require_role(['super_admin']))):
-    existing = await db.users.find_one({'email': data.email.lower()})
+async def create_user(
+    data: UserCreate,
+    request: Request,
+    user: dict = Depends(require_role(['super_admin'])),
+    repos: Repositories = Depends(get_repositories)
+):
+    existing = await repos.users.get_by_email(data.email.lower())
     if existing:
         raise HTTPException(status_code=400, detail="Email already exists")
     
@@ -304,15 +3634,18 @@ async def create_user(data: UserCreate, user: dict = Depends(require_role(['supe
     user_doc = {
         'userId': user_id,
         'email': data.email.lower(),
-        'password': hash_password(data.password),
+        'password': await hash_password_async(data.password),
         'firstName': data.firstName,
         'lastName': data.lastName,
         'role': data.role,
         'isActive': True,
-        'createdAt': datetime.now(timezone.utc).isoformat()
+        'createdAt': datetime.now(timezone.utc)
     }
     
-    await db.users.insert_one(user_doc)
+    await repos.users.insert(user_doc)
+    await index_user_for_search(repos, user_id)
+    await audit_log.log(user['userId'], 'user_created', 'user', user_id, {'role': data.role, 'source': 'admin'},
+                        request, repos=repos)
     
     return {
         'message': 'User created',
@@ -325,33 +3658,95 @@ async def create_user(data: UserCreate, user: dict = Depends(require_role(['supe
         }
     }
 
+@admin_router.post("/users/import")
+async def bulk_import_users(
+    request: Request,
+    file: UploadFile = File(...),
+    format: Optional[Literal['csv', 'ndjson']] = None,
+    user: dict = Depends(require_role(['super_admin'])),
+    repos: Repositories = Depends(get_repositories)
+):
+    # Duplicates are only rejected by the unique email index; without it they would be inserted
+    if not await repos.users.has_unique_email():
+        raise HTTPException(status_code=503, detail="Unique email index is missing; import is disabled")
+    
+    fmt = format
+    if not fmt:
+        name = (file.filename or '').lower()
+        fmt = 'ndjson' if name.endswith(('.ndjson', '.jsonl')) or 'ndjson' in (file.content_type or '') else 'csv'
+    
+    result = await import_users(repos, file, fmt)
+    for row in result['rows']:
+        if row['status'] == 'created':
+            await audit_log.log(user['userId'], 'user_created', 'user', row['userId'], {'source': 'import'},
+                                request, repos=repos)
+    return {'message': 'Import finished', **result}
+
+@admin_router.post("/notifications/announce", status_code=202)
+async def announce(
+    data: AnnouncementCreate,
+    user: dict = Depends(require_role(['super_admin'])),
+    repos: Repositories = Depends(get_repositories)
+):
+    await notifications.publish(
+        'general', data.title, data.message, {'announcedBy': user['userId']}, roles=data.roles, repos=repos
+    )
+    return {'message': 'Announcement queued'}
+
+@admin_router.get("/audit")
+async def get_audit_logs(
+    userId: Optional[str] = None,
+    action: Optional[str] = None,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    skip: int = Query(0, ge=0),
+    limit: int = Query(50, ge=1, le=500),
+    user: dict = Depends(require_role(['super_admin'])),
+    repos: Repositories = Depends(get_repositories)
+):
+    filters = {}
+    if userId:
+        filters['userId'] = userId
+    if action:
+        filters['action'] = action
+    logs = await repos.audit.find(filters, start, end, skip, limit)
+    return {'logs': logs, 'skip': skip, 'limit': limit}
+
 # ============== STUDENT ROUTES ==============
 
 @student_router.get("/profile")
-async def get_student_profile(user: dict = Depends(require_role(['student']))):
-    student = await db.students.find_one({'userId': user['userId']}, {'_id': 0})
+async def get_student_profile(
+    user: dict = Depends(require_role(['student'])),
+    fieldset: Fieldset = Depends(student_profile_fieldset),
+    repos: Repositories = Depends(get_repositories)
+):
+    student = await repos.students.get_by_user(user['userId'], fieldset.projection('student', ('studentId', 'userId')))
     if not student:
         raise HTTPException(status_code=404, detail="Student profile not found")
     
-    applications = await db.service_applications.find(
-        {'studentId': student['studentId']},
-        {'_id': 0}
-    ).to_list(100)
-    
-    # Get service details for each application
-    for app in applications:
-        service = await db.services.find_one({'serviceId': app['serviceId']}, {'_id': 0})
-        app['service'] = service
+    response = {'student': student}
+    if fieldset.embeds_resource('user'):
+        response['user'] = fieldset.trim('user', user)
+    if fieldset.embeds_resource('applications'):
+        applications = await repos.applications.list_for_student(
+            student['studentId'], fieldset.projection('applications', ('serviceId',))
+        )
+        
+        # Get service details for each application
+        if fieldset.embeds_resource('service'):
+            await embed_services(repos, applications, fieldset)
+        response['applications'] = applications
     
-    return {
-        'student': student,
-        'user': user,
-        'applications': applications
-    }
+    return response
 
 @student_router.post("/onboarding")
-async def complete_onboarding(data: OnboardingData, user: dict = Depends(require_role(['student']))):
-    student = await db.students.find_one({'userId': user['userId']})
+async def complete_onboarding(
+    data: OnboardingData,
+    request: Request,
+    user: dict = Depends(require_role(['student'])),
+    repos: Repositories = Depends(get_repositories)
+):
+    student = await repos.students.get_by_user(user['userId'])
     if not student:
         # Create student record if it doesn't exist
         student_doc = {
@@ -362,29 +3757,23 @@ async def complete_onboarding(data: OnboardingData, user: dict = Depends(require
             'intake': data.intake,
             'preferredDestination': data.preferredDestination,
             'onboardingCompleted': True,
-            'createdAt': datetime.now(timezone.utc).isoformat()
+            'createdAt': datetime.now(timezone.utc)
         }
-        await db.students.insert_one(student_doc)
+        await repos.students.insert(student_doc)
         student = student_doc
     else:
-        await db.students.update_one(
-            {'userId': user['userId']},
-            {'$set': {
-                'interestedCountries': data.interestedCountries,
-                'selectedServices': data.selectedServices,
-                'intake': data.intake,
-                'preferredDestination': data.preferredDestination,
-                'onboardingCompleted': True
-            }}
-        )
+        await repos.students.update_by_user(user['userId'], {
+            'interestedCountries': data.interestedCountries,
+            'selectedServices': data.selectedServices,
+            'intake': data.intake,
+            'preferredDestination': data.preferredDestination,
+            'onboardingCompleted': True
+        })
     
     # Create service applications for selected services
     student_id = student.get('studentId', str(uuid.uuid4()))
     for service_id in data.selectedServices:
-        existing_app = await db.service_applications.find_one({
-            'studentId': student_id,
-            'serviceId': service_id
-        })
+        existing_app = await repos.applications.find(student_id, service_id)
         if not existing_app:
             app_doc = {
                 'applicationId': str(uuid.uuid4()),
@@ -392,35 +3781,55 @@ async def complete_onboarding(data: OnboardingData, user: dict = Depends(require
                 'serviceId': service_id,
                 'status': 'not_started',
                 'progress': 0,
-                'createdAt': datetime.now(timezone.utc).isoformat()
+                'createdAt': datetime.now(timezone.utc)
             }
-            await db.service_applications.insert_one(app_doc)
+            await repos.applications.insert(app_doc)
+    
+    await refresh_student_summary(repos, student_id)
+    await index_user_for_search(repos, user['userId'])
+    await audit_log.log(user['userId'], 'student_onboarded', 'student', student_id, {
+        'interestedCountries': data.interestedCountries,
+        'selectedServices': data.selectedServices
+    }, request, repos=repos)
+    if data.selectedServices:
+        await notifications.publish(
+            'service_application',
+            'Onboarding Completed',
+            f"{user['firstName']} {user['lastName']} completed onboarding and selected {len(data.selectedServices)} services",
+            {'studentId': student_id, 'serviceIds': data.selectedServices},
+            student_ids=[student_id], admins=True, exclude=user['userId'], repos=repos
+        )
     
-    return {'message': 'Onboarding completed', 'onboardingCompleted': True}
+    response = {'message': 'Onboarding completed', 'onboardingCompleted': True}
+    # Claims in the current access token are now stale; hand out a fresh one
+    if 'sessionId' in user:
+        response['token'] = create_access_token(user, True, user['sessionId'])
+    return response
 
 @student_router.get("/applications")
-async def get_student_applications(user: dict = Depends(require_role(['student']))):
-    student = await db.students.find_one({'userId': user['userId']}, {'_id': 0})
+async def get_student_applications(
+    user: dict = Depends(require_role(['student'])),
+    fieldset: Fieldset = Depends(application_fieldset),
+    repos: Repositories = Depends(get_repositories)
+):
+    student = await repos.students.get_by_user(user['userId'], {'_id': 0, 'studentId': 1})
     if not student:
         return {'applications': []}
     
-    applications = await db.service_applications.find(
-        {'studentId': student['studentId']},
-        {'_id': 0}
-    ).to_list(100)
+    applications = await repos.applications.list_for_student(
+        student['studentId'], fieldset.projection('applications', ('serviceId',))
+    )
     
     # Add service details
-    for app in applications:
-        service = await db.services.find_one({'serviceId': app['serviceId']}, {'_id': 0})
-        app['service'] = service
+    if fieldset.embeds_resource('service'):
+        await embed_services(repos, applications, fieldset)
     
     return {'applications': applications}
 
 # ============== SERVICE ROUTES ==============
 
-@service_router.get("/")
-async def get_services():
-    services = await db.services.find({}, {'_id': 0}).to_list(100)
+async def load_services(repos: Repositories) -> List[dict]:
+    services = await repos.services.list()
     
     # If no services, create default ones
     if not services:
@@ -474,23 +3883,31 @@ async def get_services():
                 'icon': 'Shield'
             }
         ]
-        for service in default_services:
-            await db.services.insert_one(service)
+        await repos.services.insert_many(default_services)
         services = default_services
     
+    return services
+
+@service_router.get("/")
+async def get_services(response: Response, repos: Repositories = Depends(get_repositories)):
+    services = await stale_cache.read(
+        'services', lambda: load_services(repos), response, SERVICE_CATALOG_FRESH_SECONDS
+    )
     return {'services': services}
 
 @service_router.post("/apply")
-async def apply_for_service(data: ServiceApplicationCreate, user: dict = Depends(require_role(['student']))):
-    student = await db.students.find_one({'userId': user['userId']})
+async def apply_for_service(
+    data: ServiceApplicationCreate,
+    request: Request,
+    user: dict = Depends(require_role(['student'])),
+    repos: Repositories = Depends(get_repositories)
+):
+    student = await repos.students.get_by_user(user['userId'])
     if not student:
         raise HTTPException(status_code=404, detail="Student profile not found")
     
     # Check if already applied
-    existing = await db.service_applications.find_one({
-        'studentId': student['studentId'],
-        'serviceId': data.serviceId
-    })
+    existing = await repos.applications.find(student['studentId'], data.serviceId)
     if existing:
         raise HTTPException(status_code=400, detail="Already applied for this service")
     
@@ -500,91 +3917,113 @@ async def apply_for_service(data: ServiceApplicationCreate, user: dict = Depends
         'serviceId': data.serviceId,
         'status': 'not_started',
         'progress': 0,
-        'createdAt': datetime.now(timezone.utc).isoformat()
+        'createdAt': datetime.now(timezone.utc)
     }
-    await db.service_applications.insert_one(app_doc)
+    await repos.applications.insert(app_doc)
+    await refresh_student_summary(repos, student['studentId'])
+    await audit_log.log(user['userId'], 'service_applied', 'application', app_doc['applicationId'], {
+        'serviceId': data.serviceId
+    }, request, repos=repos)
+    await notifications.publish(
+        'service_application',
+        'New Service Application',
+        f"{user['firstName']} {user['lastName']} applied for a service",
+        {'applicationId': app_doc['applicationId'], 'serviceId': data.serviceId, 'studentId': student['studentId']},
+        student_ids=[student['studentId']], admins=True, exclude=user['userId'], repos=repos
+    )
     
-    return {'message': 'Application submitted', 'application': {k: v for k, v in app_doc.items() if k != '_id'}}
+    return {'message': 'Application submitted', 'application': app_doc}
 
 # ============== COUNSELOR ROUTES ==============
 
 counselor_router = APIRouter(prefix="/counselors", tags=["Counselors"])
 
-@counselor_router.get("/dashboard")
-async def get_counselor_dashboard(user: dict = Depends(require_role(['counselor']))):
-    # Get counselor's assigned students
-    students = await db.students.find({'assignedCounselor': user['userId']}, {'_id': 0}).to_list(100)
-    
-    # Calculate stats
-    total_students = len(students)
-    services_applied = await db.service_applications.count_documents({
-        'studentId': {'$in': [s.get('studentId') for s in students]}
-    })
-    
-    # Calculate commission (mock calculation)
-    commission_earned = total_students * 150  # Average commission per student
-    
+async def counselor_stats(repos: Repositories, user_id: str) -> dict:
+    totals = await repos.summaries.totals('assignedCounselor', user_id)
     return {
-        'stats': {
-            'enrolledStudents': total_students,
-            'servicesApplied': services_applied,
-            'commissionEarned': commission_earned
-        },
-        'students': students
+        'enrolledStudents': totals['students'],
+        'servicesApplied': totals['applications'],
+        # Calculate commission (mock calculation)
+        'commissionEarned': totals['students'] * 150  # Average commission per student
     }
 
+@counselor_router.get("/dashboard")
+async def get_counselor_dashboard(
+    response: Response,
+    partial: bool = Query(False, description="Return the parts that finish within the budget instead of a 504"),
+    user: dict = Depends(require_role(['counselor'])),
+    repos: Repositories = Depends(get_repositories)
+):
+    # Get counselor's assigned students
+    return await stale_cache.read(
+        ('counselor-dashboard', user['userId'], partial),
+        lambda: gather_parts({
+            'stats': counselor_stats(repos, user['userId']),
+            'students': repos.students.list_assigned('assignedCounselor', user['userId'])
+        }, partial),
+        response
+    )
+
 @counselor_router.get("/my-students")
-async def get_counselor_students(user: dict = Depends(require_role(['counselor']))):
+async def get_counselor_students(
+    user: dict = Depends(require_role(['counselor'])),
+    fieldset: Fieldset = Depends(student_list_fieldset),
+    repos: Repositories = Depends(get_repositories)
+):
     # Get all students assigned to this counselor
-    students = await db.students.find({'assignedCounselor': user['userId']}, {'_id': 0}).to_list(100)
-    
-    students_with_details = []
-    for student in students:
-        user_data = await db.users.find_one(
-            {'userId': student['userId']}, 
-            {'_id': 0, 'password': 0}
-        )
-        applications = await db.service_applications.find(
-            {'studentId': student['studentId']},
-            {'_id': 0}
-        ).to_list(100)
-        
-        students_with_details.append({
-            **student,
-            'user': user_data,
-            'applications': applications
-        })
+    students = await repos.students.list_assigned(
+        'assignedCounselor', user['userId'], fieldset.projection('student', ('studentId', 'userId'))
+    )
     
-    return {'students': students_with_details}
+    return {'students': await embed_students(repos, students, fieldset)}
+
+@counselor_router.get("/my-students/summary")
+async def get_counselor_student_summaries(
+    createdFrom: Optional[datetime] = None,
+    createdTo: Optional[datetime] = None,
+    order: Literal['asc', 'desc'] = 'desc',
+    skip: int = Query(0, ge=0),
+    limit: int = Query(100, ge=1, le=1000),
+    user: dict = Depends(require_role(['counselor'])),
+    repos: Repositories = Depends(get_repositories)
+):
+    return await list_student_summaries(
+        repos, {'assignedCounselor': user['userId']}, skip, limit, createdFrom, createdTo, order
+    )
 
 # ============== AGENT ROUTES ==============
 
 agent_router = APIRouter(prefix="/agents", tags=["Agents"])
 
-@agent_router.get("/dashboard")
-async def get_agent_dashboard(user: dict = Depends(require_role(['agent']))):
+async def agent_stats(repos: Repositories, user_id: str) -> dict:
+    totals, commissions = await asyncio.gather(
+        repos.summaries.totals('assignedAgent', user_id),
+        get_commission_totals(repos, [user_id])
+    )
+    amounts = commissions[user_id]['amounts']
+    return {
+        'referredStudents': totals['students'],
+        'activeApplications': totals['activeApplications'],
+        'totalCommission': amounts['paid'] or 8750,
+        'pendingCommission': amounts['pending'] or 1250
+    }
+
+async def agent_dashboard(repos: Repositories, user_id: str, partial: bool) -> dict:
     # Get agent's referred students
-    students = await db.students.find({'assignedAgent': user['userId']}, {'_id': 0}).to_list(100)
-    
-    # Calculate stats
-    total_referred = len(students)
-    active_applications = await db.service_applications.count_documents({
-        'studentId': {'$in': [s.get('studentId') for s in students]},
-        'status': {'$in': ['not_started', 'in_progress']}
-    })
-    
-    # Get commissions
-    commissions = await db.commissions.find({'agentId': user['userId']}, {'_id': 0}).to_list(100)
-    total_commission = sum(c.get('amount', 0) for c in commissions if c.get('status') == 'paid')
-    pending_commission = sum(c.get('amount', 0) for c in commissions if c.get('status') == 'pending')
+    results = await gather_parts({
+        'stats': agent_stats(repos, user_id),
+        'students': repos.students.list_assigned('assignedAgent', user_id, limit=5)
+    }, partial)
+    students = results.pop('students') or []
     
     # Recent referrals
+    users = await repos.users.find_many([s['userId'] for s in students])
+    users_by_id = {u['userId']: u for u in users}
     recent_referrals = []
-    for student in students[:5]:
-        user_data = await db.users.find_one({'userId': student['userId']}, {'_id': 0, 'password': 0})
+    for student in students:
         recent_referrals.append({
             'id': student['studentId'],
-            'student': user_data,
+            'student': users_by_id.get(student['userId']),
             'service': 'University Application',
             'commission': 300,
             'status': 'paid',
@@ -592,56 +4031,202 @@ async def get_agent_dashboard(user: dict = Depends(require_role(['agent']))):
         })
     
     return {
-        'stats': {
-            'referredStudents': total_referred,
-            'activeApplications': active_applications,
-            'totalCommission': total_commission or 8750,
-            'pendingCommission': pending_commission or 1250
-        },
+        **results,
         'referrals': recent_referrals
     }
 
+@agent_router.get("/dashboard")
+async def get_agent_dashboard(
+    response: Response,
+    partial: bool = Query(False, description="Return the parts that finish within the budget instead of a 504"),
+    user: dict = Depends(require_role(['agent'])),
+    repos: Repositories = Depends(get_repositories)
+):
+    return await stale_cache.read(
+        ('agent-dashboard', user['userId'], partial),
+        lambda: agent_dashboard(repos, user['userId'], partial),
+        response
+    )
+
 @agent_router.get("/my-students")
-async def get_agent_students(user: dict = Depends(require_role(['agent']))):
+async def get_agent_students(
+    user: dict = Depends(require_role(['agent'])),
+    fieldset: Fieldset = Depends(student_list_fieldset),
+    repos: Repositories = Depends(get_repositories)
+):
     # Get all students referred by this agent
-    students = await db.students.find({'assignedAgent': user['userId']}, {'_id': 0}).to_list(100)
+    students = await repos.students.list_assigned(
+        'assignedAgent', user['userId'], fieldset.projection('student', ('studentId', 'userId'))
+    )
     
-    students_with_details = []
-    for student in students:
-        user_data = await db.users.find_one(
-            {'userId': student['userId']}, 
-            {'_id': 0, 'password': 0}
-        )
-        applications = await db.service_applications.find(
-            {'studentId': student['studentId']},
-            {'_id': 0}
-        ).to_list(100)
-        
-        # Calculate commission for this student
-        commission = len(applications) * 150
-        
-        students_with_details.append({
-            **student,
-            'user': user_data,
-            'applications': applications,
-            'commission': commission
-        })
+    students_with_details = await embed_students(repos, students, fieldset)
+    
+    # Calculate commission for each student
+    if fieldset.wants('student', 'commission'):
+        if fieldset.embeds_resource('applications'):
+            counts = {s['studentId']: len(s['applications']) for s in students_with_details}
+        else:
+            counts = await repos.applications.counts_by_student([s['studentId'] for s in students])
+        for student in students_with_details:
+            student['commission'] = counts.get(student['studentId'], 0) * 150
     
     return {'students': students_with_details}
 
+@agent_router.get("/my-students/summary")
+async def get_agent_student_summaries(
+    createdFrom: Optional[datetime] = None,
+    createdTo: Optional[datetime] = None,
+    order: Literal['asc', 'desc'] = 'desc',
+    skip: int = Query(0, ge=0),
+    limit: int = Query(100, ge=1, le=1000),
+    user: dict = Depends(require_role(['agent'])),
+    repos: Repositories = Depends(get_repositories)
+):
+    return await list_student_summaries(
+        repos, {'assignedAgent': user['userId']}, skip, limit, createdFrom, createdTo, order
+    )
+
 @agent_router.get("/commissions")
-async def get_agent_commissions(user: dict = Depends(require_role(['agent']))):
-    commissions = await db.commissions.find({'agentId': user['userId']}, {'_id': 0}).to_list(100)
+async def get_agent_commissions(
+    createdFrom: Optional[datetime] = None,
+    createdTo: Optional[datetime] = None,
+    order: Literal['asc', 'desc'] = 'desc',
+    skip: int = Query(0, ge=0),
+    limit: int = Query(100, ge=1, le=1000),
+    user: dict = Depends(require_role(['agent'])),
+    fieldset: Fieldset = Depends(commission_list_fieldset),
+    repos: Repositories = Depends(get_repositories)
+):
+    commissions = await repos.commissions.list(
+        user['userId'], createdFrom, createdTo, order, skip, limit, fieldset.projection('commissions')
+    )
     
-    total_earned = sum(c.get('amount', 0) for c in commissions if c.get('status') == 'paid')
-    pending = sum(c.get('amount', 0) for c in commissions if c.get('status') == 'pending')
+    totals = (await get_commission_totals(repos, [user['userId']]))[user['userId']]
     
     return {
         'commissions': commissions,
-        'totalEarned': total_earned,
-        'pending': pending
+        'total': totals['count'],
+        'totalEarned': totals['amounts']['paid'],
+        'pending': totals['amounts']['pending']
+    }
+
+@agent_router.get("/earnings")
+async def get_agent_earnings(
+    granularity: str = Query('month', pattern='^(day|month)$'),
+    start: Optional[str] = None,
+    end: Optional[str] = None,
+    user: dict = Depends(require_role(['agent'])),
+    repos: Repositories = Depends(get_repositories)
+):
+    return await get_earnings(repos, user['userId'], granularity, start, end)
+
+# ============== NOTIFICATION ROUTES ==============
+
+notification_router = APIRouter(prefix="/notifications", tags=["Notifications"])
+
+@notification_router.get("")
+async def get_notifications(
+    unreadOnly: bool = False,
+    skip: int = Query(0, ge=0),
+    limit: int = Query(20, ge=1, le=100),
+    user: dict = Depends(get_current_user),
+    repos: Repositories = Depends(get_repositories)
+):
+    items, unread = await asyncio.gather(
+        repos.inbox.list(user['userId'], unreadOnly, skip, limit),
+        repos.inbox.unread_count(user['userId'])
+    )
+    
+    return {
+        'notifications': items,
+        'unreadCount': unread,
+        'skip': skip,
+        'limit': limit
     }
 
+@notification_router.put("/mark-all-read")
+async def mark_all_notifications_read(
+    user: dict = Depends(get_current_user),
+    repos: Repositories = Depends(get_repositories)
+):
+    updated = await repos.inbox.mark_all_read(user['userId'])
+    return {'message': 'All notifications marked as read', 'updated': updated}
+
+@notification_router.put("/{notification_id}/read")
+async def mark_notification_read(
+    notification_id: str,
+    user: dict = Depends(get_current_user),
+    repos: Repositories = Depends(get_repositories)
+):
+    await repos.inbox.mark_read(user['userId'], notification_id)
+    return {'message': 'Notification marked as read'}
+
+# ============== BOOTSTRAP ROUTES ==============
+# Everything a role's layout needs on first load in one response. The parts are
+# fetched concurrently and share lookups (the service catalog doubles as the
+# application service details, a student's own document carries the onboarding
+# flag of the profile; stats come from the student read model).
+
+async def student_bootstrap(repos: Repositories, user: dict) -> dict:
+    student = await repos.students.get_by_user(user['userId'])
+    applications = []
+    if student:
+        applications = await repos.applications.list_for_student(student['studentId'], newest_first=True)
+    return {'student': student, 'applications': applications}
+
+def attach_services(applications: List[dict], services: List[dict]):
+    services_by_id = {sv['serviceId']: sv for sv in services}
+    for app in applications:
+        app['service'] = services_by_id.get(app['serviceId'])
+
+async def load_bootstrap(repos: Repositories, user: dict, limit: int, partial: bool) -> dict:
+    role = user['role']
+    parts = {'services': load_services(repos)}
+    if role == 'student':
+        # The student part fetches the student once; the profile reads its flag from it
+        parts['student'] = student_bootstrap(repos, user)
+    else:
+        parts['user'] = current_user_profile(repos, user)
+    
+    if role == 'super_admin':
+        parts['metrics'] = admin_metrics(repos)
+        parts['students'] = list_student_summaries(repos, {}, 0, limit)
+    elif role == 'counselor':
+        parts['stats'] = counselor_stats(repos, user['userId'])
+        parts['students'] = list_student_summaries(repos, {'assignedCounselor': user['userId']}, 0, limit)
+    elif role == 'agent':
+        parts['stats'] = agent_stats(repos, user['userId'])
+        parts['students'] = list_student_summaries(repos, {'assignedAgent': user['userId']}, 0, limit)
+    
+    results = await gather_parts(parts, partial)
+    if role == 'student':
+        own = results.pop('student')
+        if own is None:
+            results.update(user=None, student=None, applications=None)
+            results['missing'] += ['user', 'applications']
+        else:
+            attach_services(own['applications'], results['services'] or [])
+            profile = {k: v for k, v in user.items() if k != 'sessionId'}
+            # Session claims already carry the onboarding flag
+            profile.setdefault('onboardingCompleted', student_onboarding_status(own['student']))
+            results.update(own, user=profile)
+    
+    return {'role': role, **results}
+
+@api_router.get("/bootstrap")
+async def bootstrap(
+    response: Response,
+    limit: int = Query(20, ge=1, le=100),
+    partial: bool = Query(False, description="Return the parts that finish within the budget instead of a 504"),
+    user: dict = Depends(get_current_user),
+    repos: Repositories = Depends(get_repositories)
+):
+    return await stale_cache.read(
+        ('bootstrap', user['userId'], limit, partial),
+        lambda: load_bootstrap(repos, user, limit, partial),
+        response
+    )
+
 # ============== ROOT ROUTES ==============
 
 @api_router.get("/")
@@ -650,7 +4235,16 @@ async def root():
 
 @api_router.get("/health")
 async def health():
-    return {"status": "healthy", "service": "Fly8 API"}
+    return {
+        "status": "healthy" if db_breaker.state == 'closed' else "degraded",
+        "service": "Fly8 API",
+        "writeBehind": write_behind.stats(),
+        "auditLog": audit_log.stats(),
+        "notifications": notifications.stats(),
+        "deadlines": deadline_stats,
+        "circuitBreaker": db_breaker.stats(),
+        "staleCache": stale_cache.stats()
+    }
 
 # Include all routers
 api_router.include_router(auth_router)
@@ -659,10 +4253,28 @@ api_router.include_router(student_router)
 api_router.include_router(service_router)
 api_router.include_router(counselor_router)
 api_router.include_router(agent_router)
+api_router.include_router(notification_router)
 
 # Include the main router
 app.include_router(api_router)
 
+@app.exception_handler(ExecutionTimeout)
+@app.exception_handler(NetworkTimeout)
+async def database_timeout_handler(request: Request, exc: Exception):
+    # The request's budget ran out while MongoDB was still working
+    return JSONResponse({'detail': 'Request timed out'}, status_code=504)
+
+@app.exception_handler(ConnectionFailure)
+async def database_unavailable_handler(request: Request, exc: Exception):
+    # No server or pool connection was available within the budget
+    db_breaker.record_exception(exc)
+    return JSONResponse({'detail': 'Database unavailable'}, status_code=503, headers={'Retry-After': '1'})
+
+# Added before CORS so timeout and fail-fast responses still get CORS headers
+app.add_middleware(DeadlineMiddleware)
+app.add_middleware(FailFastMiddleware)
+app.add_middleware(ProfilingMiddleware)
+
 # CORS Middleware
 app.add_middleware(
     CORSMiddleware,
@@ -672,13 +4284,20 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Long-running tasks started at startup and cancelled on shutdown
+background_tasks = []
+
 # Startup event - seed data
 @app.on_event("startup")
 async def startup_event():
     logger.info("Starting Fly8 API Server...")
     
+    # Every repository's indexes, the read models', audit log's (optionally capped
+    # or time-series) and notification inboxes' included
+    await repositories.ensure_indexes()
+    
     # Create super admin if not exists
-    admin = await db.users.find_one({'email': 'superadmin@fly8.com'})
+    admin = await repositories.users.get_by_email('superadmin@fly8.com')
     if not admin:
         admin_doc = {
             'userId': str(uuid.uuid4()),
@@ -688,13 +4307,13 @@ async def startup_event():
             'lastName': 'Admin',
             'role': 'super_admin',
             'isActive': True,
-            'createdAt': datetime.now(timezone.utc).isoformat()
+            'createdAt': datetime.now(timezone.utc)
         }
-        await db.users.insert_one(admin_doc)
+        await repositories.users.insert(admin_doc)
         logger.info("Created default super admin user")
     
     # Create sample counselor
-    counselor = await db.users.find_one({'email': 'counselor@fly8.com'})
+    counselor = await repositories.users.get_by_email('counselor@fly8.com')
     if not counselor:
         counselor_doc = {
             'userId': str(uuid.uuid4()),
@@ -704,13 +4323,13 @@ async def startup_event():
             'lastName': 'Johnson',
             'role': 'counselor',
             'isActive': True,
-            'createdAt': datetime.now(timezone.utc).isoformat()
+            'createdAt': datetime.now(timezone.utc)
         }
-        await db.users.insert_one(counselor_doc)
+        await repositories.users.insert(counselor_doc)
         logger.info("Created default counselor user")
     
     # Create sample agent
-    agent = await db.users.find_one({'email': 'agent@fly8.com'})
+    agent = await repositories.users.get_by_email('agent@fly8.com')
     if not agent:
         agent_doc = {
             'userId': str(uuid.uuid4()),
@@ -720,13 +4339,13 @@ async def startup_event():
             'lastName': 'Wilson',
             'role': 'agent',
             'isActive': True,
-            'createdAt': datetime.now(timezone.utc).isoformat()
+            'createdAt': datetime.now(timezone.utc)
         }
-        await db.users.insert_one(agent_doc)
+        await repositories.users.insert(agent_doc)
         logger.info("Created default agent user")
     
     # Create sample student
-    student_user = await db.users.find_one({'email': 'john@student.com'})
+    student_user = await repositories.users.get_by_email('john@student.com')
     if not student_user:
         student_user_id = str(uuid.uuid4())
         student_user_doc = {
@@ -737,9 +4356,9 @@ async def startup_event():
             'lastName': 'Smith',
             'role': 'student',
             'isActive': True,
-            'createdAt': datetime.now(timezone.utc).isoformat()
+            'createdAt': datetime.now(timezone.utc)
         }
-        await db.users.insert_one(student_user_doc)
+        await repositories.users.insert(student_user_doc)
         
         # Create student profile
         student_doc = {
@@ -748,13 +4367,50 @@ async def startup_event():
             'interestedCountries': ['USA', 'UK'],
             'selectedServices': [],
             'onboardingCompleted': True,
-            'createdAt': datetime.now(timezone.utc).isoformat()
+            'createdAt': datetime.now(timezone.utc)
         }
-        await db.students.insert_one(student_doc)
+        await repositories.students.insert(student_doc)
+        await refresh_student_summary(repositories, student_doc['studentId'])
         logger.info("Created default student user")
     
+    # Sessions: expire refresh tokens and revocations with TTL indexes
+    await db.refresh_tokens.create_index('jti', unique=True)
+    await db.refresh_tokens.create_index('sessionId')
+    await db.refresh_tokens.create_index('expiresAt', expireAfterSeconds=0)
+    await db.revoked_sessions.create_index('sessionId', unique=True)
+    await db.revoked_sessions.create_index('expiresAt', expireAfterSeconds=0)
+    await sync_revoked_sessions()
+    background_tasks.append(asyncio.create_task(revocation_sync_loop()))
+    background_tasks.append(asyncio.create_task(write_behind.run()))
+    
+    # Audit log writer and notification fan-out worker
+    background_tasks.append(asyncio.create_task(audit_log.run()))
+    background_tasks.append(asyncio.create_task(notifications.run()))
+    
+    # Build the read models once for databases that predate them
+    if await repositories.search.is_empty():
+        indexed = await rebuild_search_index(repositories)
+        logger.info(f"Indexed {indexed} users for search")
+    
+    if await repositories.summaries.is_empty() and await repositories.students.count() > 0:
+        rebuilt = await rebuild_student_summaries(repositories)
+        logger.info(f"Built {rebuilt} student summaries")
+    
+    # Agent totals are read from the rollups only
+    if await repositories.rollups.is_empty() and await repositories.commissions.count() > 0:
+        rollups = await backfill_commission_rollups(repositories)
+        logger.info(f"Built {rollups} commission rollups")
+    
     logger.info("Fly8 API Server started successfully!")
 
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    # Drain buffered writes before the client goes away
+    await write_behind.flush()
+    await audit_log.drain()
+    await notifications.drain()
+    hash_executor.shutdown(wait=False)
     client.close()
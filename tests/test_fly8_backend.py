@@ -5,6 +5,8 @@ Tests for authentication, admin endpoints, student endpoints, and services
 import pytest
 import requests
 import os
+import time
+import uuid
 
 BASE_URL = os.environ.get('REACT_APP_BACKEND_URL', '').rstrip('/')
 
@@ -27,6 +29,23 @@ class TestHealthAndRoot:
         data = response.json()
         assert data["status"] == "healthy"
         print("✓ Health endpoint working")
+    
+    def test_health_reports_write_behind_buffer(self):
+        """Test health endpoint exposes write-behind buffer stats"""
+        response = requests.get(f"{BASE_URL}/api/health")
+        assert response.status_code == 200
+        stats = response.json()["writeBehind"]
+        assert {"pending", "flushed", "dropped"} <= set(stats)
+        print(f"✓ Write-behind stats: {stats}")
+    
+    def test_health_reports_circuit_breaker(self):
+        """Test health endpoint exposes the database circuit breaker"""
+        response = requests.get(f"{BASE_URL}/api/health")
+        assert response.status_code == 200
+        data = response.json()
+        assert data["circuitBreaker"]["state"] == "closed"
+        assert "servedStale" in data["staleCache"]
+        print(f"✓ Circuit breaker: {data['circuitBreaker']}")
 
 
 class TestAuthentication:
@@ -112,6 +131,24 @@ class TestAuthentication:
         assert data["user"]["email"] == "superadmin@fly8.com"
         print("✓ Get current user endpoint working")
     
+    def test_refresh_token_rotation(self):
+        """Test refresh tokens rotate and cannot be reused (claims session mode only)"""
+        login_response = requests.post(f"{BASE_URL}/api/auth/login", json={
+            "email": "agent@fly8.com",
+            "password": "password123"
+        })
+        refresh_token = login_response.json().get("refreshToken")
+        if not refresh_token:
+            pytest.skip("Server is not running in claims session mode")
+        
+        response = requests.post(f"{BASE_URL}/api/auth/refresh", json={"refreshToken": refresh_token})
+        assert response.status_code == 200
+        assert response.json()["refreshToken"] != refresh_token
+        
+        response = requests.post(f"{BASE_URL}/api/auth/refresh", json={"refreshToken": refresh_token})
+        assert response.status_code == 401
+        print("✓ Refresh token rotation working")
+    
     def test_get_me_without_token(self):
         """Test /auth/me endpoint without token"""
         response = requests.get(f"{BASE_URL}/api/auth/me")
@@ -184,6 +221,140 @@ class TestAdminEndpoints:
         assert isinstance(data["agents"], list)
         print(f"✓ Get all agents: {len(data['agents'])} agents found")
     
+    def test_get_all_students_sparse_fields(self):
+        """Test fields/include trim the admin student list"""
+        response = requests.get(
+            f"{BASE_URL}/api/admin/students?fields=onboardingCompleted,user.firstName&include=user",
+            headers=self.headers
+        )
+        assert response.status_code == 200
+        for student in response.json()["students"]:
+            assert "applications" not in student
+            assert "interestedCountries" not in student
+            assert set(student["user"] or {}) <= {"userId", "firstName"}
+        print("✓ Sparse fieldsets on admin students working")
+    
+    def test_get_all_students_rejects_unknown_field(self):
+        """Test fields are validated"""
+        response = requests.get(
+            f"{BASE_URL}/api/admin/students?fields=user.password",
+            headers=self.headers
+        )
+        assert response.status_code == 400
+        print("✓ Unknown fields rejected")
+    
+    def test_bulk_assign_least_loaded(self):
+        """Test bulk assignment with the least-loaded policy"""
+        response = requests.post(
+            f"{BASE_URL}/api/admin/students/assign",
+            headers=self.headers,
+            json={"policy": "least_loaded", "limit": 50}
+        )
+        # 400 when there are no unassigned students left to balance
+        assert response.status_code in [200, 400]
+        if response.status_code == 200:
+            data = response.json()
+            assert "counselorLoad" in data
+            assert data["matched"] == len(data["assignments"])
+        print("✓ Bulk assignment (least loaded) working")
+    
+    def test_bulk_assign_rejects_unknown_counselor(self):
+        """Test bulk assignment validates counselor ids"""
+        response = requests.post(
+            f"{BASE_URL}/api/admin/students/assign",
+            headers=self.headers,
+            json={"assignments": [{"studentId": "missing", "counselorId": "not-a-counselor"}]}
+        )
+        assert response.status_code == 400
+        print("✓ Unknown counselor rejected")
+    
+    def test_search_prefix_match(self):
+        """Test admin search finds users by name prefix"""
+        response = requests.get(
+            f"{BASE_URL}/api/admin/search?q=joh",
+            headers=self.headers
+        )
+        assert response.status_code == 200
+        data = response.json()
+        emails = [r["email"] for r in data["results"]]
+        assert "john@student.com" in emails
+        print(f"✓ Search prefix: {len(emails)} results")
+    
+    def test_search_typo_tolerance(self):
+        """Test admin search tolerates a typo"""
+        response = requests.get(
+            f"{BASE_URL}/api/admin/search?q=jonhson&role=counselor",
+            headers=self.headers
+        )
+        assert response.status_code == 200
+        results = response.json()["results"]
+        assert all(r["role"] == "counselor" for r in results)
+        assert "counselor@fly8.com" in [r["email"] for r in results]
+        print("✓ Search typo tolerance working")
+    
+    def test_bulk_import_users_csv(self):
+        """Test CSV bulk import reports created, invalid and duplicate rows"""
+        email = f"TEST_import_{uuid.uuid4().hex[:8]}@example.com"
+        csv_data = (
+            "email,password,firstName,lastName,role\n"
+            f"{email},password123,Import,Test,student\n"
+            "not-an-email,password123,Bad,Row,student\n"
+            f"{email},password123,Dup,Row,student\n"
+        )
+        response = requests.post(
+            f"{BASE_URL}/api/admin/users/import",
+            headers=self.headers,
+            files={"file": ("users.csv", csv_data, "text/csv")}
+        )
+        assert response.status_code == 200
+        data = response.json()
+        statuses = [row["status"] for row in data["rows"]]
+        assert statuses == ["created", "invalid", "duplicate"]
+        print(f"✓ Bulk import: {data['counts']}")
+    
+    def test_bulk_import_csv_multiline_field(self):
+        """Test quoted CSV fields may span lines"""
+        email = f"TEST_multiline_{uuid.uuid4().hex[:8]}@example.com"
+        csv_data = (
+            "email,password,firstName,lastName,role\r\n"
+            f"{email},password123,\"Anne\r\nMarie\",Test,student\r\n"
+        )
+        response = requests.post(
+            f"{BASE_URL}/api/admin/users/import",
+            headers=self.headers,
+            files={"file": ("users.csv", csv_data, "text/csv")}
+        )
+        assert response.status_code == 200
+        rows = response.json()["rows"]
+        assert [(row["row"], row["status"]) for row in rows] == [(1, "created")]
+        print("✓ Multiline CSV field imported")
+    
+    def test_login_is_audited(self):
+        """Test logins are written to the audit log by the batch writer"""
+        me = requests.get(f"{BASE_URL}/api/auth/me", headers=self.headers).json()["user"]
+        time.sleep(2)  # let the writer flush the login from setup
+        response = requests.get(
+            f"{BASE_URL}/api/admin/audit?action=user_login&userId={me['userId']}&limit=5",
+            headers=self.headers
+        )
+        assert response.status_code == 200
+        logs = response.json()["logs"]
+        assert len(logs) > 0
+        assert logs[0]["action"] == "user_login"
+        print(f"✓ Audit log: {len(logs)} recent logins")
+    
+    def test_profile_request(self):
+        """Test opt-in request profiling returns or writes a profile"""
+        response = requests.get(
+            f"{BASE_URL}/api/admin/metrics?profile=1&profileOutput=inline",
+            headers=self.headers
+        )
+        assert response.status_code == 200
+        assert response.headers["X-Profile-Status"] == "200"
+        data = response.json()
+        assert data["profiles"][0]["type"] == "sampled"
+        print(f"✓ Profile: {response.headers.get('X-Profile-Summary')}")
+    
     def test_admin_endpoints_require_auth(self):
         """Test that admin endpoints require authentication"""
         endpoints = ["/api/admin/metrics", "/api/admin/students", "/api/admin/counselors", "/api/admin/agents"]
@@ -267,5 +438,219 @@ class TestStudentEndpoints:
         print(f"✓ Get student applications: {len(data['applications'])} applications found")
 
 
+class TestStudentSummaries:
+    """Student read model (student_summaries) tests"""
+    
+    @pytest.fixture(autouse=True)
+    def setup(self):
+        """Get admin token before each test"""
+        login_response = requests.post(f"{BASE_URL}/api/auth/login", json={
+            "email": "superadmin@fly8.com",
+            "password": "password123"
+        })
+        self.token = login_response.json()["token"]
+        self.headers = {"Authorization": f"Bearer {self.token}"}
+    
+    def test_get_student_summaries(self):
+        """Test paginated student summaries endpoint"""
+        response = requests.get(
+            f"{BASE_URL}/api/admin/students/summary?limit=10",
+            headers=self.headers
+        )
+        assert response.status_code == 200
+        data = response.json()
+        assert isinstance(data["students"], list)
+        assert data["limit"] == 10
+        if data["students"]:
+            summary = data["students"][0]
+            assert "applicationCounts" in summary
+            assert "email" in summary
+        print(f"✓ Student summaries: {data['total']} total")
+    
+    def test_student_summaries_date_range(self):
+        """Test createdAt range filtering and ascending order"""
+        response = requests.get(
+            f"{BASE_URL}/api/admin/students/summary?createdFrom=2024-01-01T00:00:00Z&order=asc",
+            headers=self.headers
+        )
+        assert response.status_code == 200
+        created = [s["createdAt"] for s in response.json()["students"] if s.get("createdAt")]
+        assert created == sorted(created)
+        assert all(c >= "2024-01-01" for c in created)
+        print(f"✓ Date range filter: {len(created)} students")
+    
+    def test_rebuild_then_check_is_consistent(self):
+        """Test that a rebuilt projection passes the consistency check"""
+        response = requests.post(
+            f"{BASE_URL}/api/admin/student-summaries/rebuild",
+            headers=self.headers
+        )
+        assert response.status_code == 200
+        
+        response = requests.get(
+            f"{BASE_URL}/api/admin/student-summaries/check",
+            headers=self.headers
+        )
+        assert response.status_code == 200
+        assert response.json()["consistent"] is True
+        print("✓ Student summaries consistent after rebuild")
+
+
+class TestCommissionLedger:
+    """Commission ledger and earnings rollup tests"""
+    
+    @pytest.fixture(autouse=True)
+    def setup(self):
+        """Get agent token before each test"""
+        login_response = requests.post(f"{BASE_URL}/api/auth/login", json={
+            "email": "agent@fly8.com",
+            "password": "password123"
+        })
+        self.token = login_response.json()["token"]
+        self.headers = {"Authorization": f"Bearer {self.token}"}
+    
+    def test_get_agent_commissions_totals(self):
+        """Test agent commissions endpoint returns rollup totals"""
+        response = requests.get(
+            f"{BASE_URL}/api/agents/commissions?limit=5",
+            headers=self.headers
+        )
+        assert response.status_code == 200
+        data = response.json()
+        assert len(data["commissions"]) <= 5
+        assert "totalEarned" in data
+        assert "pending" in data
+        print(f"✓ Agent commissions: {data['total']} total")
+    
+    def test_get_agent_earnings_by_month(self):
+        """Test earnings-over-time endpoint with a date range"""
+        response = requests.get(
+            f"{BASE_URL}/api/agents/earnings?granularity=month&start=2024-01&end=2030-12",
+            headers=self.headers
+        )
+        assert response.status_code == 200
+        data = response.json()
+        assert data["granularity"] == "month"
+        assert isinstance(data["buckets"], list)
+        assert "totals" in data
+        print(f"✓ Agent earnings: {len(data['buckets'])} months")
+    
+    def test_earnings_rejects_unknown_granularity(self):
+        """Test earnings endpoint validates granularity"""
+        response = requests.get(
+            f"{BASE_URL}/api/agents/earnings?granularity=year",
+            headers=self.headers
+        )
+        assert response.status_code == 422
+        print("✓ Invalid granularity rejected")
+
+
+class TestNotifications:
+    """Notification inbox tests"""
+    
+    @pytest.fixture(autouse=True)
+    def setup(self):
+        """Get counselor token before each test"""
+        login_response = requests.post(f"{BASE_URL}/api/auth/login", json={
+            "email": "counselor@fly8.com",
+            "password": "password123"
+        })
+        self.token = login_response.json()["token"]
+        self.headers = {"Authorization": f"Bearer {self.token}"}
+    
+    def test_get_notifications(self):
+        """Test paginated inbox with unread count"""
+        response = requests.get(
+            f"{BASE_URL}/api/notifications?limit=10",
+            headers=self.headers
+        )
+        assert response.status_code == 200
+        data = response.json()
+        assert isinstance(data["notifications"], list)
+        assert len(data["notifications"]) <= 10
+        assert data["unreadCount"] >= 0
+        print(f"✓ Notifications: {data['unreadCount']} unread")
+    
+    def test_mark_all_read_resets_unread_count(self):
+        """Test mark-all-read clears the unread counter"""
+        response = requests.put(
+            f"{BASE_URL}/api/notifications/mark-all-read",
+            headers=self.headers
+        )
+        assert response.status_code == 200
+        
+        response = requests.get(f"{BASE_URL}/api/notifications", headers=self.headers)
+        assert response.json()["unreadCount"] == 0
+        print("✓ Mark all notifications read working")
+    
+    def test_announce_requires_super_admin(self):
+        """Test announcements are admin only"""
+        response = requests.post(
+            f"{BASE_URL}/api/admin/notifications/announce",
+            headers=self.headers,
+            json={"title": "Test", "message": "Test"}
+        )
+        assert response.status_code == 403
+        print("✓ Announcements require super_admin role")
+
+
+class TestBootstrap:
+    """Aggregated first-load endpoint tests"""
+    
+    def _headers(self, email):
+        login_response = requests.post(f"{BASE_URL}/api/auth/login", json={
+            "email": email,
+            "password": "password123"
+        })
+        return {"Authorization": f"Bearer {login_response.json()['token']}"}
+    
+    def test_bootstrap_admin(self):
+        """Test admin bootstrap carries metrics and the first page of students"""
+        response = requests.get(
+            f"{BASE_URL}/api/bootstrap?limit=5",
+            headers=self._headers("superadmin@fly8.com")
+        )
+        assert response.status_code == 200
+        data = response.json()
+        assert data["role"] == "super_admin"
+        assert data["user"]["email"] == "superadmin@fly8.com"
+        assert "totalStudents" in data["metrics"]
+        assert len(data["students"]["students"]) <= 5
+        assert len(data["services"]) > 0
+        print("✓ Admin bootstrap working")
+    
+    def test_bootstrap_student(self):
+        """Test student bootstrap carries profile, applications and catalog"""
+        response = requests.get(
+            f"{BASE_URL}/api/bootstrap",
+            headers=self._headers("john@student.com")
+        )
+        assert response.status_code == 200
+        data = response.json()
+        assert data["role"] == "student"
+        assert "onboardingCompleted" in data["user"]
+        assert isinstance(data["applications"], list)
+        assert len(data["services"]) > 0
+        print(f"✓ Student bootstrap: {len(data['applications'])} applications")
+    
+    def test_dashboard_partial_results(self):
+        """Test dashboards report which parts missed the deadline when partial results are allowed"""
+        response = requests.get(
+            f"{BASE_URL}/api/counselors/dashboard?partial=true",
+            headers=self._headers("counselor@fly8.com")
+        )
+        assert response.status_code == 200
+        data = response.json()
+        assert isinstance(data["missing"], list)
+        assert "students" in data
+        print(f"✓ Partial dashboard: {len(data['missing'])} parts missing")
+    
+    def test_bootstrap_requires_auth(self):
+        """Test bootstrap requires authentication"""
+        response = requests.get(f"{BASE_URL}/api/bootstrap")
+        assert response.status_code in [401, 403]
+        print("✓ Bootstrap requires authentication")
+
+
 if __name__ == "__main__":
     pytest.main([__file__, "-v", "--tb=short"])